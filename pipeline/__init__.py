@@ -0,0 +1,5 @@
+"""
+Python pipeline for the simple2 BIDS to NIDM conversion.
+
+Run the modules from the repository root, e.g. ``python -m pipeline.run_all``.
+"""
@@ -0,0 +1,432 @@
+#!/usr/bin/env python
+"""
+Synthetic BIDS benchmark for the pipeline.
+
+Measuring how the pipeline scales otherwise means rerunning real ABIDE sites
+from the cluster. This tool generates synthetic BIDS sites offline and runs
+every stage on them at increasing subject counts:
+
+    cophenotype -> registry -> preflight -> convert (bidsmri2nidm -> phenotype,
+    or copy -> csv2nidm) -> merge -> export
+
+Generated sites have anat/func/dwi images (small but valid gzipped NIfTI-1),
+JSON sidecars (per image for anat/dwi, inherited from the top level for
+func), bvec/bval pairs and a participants.tsv with ABIDE-like phenotype
+columns (diagnosis, age, sex, handedness, IQ scores with -9999 and n/a codes,
+plus ``--columns`` numeric scores) and a mapping JSON for them.
+
+Each scale runs in its own process against its own output, log and state
+directories (the SIMPLE2_* overrides in config.py), so peak RSS is per scale.
+By default converters are replaced by an in-process stand-in that writes a
+graph of the same shape as bidsmri2nidm's (project, sessions, subject agents,
+one acquisition per image with its sidecar fields and sha512) and, in
+csv2nidm mode, appends the phenotype assessments. Use ``--converter worker``
+or ``subprocess`` to run the real PyNIDM tools.
+
+For each stage the report gives wall and CPU time, the process' peak RSS
+after the stage and subjects per second, plus the scaling exponent between
+consecutive scales (1.0 is linear); stages above 1.15 are flagged.
+
+Usage:
+    python -m pipeline.benchmark                          # 10, 100, 1000, 10000 subjects
+    python -m pipeline.benchmark --subjects 10 100 --sites 2 --sessions 2
+    python -m pipeline.benchmark --converter worker --phenotype-mode csv2nidm
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import math
+import os
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from pathlib import Path
+
+from . import telemetry, vocab
+from .config import DATASETS, OUTPUT_ROOT, REPO_DIR, read_sites
+from .cophenotype import build_dataset
+from .elements import MAPPINGS, write_registry
+from .export import export, pa
+from .merge import dataset_files, merge
+from .phenotype import get_index, site_subjects, write_additions
+from .preflight import check_sites, errors
+from .scheduler import FAILED, SKIPPED, Scheduler
+from .shards import DEFAULT_SHARD_SIZE
+from .steps import PHENOTYPE_MODES, site_steps
+from .turtle import XSD, TurtleWriter, literal
+from .worker import ConverterPool
+
+SCALES = (10, 100, 1000, 10000)
+MODALITIES = ("anat", "func", "dwi")
+CONVERTERS = ("synthetic", "worker", "subprocess")
+DATASET = "synthetic"
+SUPERLINEAR = 1.15  # scaling exponent above which a stage is flagged
+MIN_FLAG_SECONDS = 1.0
+STAGES = ("cophenotype", "registry", "preflight", "convert", "merge", "export")
+
+logger = logging.getLogger(__name__)
+
+SIDECARS = {
+    "anat": {"RepetitionTime": 2.3, "EchoTime": 0.00298, "InversionTime": 0.9, "FlipAngle": 9,
+             "MagneticFieldStrength": 3, "Manufacturer": "Siemens", "ScanningSequence": "GR_IR"},
+    "func": {"RepetitionTime": 2.0, "EchoTime": 0.03, "FlipAngle": 90, "TaskName": "rest",
+             "MagneticFieldStrength": 3, "Manufacturer": "Siemens", "PhaseEncodingDirection": "j-"},
+    "dwi": {"RepetitionTime": 8.5, "EchoTime": 0.089, "FlipAngle": 90,
+            "MagneticFieldStrength": 3, "Manufacturer": "Siemens", "PhaseEncodingDirection": "j-"},
+}
+SUFFIXES = {"anat": "T1w", "func": "task-rest_bold", "dwi": "dwi"}
+SHAPES = {"anat": (16, 16, 16), "func": (8, 8, 8, 10), "dwi": (8, 8, 8, 7)}
+
+
+def scale_env(root):
+    """SIMPLE2_* overrides that point one scale's pipeline at ``root``"""
+    return {
+        "SIMPLE2_DATALAD_ROOT": str(root / "datalad"),
+        "SIMPLE2_STATE_ROOT": str(root / "state"),
+        "SIMPLE2_OUTPUT_ROOT": str(root / "nidm_outputs"),
+        "SIMPLE2_LOG_ROOT": str(root / "logs"),
+        "SIMPLE2_EXPORT_ROOT": str(root / "nidm_exports"),
+        "SIMPLE2_NO_HASH_CACHE": "1",
+    }
+
+
+def nifti_bytes(shape, rng):
+    """A gzipped NIfTI-1 image (int16) of ``shape`` filled with random values"""
+    dims = [len(shape)] + list(shape) + [1] * (7 - len(shape))
+    header = bytearray(352)
+    struct.pack_into("<i", header, 0, 348)
+    struct.pack_into("<8h", header, 40, *dims)
+    struct.pack_into("<hh", header, 70, 4, 16)  # datatype int16, bitpix
+    struct.pack_into("<8f", header, 76, 1.0, *([2.0] * 7))
+    struct.pack_into("<f", header, 108, 352.0)  # vox_offset
+    struct.pack_into("<f", header, 112, 1.0)  # scl_slope
+    struct.pack_into("<hh", header, 252, 1, 1)  # qform/sform codes
+    header[344:348] = b"n+1\0"
+    voxels = math.prod(shape)
+    data = struct.pack(f"<{voxels}h", *(rng.randrange(0, 1000) for _ in range(voxels)))
+    return gzip.compress(bytes(header) + data, compresslevel=1, mtime=0)
+
+
+def phenotype_columns(extra):
+    """[(column, valueType, value generator)] shaped like the ABIDE phenotype columns"""
+    def iq(rng):
+        return rng.choice(["-9999", "n/a"]) if rng.random() < 0.08 else str(rng.randint(70, 140))
+
+    columns = [
+        ("dx_group", f"{XSD}integer", lambda rng: str(rng.choice([1, 2]))),
+        ("age_at_scan", f"{XSD}float", lambda rng: f"{rng.uniform(6, 60):.2f}"),
+        ("sex", f"{XSD}integer", lambda rng: str(rng.choice([1, 2]))),
+        ("handedness_category", f"{XSD}complexType", lambda rng: rng.choice(["R", "L", "Ambi", "n/a"])),
+        ("fiq", f"{XSD}integer", iq),
+        ("viq", f"{XSD}integer", iq),
+        ("piq", f"{XSD}integer", iq),
+        ("current_med_status", f"{XSD}integer", lambda rng: rng.choice(["0", "1", "n/a"])),
+    ]
+    for i in range(extra):
+        columns.append((f"score_{i + 1:03d}", f"{XSD}integer",
+                        lambda rng: "-9999" if rng.random() < 0.1 else str(rng.randint(0, 30))))
+    return columns
+
+
+def write_json(path, data):
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2)
+
+
+def generate(root, subjects, sites=1, sessions=1, modalities=MODALITIES, extra_columns=40, seed=0):
+    """Write a synthetic dataset under ``root``; return {"sites", "subjects", "files", "bytes"}"""
+    rng = random.Random(seed)
+    columns = phenotype_columns(extra_columns)
+    dataset_dir = root / "datalad" / DATASET
+    images = {mod: nifti_bytes(SHAPES[mod], rng) for mod in modalities}
+    site_names = [f"SITE_{i + 1:02d}" for i in range(sites)]
+    files = size = 0
+    for s, site in enumerate(site_names):
+        site_dir = dataset_dir / site
+        site_dir.mkdir(parents=True, exist_ok=True)
+        write_json(site_dir / "dataset_description.json", {"Name": f"Synthetic {site}", "BIDSVersion": "1.6.0"})
+        if "func" in modalities:
+            # Inherited by every bold image of the site
+            write_json(site_dir / "task-rest_bold.json", SIDECARS["func"])
+        rows = []
+        for n in range(s, subjects, sites):
+            label = f"{(s + 1) * 100000 + n:07d}"
+            rows.append([f"sub-{label}", site] + [make(rng) for _, _, make in columns])
+            for ses in range(sessions):
+                parts = [f"sub-{label}"] + ([f"ses-{ses + 1}"] if sessions > 1 else [])
+                for mod in modalities:
+                    mod_dir = site_dir.joinpath(*parts, mod)
+                    mod_dir.mkdir(parents=True, exist_ok=True)
+                    stem = mod_dir / "_".join(parts + [SUFFIXES[mod]])
+                    Path(f"{stem}.nii.gz").write_bytes(images[mod])
+                    files += 1
+                    size += len(images[mod])
+                    if mod != "func":
+                        write_json(f"{stem}.json", SIDECARS[mod])
+                        files += 1
+                    if mod == "dwi":
+                        directions = SHAPES["dwi"][3]
+                        Path(f"{stem}.bvec").write_text("\n".join(
+                            " ".join(f"{rng.uniform(-1, 1):.4f}" for _ in range(directions)) for _ in range(3)) + "\n")
+                        Path(f"{stem}.bval").write_text(" ".join(["0"] + ["1000"] * (directions - 1)) + "\n")
+                        files += 2
+        with open(site_dir / "participants.tsv", "w") as f:
+            f.write("\t".join(["participant_id", "site_id"] + [c for c, _, _ in columns]) + "\n")
+            f.writelines("\t".join(row) + "\n" for row in rows)
+
+    with open(root / "site_list.txt", "w") as f:
+        f.write("\n".join(site_names) + "\n")
+    mapping = {}
+    for column, value_type in [("participant_id", None), ("site_id", None)] + [c[:2] for c in columns]:
+        mapping[column] = {
+            "label": column.replace("_", " ").title(),
+            "description": f"Synthetic {column} variable",
+            "valueType": value_type or f"{XSD}string",
+            "associatedWith": "NIDM",
+            "hasUnit": "",
+            "minValue": "",
+            "maxValue": "",
+            "source_variable": column,
+        }
+        if column in ("fiq", "viq", "piq") or column.startswith("score_"):
+            mapping[column]["missingValues"] = ["-9999", "n/a"]
+    write_json(root / "synthetic_mapping.json", mapping)
+    return {"sites": sites, "subjects": subjects, "files": files, "bytes": size}
+
+
+def register(root):
+    """Add the synthetic dataset to config.DATASETS"""
+    DATASETS[DATASET] = {
+        "site_list": root / "site_list.txt",
+        "json_map": root / "synthetic_mapping.json",
+        "phenotype_csv": root / "synthetic_phenotype.csv",
+        "subject_column": "participant_id",
+        "phenotype_from_participants": True,
+        "site_prefix": "",
+        "excluded_sites": {},
+    }
+
+
+class SyntheticConverter:
+    """Stand-in for worker.ConverterPool that writes converter-shaped graphs in-process"""
+
+    def run(self, tool, args, log_file, timeout, stall_timeout=None, label=None):
+        start = time.time()
+        args = [str(a) for a in args]
+        options = {flag: value for flag, value in zip(args, args[1:]) if flag.startswith("-")}
+        if tool == "bidsmri2nidm":
+            self.bidsmri2nidm(Path(options["-d"]), Path(options["-o"]))
+        else:
+            self.csv2nidm(Path(options["-nidm"]))
+        return {"ok": True, "error": None, "seconds": time.time() - start}
+
+    def close(self):
+        pass
+
+    @staticmethod
+    def _node():
+        return f"<{vocab.NIIRI}{uuid.uuid1()}>"
+
+    def bidsmri2nidm(self, site_dir, output):
+        project = self._node()
+        description = json.loads((site_dir / "dataset_description.json").read_text())
+        tmp = output.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            writer = TurtleWriter(f, vocab.PREFIXES)
+            writer.write_prefixes()
+            writer.write_subject(project, [(vocab.TYPE, vocab.PROJECT), (vocab.TYPE, vocab.PROV_ACTIVITY),
+                                           (vocab.TITLE, literal(description.get("Name", site_dir.name),
+                                                                 f"{XSD}string"))])
+            top_level = {p.name: json.loads(p.read_text()) for p in site_dir.glob("*.json")}
+            for subject_dir in sorted(site_dir.glob("sub-*")):
+                agent = self._node()
+                writer.write_subject(agent, [(vocab.TYPE, vocab.PROV_AGENT), (vocab.TYPE, vocab.PROV_PERSON),
+                                             (vocab.SRC_SUBJECT_ID, literal(subject_dir.name[4:], f"{XSD}string"))])
+                session_dirs = sorted(subject_dir.glob("ses-*")) or [subject_dir]
+                for session_dir in session_dirs:
+                    session = self._node()
+                    writer.write_subject(session, [(vocab.TYPE, vocab.SESSION), (vocab.TYPE, vocab.PROV_ACTIVITY),
+                                                   (vocab.IS_PART_OF, project)])
+                    for image in sorted(session_dir.glob("*/*.nii.gz")):
+                        activity, entity = self._node(), self._node()
+                        writer.write_subject(activity, [
+                            (vocab.TYPE, vocab.ACQUISITION), (vocab.TYPE, vocab.PROV_ACTIVITY),
+                            (vocab.IS_PART_OF, session),
+                            (vocab.QUALIFIED_ASSOCIATION, [(vocab.TYPE, vocab.PROV_ASSOCIATION),
+                                                           (vocab.PROV_AGENT_PROP, agent),
+                                                           (vocab.HAD_ROLE, vocab.SUBJECT_ROLE)])])
+                        sidecar = Path(str(image)[:-len(".nii.gz")] + ".json")
+                        fields = (json.loads(sidecar.read_text()) if sidecar.exists()
+                                  else top_level.get("task-rest_bold.json", {}))
+                        props = [(vocab.TYPE, vocab.ACQUISITION_OBJECT), (vocab.TYPE, vocab.PROV_ENTITY)]
+                        for key, value in sorted(fields.items()):
+                            datatype = {int: "int", float: "double"}.get(type(value), "string")
+                            props.append((f"<{vocab.BIDS}{key}>", literal(value, f"{XSD}{datatype}")))
+                        rel = "/" + str(image.relative_to(site_dir))
+                        props += [(vocab.SHA512, literal(hashlib.sha512(image.read_bytes()).hexdigest(),
+                                                         f"{XSD}string")),
+                                  (vocab.FILENAME, literal(rel, f"{XSD}string")),
+                                  (vocab.LOCATION, literal(f"file:/{image}", f"{XSD}string")),
+                                  (vocab.WAS_GENERATED_BY, activity)]
+                        writer.write_subject(entity, props)
+        os.replace(tmp, output)
+
+    def csv2nidm(self, nidm_file):
+        project, agents = site_subjects(nidm_file)
+        with open(nidm_file, "a", encoding="utf-8") as f:
+            f.write("\n")
+            write_additions(f, get_index(DATASET), project, agents)
+
+
+def run_scale(root, args):
+    """Run every stage on the generated dataset in ``root``; return per-stage metrics"""
+    register(root)
+    pairs = [(DATASET, site) for site in read_sites(DATASET)]
+    stages = {}
+
+    def stage(name, func):
+        with telemetry.measure(process=True) as metrics:
+            result = func()
+        stages[name] = metrics
+        return result
+
+    stage("cophenotype", lambda: build_dataset(DATASET, args.cpu_workers))
+    stage("registry", lambda: write_registry(mappings=MAPPINGS + [root / "synthetic_mapping.json"]))
+    indexes = stage("preflight", lambda: check_sites(pairs, args.cpu_workers, use_cache=False))
+    blocked = [f"{site}: {'; '.join(errors(index))}" for (_, site), index in indexes.items() if errors(index)]
+    if blocked:
+        raise RuntimeError(f"preflight failed: {', '.join(blocked)}")
+
+    scheduler = Scheduler(cpu_workers=args.cpu_workers)
+    pool = {"synthetic": SyntheticConverter(), "worker": ConverterPool(scheduler.workers["cpu"]),
+            "subprocess": None}[args.converter]
+    for _, site in pairs:
+        for step in site_steps(DATASET, site, force=True, phenotype_mode=args.phenotype_mode, pool=pool,
+                               shard_size=args.shard_size):
+            scheduler.add(step)
+    try:
+        steps = stage("convert", scheduler.run)
+    finally:
+        if pool is not None:
+            pool.close()
+    failed = [f"{s.name}: {s.error or s.status}" for s in steps.values() if s.status in (FAILED, SKIPPED)]
+    if failed:
+        raise RuntimeError(f"conversion failed: {'; '.join(failed)}")
+
+    triples, _ = stage("merge", lambda: merge(dataset_files(DATASET), OUTPUT_ROOT / f"{DATASET}_all.ttl"))
+    rows = stage("export", lambda: export(pairs, fmt="parquet" if pa is not None else "csv"))
+    return {"stages": stages, "triples": triples, "export_rows": rows}
+
+
+def scale_report(results):
+    """Lines of the per-scale stage tables and the scaling exponents"""
+    lines = []
+    for result in results:
+        n = result["subjects"]
+        lines.append(f"{n} subjects, {result['sites']} sites, {result['files']} files "
+                     f"(generated in {result['generate_seconds']:.1f}s), {result['triples']} triples")
+        lines.append(f"  {'stage':12s} {'wall s':>9s} {'cpu s':>9s} {'rss MB':>8s} {'subj/s':>10s}")
+        total = 0.0
+        for name in STAGES:
+            m = result["stages"][name]
+            total += m["wall"]
+            rate = n / m["wall"] if m["wall"] else float("inf")
+            lines.append(f"  {name:12s} {m['wall']:9.2f} {m['cpu']:9.2f} {m['peak_rss_mb']:8.0f} {rate:10.1f}")
+        lines.append(f"  {'total':12s} {total:9.2f}")
+        lines.append("")
+
+    flagged = []
+    for prev, cur in zip(results, results[1:]):
+        ratio = math.log(cur["subjects"] / prev["subjects"])
+        exponents = []
+        for name in STAGES:
+            t0, t1 = prev["stages"][name]["wall"], cur["stages"][name]["wall"]
+            exponent = math.log(max(t1, 1e-3) / max(t0, 1e-3)) / ratio
+            exponents.append(f"{name} {exponent:.2f}")
+            if exponent > SUPERLINEAR and t1 >= MIN_FLAG_SECONDS:
+                flagged.append(f"{name} ({prev['subjects']} -> {cur['subjects']} subjects: exponent {exponent:.2f})")
+        lines.append(f"Scaling {prev['subjects']} -> {cur['subjects']}: " + ", ".join(exponents))
+    lines.append(f"Superlinear stages (exponent > {SUPERLINEAR}): " + ("; ".join(flagged) if flagged else "none"))
+    return lines, flagged
+
+
+def child(args):
+    """Generate one scale and run it; print the result as JSON"""
+    root = Path(args.root)
+    start = time.time()
+    info = generate(root, args.child, args.sites, args.sessions, args.modalities, args.columns, args.seed)
+    info["generate_seconds"] = time.time() - start
+    info.update(run_scale(root, args))
+    print(json.dumps(info))
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline on synthetic BIDS datasets")
+    parser.add_argument("--subjects", type=int, nargs="+", default=list(SCALES), help="Subject counts to run")
+    parser.add_argument("--sites", type=int, default=1, help="Sites the subjects are spread over")
+    parser.add_argument("--sessions", type=int, default=1, help="Sessions per subject")
+    parser.add_argument("--modalities", nargs="+", choices=MODALITIES, default=list(MODALITIES))
+    parser.add_argument("--columns", type=int, default=40, help="Extra numeric phenotype columns")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--converter", choices=CONVERTERS, default="synthetic",
+                        help="synthetic: in-process stand-in; worker/subprocess: the real converters")
+    parser.add_argument("--phenotype-mode", choices=PHENOTYPE_MODES, default="batch")
+    parser.add_argument("--shard-size", type=int, default=DEFAULT_SHARD_SIZE,
+                        help="Subjects per conversion shard (0: convert each site whole)")
+    parser.add_argument("--cpu-workers", type=int, help="Concurrent steps (default: CPU count)")
+    parser.add_argument("--root", type=Path, help="Directory for the generated data (default: a temp dir)")
+    parser.add_argument("--keep", action="store_true", help="Keep the generated data and outputs")
+    parser.add_argument("-o", "--output", type=Path, help="Write the results as JSON")
+    parser.add_argument("--child", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING if args.child else logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    if args.child:
+        return child(args)
+
+    base = args.root or Path(tempfile.mkdtemp(prefix="simple2-bench-"))
+    forwarded = list(argv if argv is not None else sys.argv[1:])
+    results = []
+    try:
+        for n in sorted(args.subjects):
+            root = base / f"n{n}"
+            if root.exists():
+                shutil.rmtree(root)
+            root.mkdir(parents=True)
+            logger.info(f"Running {n} subjects in {root}")
+            # A fresh process per scale: config reads the overrides at import, and peak RSS is per scale
+            env = dict(os.environ, **scale_env(root))
+            if args.converter == "synthetic":
+                env.setdefault("SIMPLE2_TOOL_VERSION", "synthetic")
+            env["PYTHONPATH"] = str(REPO_DIR) + (os.pathsep + env["PYTHONPATH"] if env.get("PYTHONPATH") else "")
+            proc = subprocess.run([sys.executable, "-m", "pipeline.benchmark", *forwarded, "--child", str(n),
+                                   "--root", str(root)], env=env, stdout=subprocess.PIPE, text=True)
+            if proc.returncode != 0:
+                logger.error(f"{n} subjects: benchmark failed (exit code {proc.returncode})")
+                return 1
+            results.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+            if not args.keep:
+                shutil.rmtree(root)
+    finally:
+        if not args.keep and args.root is None:
+            shutil.rmtree(base, ignore_errors=True)
+
+    lines, flagged = scale_report(results)
+    print("\n".join(lines))
+    if args.output:
+        write_json(args.output, {"args": {k: v for k, v in vars(args).items() if k not in ("child", "root", "output")},
+                                 "results": results})
+        logger.info(f"Results written to {args.output}")
+    return 1 if flagged else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,213 @@
+"""
+Deterministic, content-derived IRIs for NIDM site graphs.
+
+bidsmri2nidm and csv2nidm name every Project, Session, Acquisition and
+AcquisitionObject with a time-based UUID, and every PersonalDataElement with
+a random suffix, so two conversions of the same inputs share no IRIs. This
+module renames those nodes from what they describe:
+
+    Project                           <dataset>/<site>/project
+    agent with an ndar:src_subject_id <dataset>/<site>/subject/<subject ID>
+    entity with a unique nfo:filename <dataset>/<site>/file/<filename> (else its crypto:sha512)
+    activity                          its types, subject and the kinds of entities it generated
+    entity generated by an activity   that activity and the entity's kind
+    Session                           the activities that are part of it
+    PersonalDataElement               <variable>_<hash of its definition>
+    anything else                     its types and values
+
+The names are UUIDv5s in the niiri: namespace, so code that recognizes
+converter-generated nodes (merge.UUID_NODE) treats them the same way.
+Nodes that are only referenced, e.g. the BIDS graph's subjects in a phenotype
+delta, keep their IRIs. canonicalize() rewrites a file with its subjects
+sorted by their new IRI, so converting unchanged inputs twice gives
+byte-identical files. It is idempotent.
+
+run_all --deterministic-iris applies it to every graph a site step writes.
+diff.py uses the same names to compare runs.
+"""
+import hashlib
+import os
+import threading
+import uuid
+from collections import Counter, defaultdict
+from pathlib import Path
+
+from . import vocab
+from .merge import UUID_NODE, merge_prefixes
+from .phenotype import normalize_subject_id
+from .turtle import TurtleWriter, is_literal, iter_triples, split_literal
+
+NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, vocab.NIIRI)
+
+
+def _digest(text, size=16):
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=size).hexdigest()
+
+
+def load_graph(files, bnode_prefix="c"):
+    """{node: [(predicate, object)]} of Turtle files, blank nodes nested as lists of (predicate, object)"""
+    nodes = defaultdict(list)
+    references = Counter()
+    for i, path in enumerate(files):
+        for s, p, o in iter_triples(path, bnode_prefix=f"{bnode_prefix}{i}b"):
+            nodes[s].append((p, o))
+            if o.startswith("_:"):
+                references[o] += 1
+
+    # A blank node referenced once is written inline, as rdflib does, even when it was its own block
+    def nest(props, seen):
+        return [(p, nest(nodes[o], seen | {o}) if references[o] == 1 and o in nodes and o not in seen else o)
+                for p, o in props]
+
+    return {node: nest(props, {node}) for node, props in nodes.items()
+            if not (node.startswith("_:") and references[node] == 1)}
+
+
+def _minted(node):
+    return node.startswith("_:") or UUID_NODE.fullmatch(node) is not None
+
+
+def _neighbourhoods(nodes, term, rounds=3):
+    """{node: digest of its content and of the nodes within ``rounds`` edges}, to order otherwise equal nodes"""
+    edges = defaultdict(list)
+
+    def link(node, props):
+        for p, o in props:
+            if isinstance(o, list):
+                link(node, o)
+            elif o in nodes:
+                edges[node].append((f"{term(p)}>", o))
+                edges[o].append((f"{term(p)}<", node))
+
+    for node, props in nodes.items():
+        link(node, props)
+    colors = {node: _digest(" ".join(sorted(f"{term(p)} {term(o)}" for p, o in props))) for node, props in nodes.items()}
+    for _ in range(rounds):
+        colors = {node: _digest(" ".join([colors[node]] + sorted(f"{p}{colors[o]}" for p, o in edges[node])))
+                  for node in nodes}
+    return colors
+
+
+def canonical_names(nodes, base):
+    """{node: canonical IRI} for the converter-named nodes defined in ``nodes``"""
+    names = {}
+    used = set()
+
+    def assign(node, key, iri=None):
+        # Nodes with identical content are interchangeable, so numbering them apart is deterministic
+        n, unique = 1, key
+        while unique in used:
+            n += 1
+            unique = f"{key}#{n}"
+        used.add(unique)
+        names[node] = iri(unique) if iri else f"<{vocab.NIIRI}{uuid.uuid5(NAMESPACE, f'{base}/{unique}')}>"
+
+    def term(t):
+        if isinstance(t, list):
+            return "[" + ";".join(sorted(f"{term(p)} {term(o)}" for p, o in t)) + "]"
+        if t in names:
+            return names[t]
+        return "?" if _minted(t) else t
+
+    def content(node, skip=()):
+        return _digest(" ".join(sorted(f"{term(p)} {term(o)}" for p, o in nodes[node] if p not in skip)))
+
+    types = {node: {o for p, o in props if p == vocab.TYPE} for node, props in nodes.items()}
+    values = {node: {p: o for p, o in props if isinstance(o, str) and is_literal(o)}
+              for node, props in nodes.items()}
+    # Assessment entities all name participants.tsv, so only a file name no other node has identifies a node
+    files = Counter(v[key] for v in values.values() for key in (vocab.FILENAME, vocab.SHA512) if key in v)
+    for node in sorted(nodes, key=content):
+        v = values[node]
+        if vocab.PERSONAL_DATA_ELEMENT in types[node]:
+            variable = split_literal(v.get(vocab.SOURCE_VARIABLE) or v.get(vocab.LABEL) or '"element"')[0]
+            name = "".join(c if c.isalnum() or c in "_-" else "_" for c in variable)
+            assign(node, f"element/{name}/{content(node)}",
+                   lambda key, name=name: f"<{vocab.NIIRI}{name}_{_digest(key, 4)}>")
+
+    colors = {}
+
+    def ordered(items, key):
+        """``items`` sorted by ``key``, equal keys by the nodes' neighbourhoods"""
+        keys = {n: key(n) for n in items}
+        counts = Counter(keys.values())
+        if not colors and any(c > 1 for c in counts.values()):
+            colors.update(_neighbourhoods(nodes, term))
+        return sorted(items, key=lambda n: (keys[n], colors.get(n, "") if counts[keys[n]] > 1 else ""))
+
+    pending = []
+    for node in ordered([n for n in nodes if n not in names and _minted(n)], content):
+        t, v = types[node], values[node]
+        if vocab.PROJECT in t:
+            assign(node, "project")
+        elif vocab.SRC_SUBJECT_ID in v:
+            assign(node, f"subject/{normalize_subject_id(split_literal(v[vocab.SRC_SUBJECT_ID])[0])}")
+        elif vocab.FILENAME in v and files[v[vocab.FILENAME]] == 1:
+            assign(node, f"file/{split_literal(v[vocab.FILENAME])[0]}")
+        elif vocab.SHA512 in v and files[v[vocab.SHA512]] == 1:
+            assign(node, f"sha512/{split_literal(v[vocab.SHA512])[0]}")
+        else:
+            pending.append(node)
+
+    generated = defaultdict(list)
+    parts = defaultdict(list)
+    for node in nodes:
+        for p, o in nodes[node]:
+            if p == vocab.WAS_GENERATED_BY:
+                generated[o].append(node)
+            elif p == vocab.IS_PART_OF:
+                parts[o].append(node)
+
+    def shape(e):
+        # Values are left out, so an edited value does not rename the nodes around it
+        return names.get(e) or _digest(" ".join(sorted({f"{term(p)} {term(o) if p == vocab.TYPE else ''}"
+                                                         for p, o in nodes[e] if p != vocab.WAS_GENERATED_BY})))
+
+    def assign_all(kind, keys, ties):
+        # Nodes with the same key are numbered in the order of ``ties``, which includes their values
+        for node in ordered(list(keys), lambda n: (keys[n], ties[n])):
+            assign(node, f"{kind}/{keys[node]}")
+
+    activities = [n for n in pending if vocab.PROV_ACTIVITY in types[n] and vocab.SESSION not in types[n]]
+    assign_all("activity",
+               {a: _digest(" ".join([content(a, skip=(vocab.IS_PART_OF,))] + sorted(shape(e) for e in generated[a])))
+                for a in activities},
+               {a: " ".join(sorted(content(e) for e in generated[a])) for a in activities})
+    entities = [n for n in pending if n not in names and
+                any(p == vocab.WAS_GENERATED_BY and o in names for p, o in nodes[n])]
+    assign_all("entity",
+               {e: _digest(" ".join([names[o] for p, o in nodes[e] if p == vocab.WAS_GENERATED_BY and o in names] +
+                                    [shape(e)])) for e in entities},
+               {e: content(e) for e in entities})
+    sessions = [n for n in pending if vocab.SESSION in types[n]]
+    assign_all("session", {s: _digest(" ".join(sorted(names.get(a, "?") for a in parts[s]))) for s in sessions},
+               {s: "" for s in sessions})
+    rest = [n for n in pending if n not in names]
+    for n in ordered(rest, content):
+        if n.startswith("_:"):
+            assign(n, f"node/{content(n)}", lambda key: f"_:n{_digest(key, 8)}")
+        else:
+            assign(n, f"node/{content(n)}")
+    return names
+
+
+def rename(props, names):
+    """``props`` with renamed terms, sorted so the serialization is canonical"""
+    renamed = [(names.get(p, p), rename(o, names) if isinstance(o, list) else names.get(o, o)) for p, o in props]
+    return sorted(renamed, key=lambda po: (po[0] != vocab.TYPE, po[0], str(po[1])))
+
+
+def canonicalize(path, dataset, site, output=None):
+    """Rewrite a site graph with content-derived IRIs; return the number of nodes renamed"""
+    path = Path(path)
+    output = Path(output or path)
+    nodes = load_graph([path])
+    names = canonical_names(nodes, f"{dataset}/{site}")
+    tmp = output.with_suffix(f".{os.getpid()}.{threading.get_ident()}.canonical.tmp")
+    with open(tmp, "w", encoding="utf-8") as out:
+        writer = TurtleWriter(out, merge_prefixes([path]))
+        writer.write_prefixes()
+        for new, node in sorted((names.get(node, node), node) for node in nodes):
+            writer.write_subject(new, rename(nodes[node], names))
+    os.replace(tmp, output)
+    return sum(1 for node, name in names.items() if node != name)
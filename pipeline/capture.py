@@ -0,0 +1,234 @@
+"""
+Streaming capture of converter output: rotating logs, live progress and stall detection.
+
+A converter used to get the site log as its stdout, so nothing read its
+output until the run was over. A converter stuck on a hung mount looked like a
+busy one until the timeout, which is up to an hour, and a failure was reported
+as an exit code only. Converter output now goes through a Monitor:
+
+- lines are appended to the site log as they arrive, and a log that grows
+  past LOG_MAX_BYTES is rotated to .1, .2, ... (LOG_BACKUPS are kept)
+- the last TAIL_LINES lines stay in memory for the error message
+- progress is parsed from the "Hashing <image>" line the launch hook prints
+  for every image: the images hashed so far and the sub-* directories they
+  are in. It is logged every PROGRESS_INTERVAL seconds
+- every HEARTBEAT_INTERVAL seconds the CPU time of the converter's process
+  tree is sampled from /proc. A converter whose output and CPU time have not
+  advanced for ``stall_timeout`` seconds is stalled, and the caller kills it
+
+Pooled jobs (worker.py) write the log themselves, so for them the Monitor
+follows the log file instead of a pipe.
+"""
+import logging
+import os
+import re
+import signal
+import time
+from collections import defaultdict, deque
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+LOG_MAX_BYTES = 20 * 10**6
+LOG_BACKUPS = 3
+TAIL_LINES = 50
+TAIL_WIDTH = 500  # characters kept of each tail line
+PROGRESS_INTERVAL = 60  # seconds between progress log lines
+HEARTBEAT_INTERVAL = 10  # seconds between CPU time samples
+STALL_TIMEOUT = 900  # seconds without output or CPU time before a converter counts as stalled
+STALL_MIN_CPU = 1.0  # CPU seconds per stall window that still count as working
+PROGRESS_LINE = "Hashing "  # printed by launch.install_hooks before each image is hashed
+_SUBJECT = re.compile(r"/(sub-[^/]+)/")
+
+
+def rotate_log(path, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS):
+    """Shift ``path`` to ``path``.1 (and older copies up) if it is over ``max_bytes``; return whether it was"""
+    path = Path(path)
+    try:
+        if path.stat().st_size <= max_bytes:
+            return False
+    except FileNotFoundError:
+        return False
+    for n in range(backups - 1, 0, -1):
+        older = path.with_name(f"{path.name}.{n}")
+        if older.exists():
+            os.replace(older, path.with_name(f"{path.name}.{n + 1}"))
+    if backups:
+        os.replace(path, path.with_name(f"{path.name}.1"))
+    else:
+        path.unlink()
+    return True
+
+
+class RotatingLog:
+    """Append-only text log that rotates itself once it grows past ``max_bytes``"""
+
+    def __init__(self, path, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.backups = backups
+        rotate_log(self.path, max_bytes, backups)
+        self._f = open(self.path, "a", encoding="utf-8", errors="replace")
+
+    def write(self, text):
+        self._f.write(text)
+        self._f.flush()
+        if self._f.tell() > self.max_bytes:
+            self._f.close()
+            rotate_log(self.path, self.max_bytes, self.backups)
+            self._f = open(self.path, "a", encoding="utf-8", errors="replace")
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class LogFollower:
+    """Text appended to a file since the follower was created"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        try:
+            self._offset = self.path.stat().st_size
+        except FileNotFoundError:
+            self._offset = 0
+
+    def read(self):
+        try:
+            with open(self.path, "rb") as f:
+                if os.fstat(f.fileno()).st_size < self._offset:
+                    self._offset = 0  # rotated or truncated under us
+                f.seek(self._offset)
+                data = f.read()
+        except FileNotFoundError:
+            return ""
+        self._offset += len(data)
+        return data.decode("utf-8", errors="replace")
+
+
+def _process_table():
+    """{pid: (parent pid, CPU clock ticks incl. reaped children)} from /proc; None without it"""
+    try:
+        entries = os.listdir("/proc")
+    except OSError:
+        return None
+    stats = {}
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", "r") as f:
+                text = f.read()
+        except OSError:
+            continue
+        # Fields after "pid (comm)": state, ppid, ..., utime, stime, cutime, cstime at 11-14
+        fields = text[text.rindex(")") + 2:].split()
+        stats[int(entry)] = (int(fields[1]), sum(int(x) for x in fields[11:15]))
+    return stats
+
+
+def _tree(pid, stats):
+    """``pid`` and its descendants, parents first"""
+    children = defaultdict(list)
+    for child, (parent, _) in stats.items():
+        children[parent].append(child)
+    tree, stack = [], [pid]
+    while stack:
+        p = stack.pop()
+        tree.append(p)
+        stack.extend(children[p])
+    return tree
+
+
+def tree_cpu_seconds(pid):
+    """CPU seconds of ``pid`` and its descendants, reaped children included; None without /proc or ``pid``"""
+    stats = _process_table()
+    if not stats or pid not in stats:
+        return None
+    return sum(stats[p][1] for p in _tree(pid, stats)) / os.sysconf("SC_CLK_TCK")
+
+
+def kill_tree(proc):
+    """Kill a subprocess.Popen and the processes it started (the wrapper's micromamba and Python), and reap it"""
+    stats = _process_table()
+    pids = _tree(proc.pid, stats) if stats and proc.pid in stats else [proc.pid]
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    proc.wait()
+
+
+class Monitor:
+    """Progress, output tail and stall clock of one converter run"""
+
+    def __init__(self, label, pid, stall_timeout=STALL_TIMEOUT):
+        self.label = label
+        self.pid = pid
+        self.stall_timeout = stall_timeout
+        self.tail = deque(maxlen=TAIL_LINES)
+        self.lines = 0
+        self.scans = 0
+        self.subjects = set()
+        self.stuck = False  # set once stalled() found the run stalled
+        self.start = time.time()
+        self._partial = ""
+        self._output_at = self.start
+        self._samples = deque()  # (time, CPU seconds) over the last stall window
+        self._next_beat = self.start
+        self._next_report = self.start + PROGRESS_INTERVAL
+
+    def feed(self, text):
+        """Account for a chunk of output"""
+        if not text:
+            return
+        self._output_at = time.time()
+        lines = (self._partial + text).split("\n")
+        # A line that never ends (e.g. a progress bar redrawn with \r) is cut to its end
+        self._partial = lines.pop()[-4 * TAIL_WIDTH:]
+        for line in lines:
+            self.lines += 1
+            self.tail.append(line[:TAIL_WIDTH])
+            if line.startswith(PROGRESS_LINE):
+                self.scans += 1
+                subject = _SUBJECT.search(line)
+                if subject:
+                    self.subjects.add(subject.group(1))
+
+    def progress(self):
+        return (f"{self.scans} images of {len(self.subjects)} subjects, {self.lines} lines of output "
+                f"in {time.time() - self.start:.0f} seconds")
+
+    def last_line(self):
+        """Last non-empty line of output, for error messages"""
+        for line in reversed(list(self.tail) + [self._partial[:TAIL_WIDTH]]):
+            if line.strip():
+                return line.strip()
+        return ""
+
+    def stalled(self):
+        """Whether neither output nor CPU time advanced for ``stall_timeout`` seconds; call it often"""
+        now = time.time()
+        if now >= self._next_report:
+            self._next_report = now + PROGRESS_INTERVAL
+            logger.info(f"{self.label}: {self.progress()}")
+        if not self.stall_timeout or now < self._next_beat:
+            return False
+        self._next_beat = now + HEARTBEAT_INTERVAL
+        cpu = tree_cpu_seconds(self.pid)
+        if cpu is None:
+            return False
+        self._samples.append((now, cpu))
+        # Keep the newest sample that is at least a stall window old as the baseline
+        while len(self._samples) > 1 and self._samples[1][0] <= now - self.stall_timeout:
+            self._samples.popleft()
+        since, baseline = self._samples[0]
+        self.stuck = (now - self._output_at >= self.stall_timeout and now - since >= self.stall_timeout
+                      and cpu - baseline < STALL_MIN_CPU)
+        return self.stuck
@@ -0,0 +1,364 @@
+#!/usr/bin/env python
+"""
+Compact, randomly accessible storage format for NIDM site graphs (.nidmz).
+
+Turtle repeats the prefix block in every file and stores each AcquisitionObject's
+128-hex crypto:sha512 digest and its long bids:SliceTiming list as text. A
+.nidmz file holds a site's graph (the BIDS graph plus its phenotype additions,
+see phenotype.site_graph_files) as:
+
+    MAGIC | block ... | index | footer
+
+- a block is a run of whole subject statements, compressed with zstd (the
+  ``zstandard`` package) or zlib when it is not installed. Inside a block the
+  terms are dictionary-encoded, each triple is three uint32 term ids, and hex
+  digest literals are stored as raw bytes
+- the index, compressed the same way, holds the prefixes and each block's
+  offset and length, and maps every IRI subject to its (block, first triple,
+  end) ranges
+
+Reading one subject means decompressing only the blocks that hold it. The
+Turtle files stay the working format of the pipeline; ``unpack`` exports a
+.nidmz back to Turtle.
+
+Usage:
+    python -m pipeline.compact pack [DATASET ...] [--sites SITE ...]
+    python -m pipeline.compact info nidm_outputs/abide2/bni_1.nidmz
+    python -m pipeline.compact get nidm_outputs/abide2/bni_1.nidmz niiri:<uuid>
+    python -m pipeline.compact unpack nidm_outputs/abide2/bni_1.nidmz -o bni_1.ttl
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import struct
+import sys
+import time
+import zlib
+from array import array
+from functools import lru_cache
+from pathlib import Path
+
+from .config import DATASETS, data_elements_path, read_sites, site_paths
+from .merge import merge_prefixes
+from .phenotype import site_graph_files
+from .store import QueryError, parse_term
+from .turtle import TurtleWriter, iter_statements
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"NIDMZ\x01"
+FOOTER = struct.Struct("<QQ8s")  # index offset, index length, codec
+BLOCK_SIZE = 256 * 1024  # uncompressed bytes per block; one block is the unit of random access
+ZSTD_LEVEL = 10
+ZLIB_LEVEL = 9
+_HEX_LITERAL = re.compile(r'"((?:[0-9a-f]{2}){16,})"(.*)', re.DOTALL)
+_TERM = struct.Struct("<BI")  # kind, length
+_TEXT, _HEX = 0, 1
+
+
+class CompactError(Exception):
+    """Raised for a file that is not a readable .nidmz"""
+
+
+def default_codec():
+    return "zstd" if zstandard is not None else "zlib"
+
+
+def compress(data, codec):
+    if codec == "zstd":
+        if zstandard is None:
+            raise CompactError("zstd compression requires the zstandard package")
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return zlib.compress(data, ZLIB_LEVEL)
+
+
+def decompress(data, codec):
+    if codec == "zstd":
+        if zstandard is None:
+            raise CompactError("This file is zstd-compressed; install the zstandard package to read it")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+def encode_term(term):
+    """Bytes of one term; long lowercase hex literals (sha512 digests) are stored as raw bytes"""
+    m = _HEX_LITERAL.fullmatch(term)
+    if m:
+        suffix = m.group(2).encode("utf-8")
+        data = struct.pack("<H", len(suffix)) + suffix + bytes.fromhex(m.group(1))
+        return _TERM.pack(_HEX, len(data)) + data
+    data = term.encode("utf-8")
+    return _TERM.pack(_TEXT, len(data)) + data
+
+
+def decode_terms(data, count, offset=0):
+    """(terms, end offset) of ``count`` encoded terms"""
+    terms = []
+    for _ in range(count):
+        kind, length = _TERM.unpack_from(data, offset)
+        offset += _TERM.size
+        chunk = data[offset:offset + length]
+        offset += length
+        if kind == _HEX:
+            n = struct.unpack_from("<H", chunk)[0]
+            suffix = chunk[2:2 + n].decode("utf-8")
+            terms.append(f'"{chunk[2 + n:].hex()}"{suffix}')
+        else:
+            terms.append(chunk.decode("utf-8"))
+    return terms, offset
+
+
+class _Block:
+    """Dictionary-encoded triples of one block being written"""
+
+    def __init__(self):
+        self.ids = {}
+        self.terms = []
+        self.triples = array("I")
+        self.size = 0
+
+    def __len__(self):
+        return len(self.triples) // 3
+
+    def add(self, triple):
+        for term in triple:
+            term_id = self.ids.get(term)
+            if term_id is None:
+                term_id = self.ids[term] = len(self.terms)
+                self.terms.append(encode_term(term))
+                self.size += len(self.terms[-1])
+            self.triples.append(term_id)
+        self.size += 12
+
+    def encode(self):
+        triples = array("I", self.triples)
+        if sys.byteorder == "big":
+            triples.byteswap()
+        return struct.pack("<II", len(self.terms), len(self)) + b"".join(self.terms) + triples.tobytes()
+
+
+def pack(files, output, codec=None, block_size=BLOCK_SIZE):
+    """Write the union of Turtle ``files`` to ``output`` as .nidmz; return stats"""
+    codec = codec or default_codec()
+    output = Path(output)
+    tmp = output.with_suffix(f".{os.getpid()}.tmp")
+    blocks, subjects = [], {}
+    raw = triples = 0
+    block = _Block()
+
+    def flush(f):
+        nonlocal raw
+        if not len(block):
+            return
+        data = block.encode()
+        raw += len(data)
+        compressed = compress(data, codec)
+        blocks.append([f.tell(), len(compressed)])
+        f.write(compressed)
+
+    with open(tmp, "wb") as f:
+        f.write(MAGIC)
+        for i, path in enumerate(files):
+            for subject, statement in iter_statements(path, bnode_prefix=f"f{i}b"):
+                if subject is None:
+                    continue
+                if block.size >= block_size:
+                    flush(f)
+                    block = _Block()
+                start = len(block)
+                for triple in statement:
+                    block.add(triple)
+                triples += len(statement)
+                if not subject.startswith("_:"):
+                    subjects.setdefault(subject, []).append([len(blocks), start, len(block)])
+        flush(f)
+        index = {"version": 1, "codec": codec, "prefixes": merge_prefixes(files),
+                 "sources": [Path(p).name for p in files], "triples": triples,
+                 "blocks": blocks, "subjects": subjects}
+        data = compress(json.dumps(index, separators=(",", ":")).encode("utf-8"), codec)
+        offset = f.tell()
+        f.write(data)
+        f.write(FOOTER.pack(offset, len(data), codec.encode("ascii")) + MAGIC)
+    os.replace(tmp, output)
+    return {"triples": triples, "blocks": len(blocks), "subjects": len(subjects), "raw": raw,
+            "input_bytes": sum(Path(p).stat().st_size for p in files), "bytes": output.stat().st_size}
+
+
+class CompactGraph:
+    """Read access to a .nidmz file; blocks are decompressed on demand"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._f = open(self.path, "rb")
+        self._f.seek(-(FOOTER.size + len(MAGIC)), os.SEEK_END)
+        tail = self._f.read()
+        if tail[FOOTER.size:] != MAGIC:
+            raise CompactError(f"{self.path} is not a .nidmz file")
+        offset, length, codec = FOOTER.unpack(tail[:FOOTER.size])
+        self.codec = codec.rstrip(b"\0").decode("ascii")
+        self._f.seek(offset)
+        self.index = json.loads(decompress(self._f.read(length), self.codec))
+        self.prefixes = self.index["prefixes"]
+        self._block = lru_cache(maxsize=8)(self._read_block)
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.index["triples"]
+
+    def subjects(self):
+        return list(self.index["subjects"])
+
+    def _read_block(self, n):
+        offset, length = self.index["blocks"][n]
+        self._f.seek(offset)
+        data = decompress(self._f.read(length), self.codec)
+        n_terms, n_triples = struct.unpack_from("<II", data)
+        terms, end = decode_terms(data, n_terms, 8)
+        ids = array("I")
+        ids.frombytes(data[end:end + 12 * n_triples])
+        if sys.byteorder == "big":
+            ids.byteswap()
+        return terms, ids
+
+    def block_triples(self, n, start=0, end=None):
+        terms, ids = self._block(n)
+        end = len(ids) // 3 if end is None else end
+        return [(terms[ids[3 * i]], terms[ids[3 * i + 1]], terms[ids[3 * i + 2]]) for i in range(start, end)]
+
+    def statements(self, subject):
+        """Triples of ``subject``'s statements, blank nodes they own included"""
+        triples = []
+        for n, start, end in self.index["subjects"].get(subject, []):
+            triples.extend(self.block_triples(n, start, end))
+        return triples
+
+    def __iter__(self):
+        for n in range(len(self.index["blocks"])):
+            yield from self.block_triples(n)
+
+    def write_turtle(self, f):
+        """Export the graph as Turtle"""
+        writer = TurtleWriter(f, self.prefixes)
+        writer.write_prefixes()
+        for n in range(len(self.index["blocks"])):
+            subject, props = None, []
+            for s, p, o in self.block_triples(n):
+                if s != subject and props:
+                    writer.write_subject(subject, props)
+                    props = []
+                subject = s
+                props.append((p, o))
+            if props:
+                writer.write_subject(subject, props)
+
+
+def site_archive_files(dataset, site):
+    """Turtle files packed into a site's .nidmz: the site graph without the shared registry"""
+    registry = data_elements_path()
+    return [f for f in site_graph_files(dataset, site) if f != registry]
+
+
+def pack_site(dataset, site, codec=None):
+    paths = site_paths(dataset, site)
+    stats = pack(site_archive_files(dataset, site), paths["compact"], codec)
+    logger.info(f"{dataset}/{site}: {stats['input_bytes'] / 1e6:.1f} MB Turtle -> "
+                f"{stats['bytes'] / 1e6:.2f} MB {paths['compact'].name} "
+                f"({stats['input_bytes'] / max(stats['bytes'], 1):.1f}x)")
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pack NIDM site graphs into .nidmz files and read them")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("pack", help="Write {site}.nidmz next to each site's Turtle outputs")
+    p.add_argument("datasets", nargs="*", help="Datasets (default: all)")
+    p.add_argument("--sites", nargs="+", help="Only these sites")
+    p.add_argument("--codec", choices=["zstd", "zlib"], default=default_codec())
+    u = sub.add_parser("unpack", help="Export a .nidmz file as Turtle")
+    u.add_argument("file", type=Path)
+    u.add_argument("-o", "--output", type=Path, help="Turtle file (default: stdout)")
+    g = sub.add_parser("get", help="Print the statements of subjects")
+    g.add_argument("file", type=Path)
+    g.add_argument("subjects", nargs="+", help="IRIs as <...> or prefixed names")
+    i = sub.add_parser("info", help="Show a .nidmz file's size and layout")
+    i.add_argument("file", type=Path)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    if args.command == "pack":
+        unknown = [d for d in args.datasets if d not in DATASETS]
+        if unknown:
+            parser.error(f"Unknown dataset(s): {', '.join(unknown)}")
+        before = after = 0
+        for dataset in args.datasets or sorted(DATASETS):
+            for site in read_sites(dataset):
+                if args.sites and site not in args.sites:
+                    continue
+                if not site_paths(dataset, site)["nidm"].exists():
+                    continue
+                stats = pack_site(dataset, site, args.codec)
+                before += stats["input_bytes"]
+                after += stats["bytes"]
+        registry = data_elements_path()
+        if registry.exists() and not args.sites:
+            stats = pack([registry], registry.with_suffix(".nidmz"), args.codec)
+            before += stats["input_bytes"]
+            after += stats["bytes"]
+        logger.info(f"Packed {before / 1e6:.1f} MB of Turtle into {after / 1e6:.1f} MB "
+                    f"({before / max(after, 1):.1f}x)")
+        return 0
+
+    with CompactGraph(args.file) as graph:
+        if args.command == "unpack":
+            if args.output:
+                tmp = args.output.with_suffix(f".{os.getpid()}.tmp")
+                with open(tmp, "w", encoding="utf-8") as f:
+                    graph.write_turtle(f)
+                os.replace(tmp, args.output)
+            else:
+                graph.write_turtle(sys.stdout)
+        elif args.command == "get":
+            writer = TurtleWriter(sys.stdout, graph.prefixes)
+            for name in args.subjects:
+                try:
+                    subject = parse_term(name)
+                except QueryError as e:
+                    parser.error(str(e))
+                start = time.time()
+                triples = graph.statements(subject)
+                if not triples:
+                    logger.warning(f"{name}: not a subject of {args.file.name}")
+                blocks = {}
+                for s, p, o in triples:
+                    blocks.setdefault(s, []).append((p, o))
+                for s, props in blocks.items():
+                    writer.write_subject(s, props)
+                logger.info(f"{name}: {len(triples)} triples in {(time.time() - start) * 1000:.1f} ms")
+        else:
+            size = args.file.stat().st_size
+            print(f"sources: {', '.join(graph.index['sources'])}")
+            print(f"codec: {graph.codec}")
+            print(f"triples: {len(graph)}")
+            print(f"subjects: {len(graph.index['subjects'])}")
+            print(f"blocks: {len(graph.index['blocks'])}")
+            print(f"size_mb: {size / 1e6:.2f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,100 @@
+"""
+Dataset configuration shared by the pipeline modules
+"""
+import os
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+DATA_DIR = REPO_DIR / "data"
+# Output locations; overridable so benchmarks and test runs stay out of the repo
+OUTPUT_ROOT = Path(os.environ.get("SIMPLE2_OUTPUT_ROOT", REPO_DIR / "nidm_outputs"))
+LOG_ROOT = Path(os.environ.get("SIMPLE2_LOG_ROOT", REPO_DIR / "logs"))
+EXPORT_ROOT = Path(os.environ.get("SIMPLE2_EXPORT_ROOT", REPO_DIR / "nidm_exports"))
+WRAPPER_DIR = REPO_DIR / "scripts" / "wrappers"
+# Build manifests and caches; not versioned
+STATE_ROOT = Path(os.environ.get("SIMPLE2_STATE_ROOT", REPO_DIR / ".pipeline"))
+
+# Root of the datalad BIDS datasets; override to run against a local copy
+DATALAD_ROOT = Path(os.environ.get("SIMPLE2_DATALAD_ROOT",
+                                   "/orcd/data/satra/002/datasets/simple2_datalad"))
+
+DATASETS = {
+    "abide1": {
+        "site_list": DATA_DIR / "site_lists" / "abide1_sites.txt",
+        "json_map": DATA_DIR / "mappings" / "abide_phenotypic_v1_0b_vars_to_terms_v5.json",
+        "phenotype_csv": DATA_DIR / "phenotypes" / "Phenotypic_V1_0b.csv",
+        "subject_column": "SUB_ID",
+        "phenotype_from_participants": False,
+        "site_prefix": "",
+        "excluded_sites": {},
+    },
+    "abide2": {
+        "site_list": DATA_DIR / "site_lists" / "abide2_sites.txt",
+        "json_map": DATA_DIR / "mappings" / "abide2_variables_to_terms_complete.json",
+        "phenotype_csv": DATA_DIR / "phenotypes" / "ABIDE2_Cophenotype.csv",
+        "subject_column": "participant_id",
+        # ABIDE2_Cophenotype.csv is assembled from the sites' participants.tsv (cophenotype.py)
+        "phenotype_from_participants": True,
+        "site_prefix": "ABIDEII-",
+        "excluded_sites": {
+            "ABIDEII-GU_1": "Unicode error in participants.tsv",
+            "ABIDEII-NYU_1": "Missing bvec files",
+            "ABIDEII-NYU_2": "Missing bvec files",
+        },
+    },
+    "adhd200": {
+        "site_list": DATA_DIR / "site_lists" / "adhd200_sites.txt",
+        "json_map": DATA_DIR / "mappings" / "adhd200_vars_to_terms_v5.json",
+        "phenotype_csv": None,  # BIDS conversion only
+        "subject_column": None,
+        "phenotype_from_participants": False,
+        "site_prefix": "",
+        "excluded_sites": {},
+    },
+}
+
+
+def read_sites(dataset, include_excluded=False):
+    """Read the site list for a dataset, dropping known-bad sites by default"""
+    config = DATASETS[dataset]
+    with open(config["site_list"], "r") as f:
+        sites = [line.strip() for line in f if line.strip()]
+    if not include_excluded:
+        sites = [site for site in sites if site not in config["excluded_sites"]]
+    return sites
+
+
+def data_elements_path():
+    """Shared PersonalDataElement registry referenced by the phenotype graphs"""
+    return OUTPUT_ROOT / "data_elements.ttl"
+
+
+def site_stem(dataset, site):
+    """Lowercase output file stem for a site, e.g. ABIDEII-BNI_1 -> bni_1"""
+    prefix = DATASETS[dataset]["site_prefix"]
+    if prefix and site.startswith(prefix):
+        site = site[len(prefix):]
+    return site.lower()
+
+
+def site_paths(dataset, site):
+    """Input, output and log paths used when processing a site"""
+    stem = site_stem(dataset, site)
+    output_dir = OUTPUT_ROOT / dataset
+    log_dir = LOG_ROOT / dataset
+    return {
+        "site_dir": DATALAD_ROOT / dataset / site,
+        "output_dir": output_dir,
+        "log_dir": log_dir,
+        "nidm": output_dir / f"{stem}_nidm.ttl",
+        "phenotype": output_dir / f"{stem}_phenotype.ttl",
+        "phenotype_delta": output_dir / f"{stem}_phenotype_delta.ttl",
+        "compact": output_dir / f"{stem}.nidmz",
+        "log": log_dir / f"{site}_processing.log",
+    }
+
+
+def has_phenotype(dataset):
+    """Whether phenotype integration is configured and its CSV is present"""
+    csv_file = DATASETS[dataset]["phenotype_csv"]
+    return csv_file is not None and Path(csv_file).exists()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+"""
+Assemble a dataset's co-phenotype CSV from its sites' participants.tsv files.
+
+Replaces archive/python_scripts/create_abide2_copheno.py (and the header
+rewriting of fix_abide2_tsv_headers.py). That script read every site serially
+with pandas and re-parsed a file once per candidate encoding before one big
+concat. Here:
+
+- sites are read in parallel, each file exactly once as bytes
+- the encoding is detected once per file (UTF-8, else cp1252, else latin-1)
+  and the parsed site is cached under .pipeline/cophenotype/<dataset>/ keyed
+  by the file's sha256, so a rebuild re-parses only new or changed sites
+- column names are stripped of surrounding spaces on read (the source files
+  are left alone) and the combined column list is grown site by site in
+  first-seen order; a site without a site_id column gets its site name
+- the CSV csv2nidm and phenotype.py read is written with the values exactly
+  as in the TSVs, plus a typed Parquet copy alongside it when pyarrow is
+  installed
+
+Usage:
+    python -m pipeline.cophenotype [DATASET ...]     # default: abide2
+"""
+import argparse
+import csv
+import hashlib
+import json
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from .config import DATASETS, STATE_ROOT, read_sites, site_paths
+from .scheduler import default_workers
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # the Parquet copy is skipped without it
+    pa = pq = None
+
+logger = logging.getLogger(__name__)
+
+ENCODINGS = ("utf-8-sig", "cp1252", "latin-1")
+MISSING = {"", "n/a", "na", "nan", "NaN", "N/A"}
+
+
+def cache_path(dataset, site):
+    return STATE_ROOT / "cophenotype" / dataset / f"{site}.json"
+
+
+def detect_encoding(data):
+    """First of ENCODINGS that decodes ``data``; latin-1 always does"""
+    for encoding in ENCODINGS:
+        try:
+            data.decode(encoding)
+            return encoding
+        except UnicodeDecodeError:
+            continue
+
+
+def parse_tsv(data, encoding):
+    """(stripped columns, rows) of a TSV given as bytes"""
+    lines = [line for line in data.decode(encoding).splitlines() if line.strip()]
+    if not lines:
+        return [], []
+    columns = [col.strip() for col in lines[0].split("\t")]
+    rows = [line.split("\t") for line in lines[1:]]
+    return columns, rows
+
+
+def read_site(dataset, site, use_cache=True):
+    """Parsed participants.tsv of a site, or None if it has none"""
+    tsv = site_paths(dataset, site)["site_dir"] / "participants.tsv"
+    try:
+        data = tsv.read_bytes()
+    except FileNotFoundError:
+        return None
+    digest = hashlib.sha256(data).hexdigest()
+    path = cache_path(dataset, site)
+    if use_cache and path.exists():
+        with open(path, "r") as f:
+            cached = json.load(f)
+        if cached.get("sha256") == digest:
+            return cached
+
+    encoding = detect_encoding(data)
+    columns, rows = parse_tsv(data, encoding)
+    if "site_id" not in columns:
+        columns.append("site_id")
+        rows = [row + [site] for row in rows]
+    parsed = {"site": site, "sha256": digest, "encoding": encoding, "columns": columns, "rows": rows}
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp, "w") as f:
+        json.dump(parsed, f)
+    os.replace(tmp, path)
+    return parsed
+
+
+def typed(values):
+    """Values as int or float when every non-missing one parses, else as str (missing -> None)"""
+    present = [v.strip() for v in values if v is not None and v.strip() not in MISSING]
+    for kind in (int, float):
+        try:
+            for v in present:
+                kind(v)
+        except ValueError:
+            continue
+        return kind, [kind(v.strip()) if v is not None and v.strip() not in MISSING else None for v in values]
+    return str, [v if v is not None and v.strip() not in MISSING else None for v in values]
+
+
+def build(dataset, workers=None, use_cache=True):
+    """Combine the sites' participants; return (columns, rows, per-site counts)"""
+    sites = read_sites(dataset, include_excluded=True)
+    with ThreadPoolExecutor(max_workers=workers or default_workers()[1]) as pool:
+        parsed = list(pool.map(lambda site: read_site(dataset, site, use_cache), sites))
+
+    columns, positions, rows, counts = [], {}, [], {}
+    for site, part in zip(sites, parsed):
+        if part is None:
+            logger.warning(f"{dataset}/{site}: participants.tsv not found")
+            continue
+        for col in part["columns"]:
+            if col not in positions:
+                positions[col] = len(columns)
+                columns.append(col)
+        index = [positions[col] for col in part["columns"]]
+        for row in part["rows"]:
+            out = [None] * len(columns)
+            for i, value in zip(index, row):
+                out[i] = value
+            rows.append(out)
+        counts[site] = (len(part["rows"]), part["encoding"])
+    # Rows from earlier sites predate later columns
+    rows = [row + [None] * (len(columns) - len(row)) for row in rows]
+    return columns, rows, counts
+
+
+def write_outputs(columns, rows, csv_file):
+    """Write the CSV (if changed) and, with pyarrow, a typed Parquet copy; return paths written"""
+    csv_file = Path(csv_file)
+    csv_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp = csv_file.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(columns)
+        writer.writerows(["" if v is None else v for v in row] for row in rows)
+    written = []
+    # Leave an unchanged CSV alone so its mtime does not trigger downstream rebuilds
+    if csv_file.exists() and csv_file.read_bytes() == tmp.read_bytes():
+        tmp.unlink()
+    else:
+        os.replace(tmp, csv_file)
+        written.append(csv_file)
+
+    if pa is None:
+        logger.info("pyarrow is not installed; skipping the Parquet copy")
+        return written
+    parquet_file = csv_file.with_suffix(".parquet")
+    arrays, fields = [], []
+    for i, col in enumerate(columns):
+        kind, values = typed([row[i] for row in rows])
+        arrow_type = {int: pa.int64(), float: pa.float64(), str: pa.string()}[kind]
+        fields.append(pa.field(col, arrow_type))
+        arrays.append(pa.array(values, type=arrow_type))
+    tmp = parquet_file.with_suffix(f".{os.getpid()}.tmp")
+    pq.write_table(pa.Table.from_arrays(arrays, schema=pa.schema(fields)), tmp, compression="zstd")
+    os.replace(tmp, parquet_file)
+    written.append(parquet_file)
+    return written
+
+
+def build_dataset(dataset, workers=None, use_cache=True):
+    """Rebuild a dataset's co-phenotype CSV; return the number of participants"""
+    columns, rows, counts = build(dataset, workers, use_cache)
+    if not rows:
+        logger.warning(f"{dataset}: no participants.tsv found; co-phenotype not written")
+        return 0
+    for site, (n, encoding) in counts.items():
+        note = "" if encoding == "utf-8-sig" else f" (read as {encoding})"
+        logger.info(f"{dataset}/{site}: {n} participants{note}")
+    written = write_outputs(columns, rows, DATASETS[dataset]["phenotype_csv"])
+    logger.info(f"{dataset}: {len(rows)} participants, {len(columns)} columns from {len(counts)} sites"
+                + (f"; wrote {', '.join(p.name for p in written)}" if written else "; unchanged"))
+    return len(rows)
+
+
+def main(argv=None):
+    default = [d for d in sorted(DATASETS) if DATASETS[d]["phenotype_from_participants"]]
+    parser = argparse.ArgumentParser(description="Assemble co-phenotype CSVs from participants.tsv files")
+    parser.add_argument("datasets", nargs="*", help=f"Datasets (default: {', '.join(default)})")
+    parser.add_argument("--workers", type=int, help="Sites read concurrently")
+    parser.add_argument("--no-cache", action="store_true", help="Re-parse every participants.tsv")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    unknown = [d for d in args.datasets if d not in DATASETS]
+    if unknown:
+        parser.error(f"Unknown dataset(s): {', '.join(unknown)}")
+
+    for dataset in args.datasets or default:
+        build_dataset(dataset, args.workers, use_cache=not args.no_cache)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,98 @@
+"""
+Runtime predictions from the telemetry history.
+
+run_all used to start sites in site-list order with one 3600 s timeout for
+every converter call. A large site that started last then set the makespan,
+and a hung call on a site that converts in a minute held its worker for an
+hour. logs/telemetry.jsonl already records each step's wall time with the
+site's subject, scan and image byte counts. CostModel uses it to predict a
+step's runtime:
+
+- from the step's own recent runs on the site (the median of the last
+  RECENT), scaled by how the scan count changed since then
+- else from the step's median seconds per scan over all sites, or per subject
+  for steps that do not read images
+
+A sharded site's merge is its own step, bidsmri2nidm-merge, so its few
+seconds do not count as a conversion of the whole site. Older records named
+it bidsmri2nidm; those are recognized by the shard records of the same run.
+
+The scheduler starts ready steps longest-predicted-chain first (see
+scheduler.py). Converter steps get a timeout of TIMEOUT_FACTOR x the
+prediction, at least MIN_TIMEOUT and at most the --timeout default. A step
+whose last run timed out, or that has no history, gets the default.
+"""
+import logging
+import statistics
+from collections import defaultdict
+
+from . import telemetry
+
+logger = logging.getLogger(__name__)
+
+RECENT = 5  # runs of a step on a site that its prediction is based on
+TIMEOUT_FACTOR = 4.0
+MIN_TIMEOUT = 300  # seconds
+FEATURES = ("subjects", "scans", "image_bytes")
+
+
+def features(index, subjects=None):
+    """{"subjects", "scans", "image_bytes"} of a site's preflight index, or of some of its subjects"""
+    if not index or "subjects" not in index:
+        return {}
+    if subjects is None:
+        return {"subjects": len(index["subjects"]), "scans": index.get("images"),
+                "image_bytes": index.get("image_bytes")}
+    infos = [index["subjects"][s] for s in subjects if s in index["subjects"]]
+    return {"subjects": len(infos), "scans": sum(sum(i["modalities"].values()) for i in infos),
+            "image_bytes": sum(i.get("image_bytes", 0) for i in infos)}
+
+
+class CostModel:
+    """Per-step runtime predictions and timeouts from telemetry records"""
+
+    def __init__(self, records=None):
+        records = telemetry.read() if records is None else records
+        self.history = defaultdict(list)
+        self.last = {}
+        per_unit = defaultdict(list)
+        sharded = {(r["run"], r["dataset"], r["site"]) for r in records if r.get("step") == "bidsmri2nidm-shard"}
+        for rec in records:
+            if not rec.get("site"):
+                continue
+            if rec["step"] == "bidsmri2nidm" and (rec["run"], rec["dataset"], rec["site"]) in sharded:
+                rec = dict(rec, step="bidsmri2nidm-merge")
+            key = (rec["dataset"], rec["site"], rec["step"], rec.get("shard"))
+            if rec["status"] in ("done", "failed"):
+                self.last[key] = rec
+            if rec["status"] != "done":
+                continue
+            self.history[key].append(rec)
+            for unit in ("scans", "subjects"):
+                if rec.get(unit):
+                    per_unit[(rec["step"], unit)].append(rec["wall"] / rec[unit])
+        self.rates = {key: statistics.median(values) for key, values in per_unit.items()}
+
+    def predict(self, dataset, site, step, feats, shard=None):
+        """Predicted wall seconds of a step, or None without any history for it"""
+        recent = self.history.get((dataset, site, step, shard), [])[-RECENT:]
+        if recent:
+            wall = statistics.median(r["wall"] for r in recent)
+            before = statistics.median(r.get("scans") or 0 for r in recent)
+            if before and feats.get("scans"):
+                wall *= feats["scans"] / before
+            return wall
+        for unit in ("scans", "subjects"):
+            if feats.get(unit) and (step, unit) in self.rates:
+                return self.rates[(step, unit)] * feats[unit]
+        return None
+
+    def timeout(self, dataset, site, step, feats, default, shard=None):
+        """Converter timeout for a step: a multiple of its prediction, capped at ``default``"""
+        last = self.last.get((dataset, site, step, shard))
+        if last is not None and last["status"] == "failed" and "timed out" in (last.get("error") or ""):
+            return default
+        predicted = self.predict(dataset, site, step, feats, shard)
+        if predicted is None:
+            return default
+        return int(min(default, max(MIN_TIMEOUT, TIMEOUT_FACTOR * predicted)))
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+"""
+Compare two nidm_outputs/ trees subject by subject.
+
+Whether a rerun changed anything used to need a graph-isomorphism check per
+site, because every conversion names its nodes with fresh UUIDs. This tool
+names the nodes of both trees from their content (canonical.py), so the
+comparison needs no matching. It assigns every node to the subject it
+describes: the subject's agent, the acquisitions and assessments associated
+with that agent, the entities they generated, and their sessions. It then
+hashes each subject's nodes into one order-independent digest. Site graphs
+whose files are byte-identical are skipped without parsing. That is the
+common case for outputs written with run_all --deterministic-iris.
+
+Each .ttl file is compared on its own, except that a phenotype delta is read
+together with its site's BIDS graph, which defines the subjects it
+references. For each graph the report lists the subjects that were added,
+removed or changed, and whether nodes not tied to a subject changed. The
+exit status is 1 if the trees differ.
+
+Usage:
+    python -m pipeline.diff OLD_OUTPUTS NEW_OUTPUTS
+    python -m pipeline.diff /backup/nidm_outputs nidm_outputs --datasets abide1 --json /tmp/diff.json
+"""
+import argparse
+import hashlib
+import json
+import logging
+import sys
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from . import vocab
+from .canonical import canonical_names, load_graph, rename
+from .manifest import file_digest
+from .phenotype import normalize_subject_id
+from .scheduler import default_workers
+from .turtle import split_literal
+
+logger = logging.getLogger(__name__)
+
+SITE_LEVEL = ""  # digest key of the nodes no subject owns
+DELTA_SUFFIX = "_phenotype_delta.ttl"
+
+
+def graph_units(root, datasets=None):
+    """{name: [files]} of the graphs in an outputs tree, a phenotype delta together with its BIDS graph"""
+    root = Path(root)
+    units = {}
+    for path in sorted(root.rglob("*.ttl")):
+        rel = path.relative_to(root)
+        if datasets and (len(rel.parts) < 2 or rel.parts[0] not in datasets):
+            continue
+        nidm = path.with_name(path.name[:-len(DELTA_SUFFIX)] + "_nidm.ttl")
+        if path.name.endswith(DELTA_SUFFIX) and nidm.exists():
+            units[rel.as_posix()] = [nidm, path]
+        else:
+            units[rel.as_posix()] = [path]
+    return units
+
+
+def _owners(nodes):
+    """{node: set of subject IDs} for the nodes that describe a subject"""
+    owners = defaultdict(set)
+    for node, props in nodes.items():
+        for p, o in props:
+            if p == vocab.SRC_SUBJECT_ID and isinstance(o, str):
+                owners[node].add(normalize_subject_id(split_literal(o)[0]))
+    # activity -> its agents; entity -> the activity that generated it; session -> its activities
+    activities = defaultdict(set)
+    for node, props in nodes.items():
+        for p, assoc in props:
+            if p == vocab.QUALIFIED_ASSOCIATION and isinstance(assoc, list):
+                for q, agent in assoc:
+                    if q == vocab.PROV_AGENT_PROP:
+                        activities[node] |= owners.get(agent, set())
+    for node, props in nodes.items():
+        for p, o in props:
+            if p == vocab.WAS_GENERATED_BY and o in activities:
+                owners[node] |= activities[o]
+            elif p == vocab.IS_PART_OF and node in activities:
+                owners[o] |= activities[node]
+    for node, agents in activities.items():
+        owners[node] |= agents
+    return owners
+
+
+def subject_digests(files, base):
+    """{subject ID (SITE_LEVEL for other nodes): digest} of a graph"""
+    nodes = load_graph(files)
+    names = canonical_names(nodes, base)
+    owners = _owners(nodes)
+    digests = defaultdict(int)
+    for node, props in nodes.items():
+        text = f"{names.get(node, node)} {rename(props, names)}"
+        digest = int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "big")
+        for owner in owners.get(node) or [SITE_LEVEL]:
+            # A sum does not depend on the order the nodes were read in
+            digests[owner] = (digests[owner] + digest) % (1 << 64)
+    return dict(digests)
+
+
+def compare_unit(job):
+    """Comparison of one graph in both trees"""
+    name, old, new = job
+    if old and new and len(old) == len(new) and \
+            all(file_digest(a) == file_digest(b) for a, b in zip(old, new)):
+        return {"graph": name, "status": "unchanged"}
+    if not old or not new:
+        return {"graph": name, "status": "added" if new else "removed"}
+    before, after = subject_digests(old, name), subject_digests(new, name)
+    subjects = (set(before) | set(after)) - {SITE_LEVEL}
+    result = {
+        "graph": name,
+        "added": sorted(s for s in subjects if s not in before),
+        "removed": sorted(s for s in subjects if s not in after),
+        "changed": sorted(s for s in subjects if s in before and s in after and before[s] != after[s]),
+        "site_changed": before.get(SITE_LEVEL) != after.get(SITE_LEVEL),
+        "subjects": len(set(after) - {SITE_LEVEL}),
+    }
+    differs = result["added"] or result["removed"] or result["changed"] or result["site_changed"]
+    result["status"] = "changed" if differs else "equivalent"
+    return result
+
+
+def diff(old_root, new_root, datasets=None, workers=None):
+    """Compare two outputs trees; return the report"""
+    start = time.time()
+    old, new = graph_units(old_root, datasets), graph_units(new_root, datasets)
+    jobs = [(name, old.get(name), new.get(name)) for name in sorted(set(old) | set(new))]
+    with ProcessPoolExecutor(max_workers=workers or default_workers()[0]) as pool:
+        graphs = list(pool.map(compare_unit, jobs, chunksize=1))
+    return {"old": str(old_root), "new": str(new_root), "seconds": round(time.time() - start, 2),
+            "graphs": graphs}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare two nidm_outputs trees subject by subject")
+    parser.add_argument("old", type=Path, help="Outputs tree of the earlier run")
+    parser.add_argument("new", type=Path, help="Outputs tree of the later run")
+    parser.add_argument("--datasets", nargs="+", help="Only these dataset directories")
+    parser.add_argument("--workers", type=int, help="Graphs compared concurrently (default: CPU count)")
+    parser.add_argument("--json", type=Path, help="Also write the report to this file")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    for root in (args.old, args.new):
+        if not root.is_dir():
+            parser.error(f"Not a directory: {root}")
+
+    report = diff(args.old, args.new, args.datasets, args.workers)
+    counts = defaultdict(int)
+    for graph in report["graphs"]:
+        counts[graph["status"]] += 1
+        if graph["status"] in ("added", "removed"):
+            print(f"{graph['graph']:36s} {graph['status']}")
+        elif graph["status"] == "changed":
+            parts = [f"{len(graph[key])} {key}" for key in ("added", "removed", "changed") if graph[key]]
+            if graph["site_changed"]:
+                parts.append("site-level nodes changed")
+            print(f"{graph['graph']:36s} {', '.join(parts)} of {graph['subjects']} subjects")
+            for key in ("added", "removed", "changed"):
+                if graph[key]:
+                    print(f"    {key:8s} {' '.join(graph[key][:20])}{' ...' if len(graph[key]) > 20 else ''}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=1)
+    print(f"{len(report['graphs'])} graphs compared in {report['seconds']:.1f} seconds: "
+          + ", ".join(f"{n} {status}" for status, n in sorted(counts.items())))
+    return 1 if counts["changed"] or counts["added"] or counts["removed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+"""
+Shared PersonalDataElement registry.
+
+csv2nidm defines every mapped variable again in every site graph, each time
+with a random IRI suffix, so the same variable has a different IRI in every
+site (and sometimes twice in one site). This module builds the definitions
+once from data/mappings/*.json and writes them to a shared
+nidm_outputs/data_elements.ttl. Each element's IRI is derived from its
+canonical DD(source=..., variable=...) key, so it is the same in every run
+and every site. The phenotype stage references these IRIs and does not
+redefine them.
+
+Mapping entries keyed by a plain variable name get the dataset's phenotype CSV
+as their source. For a mapping no dataset uses for phenotypes, the mapping
+file name is used instead.
+
+Usage:
+    python -m pipeline.elements            # (re)write nidm_outputs/data_elements.ttl
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+from pathlib import Path
+
+from . import vocab
+from .config import DATA_DIR, DATASETS, data_elements_path
+from .turtle import TurtleWriter, literal
+
+logger = logging.getLogger(__name__)
+
+MAPPINGS = sorted((DATA_DIR / "mappings").glob("*.json"))
+
+# Mapping keys look like DD(source='Phenotypic_V1_0b.csv', variable='SITE_ID')
+_DD_KEY = re.compile(r"DD\(source=['\"](?P<source>[^'\"]*)['\"],\s*variable=['\"](?P<variable>[^'\"]*)['\"]\)")
+
+
+def mapping_variable(key, entry):
+    """Source variable (CSV column) a mapping entry describes"""
+    if entry.get("source_variable"):
+        return str(entry["source_variable"]).strip()
+    m = _DD_KEY.fullmatch(key.strip())
+    return m.group("variable").strip() if m else key.strip()
+
+
+def mapping_source(json_map):
+    """Default source for a mapping's plain keys: the phenotype CSV it describes"""
+    for config in DATASETS.values():
+        if Path(config["json_map"]) == Path(json_map) and config["phenotype_csv"]:
+            return Path(config["phenotype_csv"]).name
+    return Path(json_map).name
+
+
+def canonical_key(key, entry, source):
+    """DD(source=..., variable=...) key of a mapping entry"""
+    m = _DD_KEY.fullmatch(key.strip())
+    if m:
+        return f"DD(source='{m.group('source').strip()}', variable='{m.group('variable').strip()}')"
+    return f"DD(source='{source}', variable='{mapping_variable(key, entry)}')"
+
+
+def element_iri(dd_key, variable):
+    """Stable IRI for the PersonalDataElement with canonical key ``dd_key``"""
+    name = re.sub(r"[^\w\-]", "_", variable) or "element"
+    suffix = hashlib.sha1(dd_key.encode("utf-8")).hexdigest()[:8]
+    return f"<{vocab.NIIRI}{name}_{suffix}>"
+
+
+def load_mapping(json_map):
+    """[(canonical key, variable, entry)] for one mapping file, in file order"""
+    with open(json_map, "r") as f:
+        mapping = json.load(f)
+    source = mapping_source(json_map)
+    return [(canonical_key(key, entry, source), mapping_variable(key, entry), entry)
+            for key, entry in mapping.items()]
+
+
+def element_props(variable, entry):
+    """(predicate, object) pairs defining one PersonalDataElement"""
+    props = [(vocab.TYPE, vocab.PERSONAL_DATA_ELEMENT), (vocab.TYPE, vocab.PROV_ENTITY),
+             (vocab.LABEL, literal(entry.get("label") or variable))]
+    if entry.get("description"):
+        props.append((vocab.DESCRIPTION, literal(entry["description"])))
+    for concept in concepts(entry):
+        props.append((vocab.IS_ABOUT, f"<{concept['@id']}>"))
+    props.append((vocab.SOURCE_VARIABLE, literal(variable)))
+    if entry.get("valueType"):
+        props.append((vocab.VALUE_TYPE, f"<{entry['valueType']}>"))
+    for field, prop in (("hasUnit", vocab.HAS_UNIT), ("minValue", vocab.MIN_VALUE),
+                        ("maxValue", vocab.MAX_VALUE)):
+        if str(entry.get(field, "")).strip() not in ("", "NA"):
+            props.append((prop, literal(entry[field])))
+    if entry.get("associatedWith"):
+        props.append((vocab.ASSOCIATED_WITH, literal(entry["associatedWith"])))
+    return props
+
+
+def concepts(entry):
+    """isAbout concepts of a mapping entry that have an @id"""
+    about = entry.get("isAbout") or []
+    return [c for c in (about if isinstance(about, list) else [about]) if isinstance(c, dict) and c.get("@id")]
+
+
+def registry_blocks(mappings=None):
+    """(subject, props) blocks for every element in ``mappings``, each defined once"""
+    seen = set()
+    labels = {}
+    for json_map in mappings or MAPPINGS:
+        for dd_key, variable, entry in load_mapping(json_map):
+            if dd_key in seen:
+                continue
+            seen.add(dd_key)
+            for concept in concepts(entry):
+                labels.setdefault(concept["@id"], concept.get("label"))
+            yield element_iri(dd_key, variable), element_props(variable, entry)
+    for concept, label in labels.items():
+        props = [(vocab.TYPE, vocab.PROV_ENTITY)]
+        if label:
+            props.append((vocab.LABEL, literal(label)))
+        yield f"<{concept}>", props
+
+
+def write_registry(path=None, mappings=None):
+    """Write the registry TTL atomically; return (path, number of elements)"""
+    path = Path(path or data_elements_path())
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    count = 0
+    with open(tmp, "w", encoding="utf-8") as f:
+        writer = TurtleWriter(f, vocab.PREFIXES)
+        writer.write_prefixes()
+        for subject, props in registry_blocks(mappings):
+            count += props[0][1] == vocab.PERSONAL_DATA_ELEMENT
+            writer.write_subject(subject, props)
+    os.replace(tmp, path)
+    return path, count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write the shared PersonalDataElement registry")
+    parser.add_argument("mappings", nargs="*", type=Path, help="Mapping JSON files (default: data/mappings/*.json)")
+    parser.add_argument("-o", "--output", type=Path, help="Output TTL (default: nidm_outputs/data_elements.ttl)")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    path, count = write_registry(args.output, args.mappings or None)
+    logger.info(f"Wrote {count} data elements to {path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
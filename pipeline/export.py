@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+"""
+Export the NIDM graphs as typed tables.
+
+Getting age, diagnosis and T1 parameters across all of ABIDE otherwise means
+loading every Turtle file into rdflib. This stage streams each site graph once
+(the BIDS graph, the phenotype graph or delta and the data element registry)
+and flattens it into four tables:
+
+    subjects       one row per subject agent
+    sessions       one row per nidm:Session, with its subject
+    acquisitions   one row per AcquisitionObject; every bids:/dicom:/nidm:
+                   property becomes a typed column named <prefix>_<name>
+                   (dicom_RepetitionTime, bids_EchoTime, ...)
+    assessments    one row per (assessment, variable) with the raw value and,
+                   where it parses, a numeric value
+
+Tables are written as Parquet (pyarrow, optional dependency), partitioned per
+dataset and site:
+    nidm_exports/{table}/dataset={dataset}/site={site}/part-0.parquet
+so query engines can prune partitions and columns. ``--format csv`` writes the
+same layout as CSV files when pyarrow is not installed. Each table's columns
+and types are kept in {table}/_schema.json, so exporting some sites writes the
+same schema as exporting all of them; when new sites add columns or widen a
+type, the sites already exported are rewritten with the new schema.
+
+Usage:
+    python -m pipeline.export                   # all datasets
+    python -m pipeline.export abide1 --sites Caltech --format csv
+"""
+import argparse
+import csv
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+from collections import defaultdict
+from pathlib import Path
+
+from . import vocab
+from .config import DATASETS, EXPORT_ROOT, read_sites, site_paths
+from .phenotype import normalize_subject_id, site_graph_files
+from .turtle import XSD, TurtleReader, iri, is_literal, split_literal
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # only needed for --format parquet
+    pa = pq = None
+
+logger = logging.getLogger(__name__)
+
+TABLES = ("subjects", "sessions", "acquisitions", "assessments")
+FORMATS = ("parquet", "csv")
+KEY_COLUMNS = ["dataset", "site"]
+_INT_TYPES = {f"{XSD}{t}" for t in ("int", "integer", "long", "short", "byte", "nonNegativeInteger",
+                                     "positiveInteger", "unsignedInt", "unsignedLong")}
+_FLOAT_TYPES = {f"{XSD}{t}" for t in ("double", "float", "decimal")}
+SCHEMA_FILE = "_schema.json"  # leading underscore: Parquet readers skip it
+# Properties of an AcquisitionObject that link or type it rather than describe it;
+# bidsmri2nidm also writes a type-like ``nidm:AcquisitionObject 1``
+LINKS = {vocab.TYPE, vocab.WAS_GENERATED_BY, vocab.IS_PART_OF, vocab.QUALIFIED_ASSOCIATION,
+         vocab.ACQUISITION_OBJECT}
+_NAMESPACES = sorted(((namespace, prefix) for prefix, namespace in vocab.PREFIXES.items()),
+                     key=lambda item: -len(item[0]))
+
+
+def typed_value(term):
+    """Python value of an RDF term: int/float/bool for typed literals, str otherwise"""
+    if not is_literal(term):
+        return iri(term) if term.startswith("<") else term
+    value, datatype, _ = split_literal(term)
+    try:
+        if datatype in _INT_TYPES:
+            return int(value)
+        if datatype in _FLOAT_TYPES:
+            return float(value)
+        if datatype == f"{XSD}boolean":
+            return value.strip().lower() in ("true", "1")
+    except ValueError:
+        pass
+    return value
+
+
+def local_name(term):
+    """Last path or fragment segment of an IRI"""
+    value = iri(term)
+    return value.rstrip("/#").replace("#", "/").rsplit("/", 1)[-1]
+
+
+def column_name(term):
+    """Column of a property: <prefix>_<local name>, e.g. dicom_RepetitionTime"""
+    value = iri(term)
+    for namespace, prefix in _NAMESPACES:
+        if value.startswith(namespace) and len(value) > len(namespace):
+            name = value[len(namespace):]
+            break
+    else:
+        # Namespaces without a pipeline prefix get a short digest of the namespace instead
+        name = local_name(term)
+        prefix = "ns" + hashlib.blake2b(value[:len(value) - len(name)].encode(), digest_size=3).hexdigest()
+    return f"{prefix}_{''.join(c if c.isalnum() else '_' for c in name)}"
+
+
+def as_number(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def load_graph(files):
+    """{subject: {predicate: [object, ...]}} for the union of ``files``"""
+    nodes = defaultdict(lambda: defaultdict(list))
+    for i, path in enumerate(files):
+        for s, p, o in TurtleReader(path, bnode_prefix=f"f{i}b"):
+            nodes[s][p].append(o)
+    return nodes
+
+
+def data_element_names(nodes):
+    """{PersonalDataElement IRI: variable name} for the elements defined in ``nodes``"""
+    names = {}
+    for node, props in nodes.items():
+        if vocab.PERSONAL_DATA_ELEMENT in props.get(vocab.TYPE, ()):
+            name = (props.get(vocab.SOURCE_VARIABLE) or props.get(vocab.LABEL) or [None])[0]
+            names[node] = split_literal(name)[0] if name else local_name(node)
+    return names
+
+
+def site_tables(dataset, site):
+    """{table: [row dict, ...]} for one site"""
+    nodes = load_graph(site_graph_files(dataset, site))
+    elements = data_element_names(nodes)
+    key = {"dataset": dataset, "site": site}
+
+    subject_ids = {}
+    for node, props in nodes.items():
+        if props.get(vocab.SRC_SUBJECT_ID):
+            subject_ids[node] = normalize_subject_id(split_literal(props[vocab.SRC_SUBJECT_ID][0])[0])
+
+    def first(node, prop):
+        values = nodes.get(node, {}).get(prop)
+        return values[0] if values else None
+
+    def activity_subject(activity):
+        for association in nodes.get(activity, {}).get(vocab.QUALIFIED_ASSOCIATION, ()):
+            agent = first(association, vocab.PROV_AGENT_PROP)
+            if agent in subject_ids:
+                return subject_ids[agent]
+        return None
+
+    tables = {name: [] for name in TABLES}
+    sessions = {}
+    for node, props in nodes.items():
+        types = props.get(vocab.TYPE, ())
+        if vocab.ACQUISITION_OBJECT not in types:
+            continue
+        activity = first(node, vocab.WAS_GENERATED_BY)
+        session = first(activity, vocab.IS_PART_OF)
+        subject_id = activity_subject(activity)
+        if session is not None:
+            counts = sessions.setdefault(session, {"subject_id": subject_id, "n_acquisitions": 0,
+                                                   "n_assessments": 0})
+            counts["subject_id"] = counts["subject_id"] or subject_id
+        row = dict(key, subject_id=subject_id, session=iri(session) if session else None, iri=iri(node))
+        if vocab.ASSESSMENT_OBJECT in types:
+            if session is not None:
+                counts["n_assessments"] += 1
+            for prop, values in props.items():
+                if prop in elements:
+                    value = typed_value(values[0])
+                    tables["assessments"].append(dict(row, variable=elements[prop], value=str(value),
+                                                      value_num=as_number(value)))
+        else:
+            if session is not None:
+                counts["n_acquisitions"] += 1
+            for prop, values in sorted(props.items()):
+                # Values that are nodes of the graph are links too
+                if prop not in LINKS and values[0] not in nodes:
+                    row[column_name(prop)] = typed_value(values[0])
+            tables["acquisitions"].append(row)
+
+    for node, props in nodes.items():
+        if vocab.SESSION in props.get(vocab.TYPE, ()):
+            counts = sessions.get(node, {"subject_id": None, "n_acquisitions": 0, "n_assessments": 0})
+            tables["sessions"].append(dict(key, session=iri(node), **counts))
+    subject_iris = {sid: iri(node) for node, sid in subject_ids.items()}
+    for sid, node in sorted(subject_iris.items()):
+        tables["subjects"].append(dict(key, subject_id=sid, iri=node))
+    return tables
+
+
+def column_type(values, kinds=()):
+    """Narrowest common type of a column's non-null values and the types ``kinds``: int, float, bool or str"""
+    kinds = {type(v) for v in values if v is not None} | set(kinds)
+    if kinds == {bool}:
+        return bool
+    if kinds and kinds <= {int}:
+        return int
+    if kinds and kinds <= {int, float}:
+        return float
+    return str
+
+
+def unify(rows, schema=None):
+    """(columns, types) covering every row and the earlier ``schema``, each column coerced to one type"""
+    columns, known = (list(schema[0]), schema[1]) if schema else (list(KEY_COLUMNS), {})
+    seen = set(columns)
+    for row in rows:
+        for c in row:
+            if c not in seen:
+                seen.add(c)
+                columns.append(c)
+    types = {c: column_type([row.get(c) for row in rows], [known[c]] if c in known else ()) for c in columns}
+    return columns, types
+
+
+_TYPE_NAMES = {str: "str", int: "int", float: "float", bool: "bool"}
+
+
+def read_schema(table_dir):
+    """(columns, types) a table was last written with, or None"""
+    try:
+        with open(Path(table_dir) / SCHEMA_FILE, "r") as f:
+            schema = json.load(f)
+    except FileNotFoundError:
+        return None
+    names = {name: kind for kind, name in _TYPE_NAMES.items()}
+    return schema["columns"], {c: names[t] for c, t in schema["types"].items()}
+
+
+def write_schema(table_dir, columns, types):
+    table_dir.mkdir(parents=True, exist_ok=True)
+    tmp = table_dir / f"{SCHEMA_FILE}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump({"columns": columns, "types": {c: _TYPE_NAMES[types[c]] for c in columns}}, f, indent=1)
+    os.replace(tmp, table_dir / SCHEMA_FILE)
+
+
+def exported_sites(output_dir):
+    """(dataset, site) pairs with a partition in any table of ``output_dir``"""
+    pairs = set()
+    for name in TABLES:
+        for partition in Path(output_dir, name).glob("dataset=*/site=*"):
+            pairs.add((partition.parent.name[len("dataset="):], partition.name[len("site="):]))
+    return sorted(pairs)
+
+
+def coerce(value, kind):
+    if value is None:
+        return None
+    if kind is str:
+        return str(value)
+    return kind(value)
+
+
+_ARROW_TYPES = {str: "string", int: "int64", float: "float64", bool: "bool_"}
+
+
+def write_partition(rows, columns, types, path, fmt):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    if fmt == "parquet":
+        # dataset/site live in the partition path, not in the file
+        fields = [c for c in columns if c not in KEY_COLUMNS]
+        schema = pa.schema([(c, getattr(pa, _ARROW_TYPES[types[c]])()) for c in fields])
+        table = pa.table({c: [coerce(row.get(c), types[c]) for row in rows] for c in fields}, schema=schema)
+        pq.write_table(table, tmp, compression="zstd")
+    else:
+        with open(tmp, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            for row in rows:
+                writer.writerow(["" if row.get(c) is None else coerce(row.get(c), types[c]) for c in columns])
+    os.replace(tmp, path)
+
+
+def export(pairs, output_dir=None, fmt="parquet"):
+    """Export the graphs of ``pairs`` (dataset, site); return {table: rows written}"""
+    if fmt == "parquet" and pa is None:
+        raise RuntimeError("Parquet export needs pyarrow (pip install pyarrow), or use --format csv")
+    output_dir = Path(output_dir or EXPORT_ROOT)
+    collected = {name: [] for name in TABLES}
+
+    def flatten(pairs):
+        for dataset, site in pairs:
+            if not site_paths(dataset, site)["nidm"].exists():
+                logger.warning(f"{dataset}/{site}: no BIDS NIDM file, skipping")
+                continue
+            for name, rows in site_tables(dataset, site).items():
+                collected[name].append((dataset, site, rows))
+            logger.info(f"{dataset}/{site}: flattened")
+
+    def schemas():
+        return {name: unify([row for _, _, rows in parts for row in rows], stored[name])
+                for name, parts in collected.items()}
+
+    pairs = list(pairs)
+    flatten(pairs)
+    # One schema per table across all partitions, so readers can union them
+    stored = {name: read_schema(output_dir / name) for name in TABLES}
+    schema = schemas()
+    others = [pair for pair in exported_sites(output_dir) if pair not in pairs]
+    if others and any(schema[name] != stored[name] for name in TABLES):
+        logger.info(f"The export schema changed; rewriting the {len(others)} sites exported before")
+        flatten(others)
+        schema = schemas()
+
+    written = {}
+    for name, parts in collected.items():
+        columns, types = schema[name]
+        for dataset, site, rows in parts:
+            partition = output_dir / name / f"dataset={dataset}" / f"site={site}"
+            if partition.exists():
+                shutil.rmtree(partition)
+            if rows:
+                write_partition(rows, columns, types, partition / f"part-0.{fmt}", fmt)
+        write_schema(output_dir / name, columns, types)
+        written[name] = sum(len(rows) for _, _, rows in parts)
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export the NIDM graphs as partitioned tables")
+    parser.add_argument("datasets", nargs="*", help="Datasets (default: all)")
+    parser.add_argument("--sites", nargs="+", help="Only these sites")
+    parser.add_argument("--format", choices=FORMATS, default="parquet")
+    parser.add_argument("-o", "--output", type=Path, help="Output directory (default: nidm_exports/)")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    unknown = [d for d in args.datasets if d not in DATASETS]
+    if unknown:
+        parser.error(f"Unknown dataset(s): {', '.join(unknown)}")
+
+    pairs = [(dataset, site) for dataset in (args.datasets or sorted(DATASETS))
+             for site in read_sites(dataset) if not args.sites or site in args.sites]
+    try:
+        written = export(pairs, args.output, args.format)
+    except RuntimeError as e:
+        logger.error(str(e))
+        return 1
+    for name, count in written.items():
+        logger.info(f"{name}: {count} rows")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+"""
+Persistent sha512 cache for image files.
+
+bidsmri2nidm records a crypto:sha512 for every AcquisitionObject, which means
+reading every NIfTI end to end on each run. This cache stores the digest in a
+SQLite database keyed by the file's (resolved path, size, mtime, inode), so an
+unchanged file is never re-read. SQLite's locking makes the cache safe to share
+between parallel site workers; entries are evicted least-recently-used once the
+cache grows past ``max_entries``.
+
+Usage:
+    python -m pipeline.hashcache stats
+    python -m pipeline.hashcache prune [--max-entries N]
+    python -m pipeline.hashcache hash FILE [FILE ...]
+"""
+import argparse
+import hashlib
+import os
+import sqlite3
+import sys
+import threading
+import time
+from pathlib import Path
+
+from .config import STATE_ROOT
+
+DEFAULT_PATH = Path(os.environ.get("SIMPLE2_HASH_CACHE", STATE_ROOT / "sha512_cache.sqlite"))
+DEFAULT_MAX_ENTRIES = 200000
+BLOCK_SIZE = 1 << 20
+# Check the size bound once every this many inserts rather than on each one
+PRUNE_INTERVAL = 1000
+
+
+def sha512_file(filename):
+    """Hex sha512 of a file, read in 1 MiB blocks"""
+    h = hashlib.sha512()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class HashCache:
+    """SQLite-backed sha512 cache with LRU eviction"""
+
+    def __init__(self, path=DEFAULT_PATH, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        self._inserts = 0
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS hashes (
+                            path TEXT NOT NULL,
+                            size INTEGER NOT NULL,
+                            mtime_ns INTEGER NOT NULL,
+                            inode INTEGER NOT NULL,
+                            sha512 TEXT NOT NULL,
+                            last_used REAL NOT NULL,
+                            PRIMARY KEY (path, size, mtime_ns, inode))""")
+            db.execute("CREATE INDEX IF NOT EXISTS hashes_last_used ON hashes (last_used)")
+
+    def _connect(self):
+        # One connection per thread; sqlite3 connections are not thread-safe
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=60)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def sha512(self, filename):
+        """Cached sha512 of ``filename``, hashing it only on a miss"""
+        real = os.path.realpath(filename)
+        st = os.stat(real)
+        key = (real, st.st_size, st.st_mtime_ns, st.st_ino)
+        db = self._connect()
+        with db:
+            row = db.execute("SELECT sha512 FROM hashes WHERE path=? AND size=? AND mtime_ns=? AND inode=?",
+                             key).fetchone()
+            if row is not None:
+                db.execute("UPDATE hashes SET last_used=? WHERE path=? AND size=? AND mtime_ns=? AND inode=?",
+                           (time.time(),) + key)
+                self.hits += 1
+                return row[0]
+
+        digest = sha512_file(real)
+        self.misses += 1
+        with db:
+            # A stale entry for the same path is dead weight once the file changed
+            db.execute("DELETE FROM hashes WHERE path=?", (real,))
+            db.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)",
+                       key + (digest, time.time()))
+        self._inserts += 1
+        if self._inserts % PRUNE_INTERVAL == 0:
+            self.prune()
+        return digest
+
+    def add(self, filename, digest):
+        """Record a digest computed elsewhere, e.g. while the file was copied"""
+        real = os.path.realpath(filename)
+        st = os.stat(real)
+        db = self._connect()
+        with db:
+            db.execute("DELETE FROM hashes WHERE path=?", (real,))
+            db.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)",
+                       (real, st.st_size, st.st_mtime_ns, st.st_ino, digest, time.time()))
+
+    def prune(self, max_entries=None):
+        """Evict least-recently-used entries beyond ``max_entries``; return the number removed"""
+        max_entries = self.max_entries if max_entries is None else max_entries
+        db = self._connect()
+        with db:
+            count = db.execute("SELECT COUNT(*) FROM hashes").fetchone()[0]
+            excess = count - max_entries
+            if excess <= 0:
+                return 0
+            db.execute("DELETE FROM hashes WHERE rowid IN "
+                       "(SELECT rowid FROM hashes ORDER BY last_used LIMIT ?)", (excess,))
+        return excess
+
+    def stats(self):
+        db = self._connect()
+        count, oldest, newest = db.execute(
+            "SELECT COUNT(*), MIN(last_used), MAX(last_used) FROM hashes").fetchone()
+        return {
+            "path": str(self.path),
+            "entries": count,
+            "max_entries": self.max_entries,
+            "oldest_use": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(oldest)) if oldest else None,
+            "newest_use": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(newest)) if newest else None,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect or maintain the sha512 cache")
+    parser.add_argument("command", choices=["stats", "prune", "hash"])
+    parser.add_argument("files", nargs="*")
+    parser.add_argument("--cache", default=DEFAULT_PATH, help="Cache database path")
+    parser.add_argument("--max-entries", type=int, default=DEFAULT_MAX_ENTRIES)
+    args = parser.parse_args(argv)
+
+    cache = HashCache(args.cache, max_entries=args.max_entries)
+    if args.command == "stats":
+        for key, value in cache.stats().items():
+            print(f"{key}: {value}")
+    elif args.command == "prune":
+        print(f"Evicted {cache.prune()} entries")
+    else:
+        for filename in args.files:
+            print(f"{cache.sha512(filename)}  {filename}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,534 @@
+#!/usr/bin/env python
+"""
+Shared-filesystem job queue for running the pipeline on several nodes.
+
+run_all runs a run's steps on the threads of one process, so a run uses one
+node. The job queue hands the same steps to any number of worker processes
+on any number of nodes that share the output filesystem. There is no
+coordinator: the queue is a directory (QUEUE_ROOT, next to nidm_outputs/ by
+default), and every change of a job's state is a rename or a link, which
+are atomic on local filesystems and NFS:
+
+    run.json, jobs.json             the submitted run and its jobs, written once
+    pending/<job>                   waiting to run
+    claimed/<job>@<worker>          taken: the rename out of pending/ is the claim
+    leases/<job>@<worker>.json      the claim's expiry, renewed while the job runs
+    results/<job>.json              status, metrics and error; linked into place, so written once
+    lost/<job>@<worker>.json        a claim taken back from a dead worker
+    finished.json                   written by "finish"
+
+Submitting a run replaces the previous one: all of these are removed first.
+
+Jobs are run_all's steps (steps.site_steps): conversions, shard
+conversions, phenotype, copy, csv2nidm and compact steps of every site,
+named like the steps with "/" as "+". A worker claims the pending job with
+the longest predicted chain to the end of the run (Scheduler.ranks) whose
+dependencies have results, rebuilds the site's steps and runs the one the
+job names. A job behind a failed dependency gets a "skipped" result.
+
+Before each claim a worker takes back the claims of dead workers: those
+whose lease has expired, and at once those of a worker on its own host whose
+process is gone. The job goes back to pending/, and after MAX_ATTEMPTS lost
+workers it fails. Lease expiry compares clocks across nodes, so their
+clocks must agree (NTP) to well within LEASE_SECONDS. A worker that loses
+its lease while still running finishes the job, but if another worker has
+already finished it its result is discarded.
+
+Workers exit once no job is pending or claimed (with --wait they keep
+polling for a new run). "finish" then does what run_all does at the end of
+a run: the summary, the content check (verify.py) and the telemetry records,
+once for the whole run.
+
+Usage:
+    python -m pipeline.jobqueue submit abide1 adhd200 --shard-size 50    # run_all's options
+    python -m pipeline.jobqueue work --processes 8                       # on each node
+    python -m pipeline.jobqueue status
+    python -m pipeline.jobqueue finish
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+from . import telemetry
+from .config import DATASETS, LOG_ROOT, OUTPUT_ROOT
+from .costs import CostModel
+from .run_all import collect_sites, conclude, parse_args as parse_run_args, prepare, setup_logging
+from .scheduler import Scheduler, Step, DONE, FAILED, SKIPPED, UP_TO_DATE
+from .steps import site_steps
+from .worker import ConverterPool
+
+logger = logging.getLogger(__name__)
+
+QUEUE_ROOT = Path(os.environ.get("SIMPLE2_QUEUE_ROOT", OUTPUT_ROOT.parent / "nidm_queue"))
+LEASE_SECONDS = 300  # a claim whose lease has not been renewed for this long is taken back
+RENEW_INTERVAL = 60  # seconds between lease renewals
+POLL_INTERVAL = 5  # seconds between looks at the queue while no job can start
+MAX_ATTEMPTS = 3  # workers a job may be lost with before it fails
+OK = (DONE, UP_TO_DATE)
+
+
+def job_id(name):
+    """Queue file name of a step"""
+    return name.replace("/", "+")
+
+
+def _write_json(path, data):
+    """Write ``path`` so readers on any node see either the old or the new content"""
+    tmp = path.with_name(f".{path.name}.{socket.gethostname()}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp, "w") as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+    return path
+
+
+def _read_json(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def _alive(pid):
+    """Whether a process of this host is running"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _entries(directory, suffix=""):
+    """{file name: job} of a queue directory, skipping temporary files"""
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return {}
+    return {name: name[:len(name) - len(suffix)].partition("@")[0] for name in names
+            if not name.startswith(".") and name.endswith(suffix)}
+
+
+class JobQueue:
+    """The queue directory; every method is safe to call from any number of processes and nodes"""
+
+    def __init__(self, root=None):
+        self.root = Path(root or QUEUE_ROOT)
+        self.pending = self.root / "pending"
+        self.claimed = self.root / "claimed"
+        self.leases = self.root / "leases"
+        self.results = self.root / "results"
+        self.lost = self.root / "lost"
+        self._jobs = None
+        self._jobs_stat = None
+        self._results = {}
+
+    def unfinished(self):
+        """Jobs pending or claimed"""
+        return set(_entries(self.pending).values()) | set(_entries(self.claimed).values())
+
+    def clear(self):
+        """Remove the queue's run, jobs, claims, leases and results"""
+        for directory in (self.pending, self.claimed, self.leases, self.results, self.lost):
+            shutil.rmtree(directory, ignore_errors=True)
+        for name in ("run.json", "jobs.json", "finished.json"):
+            (self.root / name).unlink(missing_ok=True)
+
+    def create(self, run, jobs):
+        """Replace the queue's previous run, with its results and lost claims, by a new one"""
+        self.clear()
+        for directory in (self.pending, self.claimed, self.leases, self.results, self.lost):
+            directory.mkdir(parents=True, exist_ok=True)
+        _write_json(self.root / "jobs.json", jobs)
+        _write_json(self.root / "run.json", run)
+        for job in jobs:
+            (self.pending / job["id"]).touch()
+
+    def run_info(self):
+        return _read_json(self.root / "run.json")
+
+    def jobs(self):
+        """{job id: job} of the current run, reread when a new run is submitted"""
+        try:
+            stat = (self.root / "jobs.json").stat()
+        except FileNotFoundError:
+            return {}
+        if (stat.st_ino, stat.st_mtime) != self._jobs_stat:
+            self._jobs = {job["id"]: job for job in _read_json(self.root / "jobs.json") or []}
+            self._jobs_stat = (stat.st_ino, stat.st_mtime)
+            self._results = {}
+        return self._jobs
+
+    def finished(self):
+        """{job id: result} of the jobs with a result; results never change, so each is read once"""
+        for name, job in _entries(self.results, ".json").items():
+            if job not in self._results:
+                result = _read_json(self.results / name)
+                if result is not None:
+                    self._results[job] = result
+        return self._results
+
+    def claim(self, worker):
+        """Claim the startable pending job with the longest chain ahead; return (job, claim path) or None"""
+        jobs, results = self.jobs(), self.finished()
+        candidates = []
+        for job in _entries(self.pending).values():
+            if job in results:
+                # Finished by a worker that had lost its lease
+                (self.pending / job).unlink(missing_ok=True)
+                continue
+            if job not in jobs:
+                continue
+            deps = [results[dep]["status"] if dep in results else None for dep in jobs[job]["deps"]]
+            # A job behind a failure is claimed to record that it was skipped
+            if all(s in OK for s in deps) or any(s is not None and s not in OK for s in deps):
+                candidates.append((-jobs[job]["priority"], job))
+        for _, job in sorted(candidates):
+            claim = self.claimed / f"{job}@{worker}"
+            try:
+                os.rename(self.pending / job, claim)
+            except FileNotFoundError:
+                continue  # another worker was first
+            return jobs[job], claim
+        return None
+
+    def renew(self, claim, owner):
+        """Write or extend the lease of a claim"""
+        return _write_json(self.leases / f"{claim.name}.json", dict(owner, expires=time.time() + LEASE_SECONDS))
+
+    def attempts(self, job):
+        """Workers the job has been lost with"""
+        return sum(1 for lost in _entries(self.lost, ".json").values() if lost == job)
+
+    def reclaim(self):
+        """Put the claims of dead workers back in pending/; return the jobs taken back"""
+        now, host = time.time(), socket.gethostname()
+        reclaimed = []
+        for name, job in _entries(self.claimed).items():
+            claim = self.claimed / name
+            lease = _read_json(self.leases / f"{name}.json")
+            if lease is None:
+                # The worker died between claiming the job and writing the lease
+                try:
+                    expires = claim.stat().st_mtime + LEASE_SECONDS
+                except FileNotFoundError:
+                    continue
+                reason = "no lease was written"
+            else:
+                expires = lease["expires"]
+                reason = f"lease of {lease['worker']} expired"
+            if lease is not None and lease["host"] == host and not _alive(lease["pid"]):
+                reason = f"worker {lease['worker']} is gone"
+            elif now < expires:
+                continue
+            try:
+                os.rename(claim, self.pending / job)
+            except FileNotFoundError:
+                continue  # finished, or taken back by another worker
+            _write_json(self.lost / f"{name}.json", dict(lease or {}, reason=reason, time=now))
+            (self.leases / f"{name}.json").unlink(missing_ok=True)
+            logger.warning(f"Took back {job}: {reason}")
+            reclaimed.append(job)
+        return reclaimed
+
+    def release(self, claim):
+        """Put a claim back in pending/ without counting it as lost, e.g. when its worker is stopped"""
+        try:
+            os.rename(claim, self.pending / claim.name.partition("@")[0])
+        except FileNotFoundError:
+            pass
+        (self.leases / f"{claim.name}.json").unlink(missing_ok=True)
+
+    def complete(self, claim, result):
+        """Record a job's result unless another worker already did; return whether it was recorded"""
+        job = claim.name.partition("@")[0]
+        tmp = _write_json(self.results / f".{claim.name}.json", result)
+        try:
+            # link() fails if the result exists, so the first worker to finish a job records it
+            os.link(tmp, self.results / f"{job}.json")
+            recorded = True
+        except FileExistsError:
+            recorded = False
+        finally:
+            tmp.unlink()
+        claim.unlink(missing_ok=True)
+        (self.leases / f"{claim.name}.json").unlink(missing_ok=True)
+        return recorded
+
+    def drained(self):
+        return not self.unfinished()
+
+
+class _Lease(threading.Thread):
+    """Renews a claim's lease while its job runs"""
+
+    def __init__(self, queue, claim, owner):
+        super().__init__(name="lease", daemon=True)
+        self.queue = queue
+        self.claim = claim
+        self.owner = owner
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(RENEW_INTERVAL):
+            if not self.claim.exists():
+                logger.warning(f"Lost the lease on {self.claim.name}; another worker may run it as well")
+                return
+            self.queue.renew(self.claim, self.owner)
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+
+def run_job(job, pool=None, results=None, attempts=0):
+    """Run one job's step; return its result record"""
+    results = results or {}
+    blocked = [dep for dep in job["deps"] if results.get(dep, {}).get("status") not in OK]
+    result = {"status": FAILED, "error": None, "metrics": {}, "elapsed": 0.0}
+    if blocked:
+        logger.warning(f"Skipping {job['name']}: an upstream step did not complete")
+        return dict(result, status=SKIPPED)
+    if attempts >= MAX_ATTEMPTS:
+        error = f"{attempts} workers were lost while running it"
+        logger.error(f"{job['name']} failed: {error}")
+        return dict(result, error=error)
+    try:
+        steps = {step.name: step for step in site_steps(job["dataset"], job["site"], timeout=job["timeout"],
+                                                         pool=pool, **job["options"])}
+    except Exception as e:
+        logger.error(f"{job['name']} failed: {e}")
+        return dict(result, error=str(e))
+    if job["name"] not in steps:
+        error = "the site no longer has this step (were subjects added since the run was submitted?)"
+        logger.error(f"{job['name']} failed: {error}")
+        return dict(result, error=error)
+
+    step = steps[job["name"]]
+    logger.info(f"Starting {step.name}")
+    start_time = time.time()
+    try:
+        with telemetry.measure() as metrics:
+            outcome = step.func()
+        status = UP_TO_DATE if outcome == UP_TO_DATE else DONE
+    except Exception as e:
+        status, result["error"] = FAILED, str(e)
+    elapsed = time.time() - start_time
+    if status == FAILED:
+        logger.error(f"{step.name} failed after {elapsed:.2f} seconds: {result['error']}")
+    elif status == UP_TO_DATE:
+        logger.info(f"{step.name} is up to date")
+    else:
+        logger.info(f"Finished {step.name} in {elapsed:.2f} seconds")
+    return dict(result, status=status, metrics=metrics, elapsed=round(elapsed, 3))
+
+
+def work(queue, pool=None, wait=False, poll=POLL_INTERVAL, run=run_job):
+    """Run jobs until none is pending or claimed (with ``wait``, until stopped); return the number run.
+
+    ``run(job, pool, results, attempts)`` returns a job's result record (see run_job).
+    """
+    host, pid = socket.gethostname(), os.getpid()
+    owner = {"worker": f"{host}-{pid}", "host": host, "pid": pid}
+    count = 0
+    while True:
+        queue.reclaim()
+        claimed = queue.claim(owner["worker"])
+        if claimed is None:
+            if not wait and queue.drained():
+                break
+            time.sleep(poll)
+            continue
+        job, claim = claimed
+        queue.renew(claim, owner)
+        lease = _Lease(queue, claim, owner)
+        lease.start()
+        try:
+            result = run(job, pool, queue.finished(), queue.attempts(job["id"]))
+        except BaseException:
+            # Stopped (Ctrl-C, SIGTERM): hand the job to another worker
+            lease.stop()
+            queue.release(claim)
+            raise
+        lease.stop()
+        result.update(worker=owner["worker"], finished=time.time())
+        if not queue.complete(claim, result):
+            logger.warning(f"{job['name']} was finished by another worker; discarding this result")
+        count += 1
+    logger.info(f"No jobs left; {owner['worker']} ran {count}")
+    return count
+
+
+def submit(queue, args):
+    """Prepare a run_all run and queue its steps; return the number of jobs"""
+    datasets = args.datasets or sorted(DATASETS)
+    pairs = collect_sites(datasets, args.sites, args.include_excluded)
+    logging.info(f"Found {len(pairs)} sites to queue in {', '.join(datasets)}")
+
+    run = telemetry.new_run_id()
+    blocked, indexes = prepare(datasets, pairs, run, args.io_workers, check=not args.no_preflight)
+    # Rebuilt by each worker from these options, with the planned timeout of its own step
+    options = {"force": args.force, "phenotype_mode": args.phenotype_mode, "shard_size": args.shard_size,
+               "compact": args.compact, "deterministic": args.deterministic_iris,
+               "stall_timeout": args.stall_timeout}
+    costs = None if args.fixed_timeout else CostModel()
+    scheduler = Scheduler()
+    for dataset, site in pairs:
+        if (dataset, site) in blocked:
+            continue
+        for step in site_steps(dataset, site, timeout=args.timeout, costs=costs,
+                               index=indexes.get((dataset, site)), **options):
+            scheduler.add(step)
+
+    ranks = scheduler.ranks()
+    jobs = []
+    for name, step in scheduler.steps.items():
+        dataset, site, _ = name.split("/", 2)
+        jobs.append({"id": job_id(name), "name": name, "dataset": dataset, "site": site,
+                     "deps": [job_id(dep) for dep in step.deps], "priority": round(ranks[name], 1),
+                     "info": step.info, "timeout": step.info.get("timeout", args.timeout), "options": options})
+    queue.create({"run": run, "submitted": time.time(), "pairs": pairs,
+                  "blocked": [[dataset, site, problems] for (dataset, site), problems in blocked.items()],
+                  "verify": not args.no_verify}, jobs)
+    logging.info(f"Queued {len(jobs)} jobs of run {run} in {queue.root}")
+    return len(jobs)
+
+
+def finish(queue, workers=None):
+    """Summarize, verify and record the telemetry of a drained run; return the exit status"""
+    run = queue.run_info()
+    if run is None:
+        logging.error(f"No run has been submitted to {queue.root}")
+        return 1
+    unfinished = queue.unfinished()
+    if unfinished:
+        logging.error(f"{len(unfinished)} jobs are still pending or running (python -m pipeline.jobqueue status)")
+        return 1
+    if (queue.root / "finished.json").exists():
+        logging.error(f"Run {run['run']} was already finished; submit a new one")
+        return 1
+
+    results = queue.finished()
+    steps = {}
+    for job in queue.jobs().values():
+        step = steps[job["name"]] = Step(job["name"], None, info=job["info"])
+        result = results.get(job["id"], {"status": FAILED, "error": "no result was recorded"})
+        step.status, step.error = result["status"], result["error"]
+        step.metrics, step.elapsed = result.get("metrics", {}), result.get("elapsed", 0.0)
+    ended = max((result.get("finished", 0) for result in results.values()), default=run["submitted"])
+    pairs = [tuple(pair) for pair in run["pairs"]]
+    blocked = {(dataset, site): problems for dataset, site, problems in run["blocked"]}
+    status = conclude(run["run"], pairs, steps, ended - run["submitted"], blocked, {}, check=run["verify"],
+                      workers=workers)
+    _write_json(queue.root / "finished.json", {"run": run["run"], "time": time.time(), "status": status})
+    return status
+
+
+def status(queue):
+    """Log the state of the queue's jobs"""
+    run = queue.run_info()
+    if run is None:
+        logging.info(f"No run has been submitted to {queue.root}")
+        return
+    jobs, results = queue.jobs(), queue.finished()
+    counts = Counter(result["status"] for result in results.values())
+    pending = _entries(queue.pending)
+    claimed = _entries(queue.claimed)
+    logging.info(f"Run {run['run']} in {queue.root}: {len(jobs)} jobs, {len(pending)} pending, "
+                 f"{len(claimed)} running, " + ", ".join(f"{n} {s}" for s, n in sorted(counts.items())))
+    now = time.time()
+    for name, job in sorted(claimed.items()):
+        lease = _read_json(queue.leases / f"{name}.json") or {}
+        expires = f"lease expires in {lease['expires'] - now:.0f} s" if lease else "no lease yet"
+        logging.info(f"  {jobs.get(job, {}).get('name', job)} on {lease.get('worker', '?')} ({expires})")
+    for job, result in sorted(results.items()):
+        if result["status"] == FAILED:
+            logging.error(f"  {jobs.get(job, {}).get('name', job)}: {result['error']}")
+    for job, count in sorted(Counter(_entries(queue.lost, ".json").values()).items()):
+        logging.warning(f"  {jobs.get(job, {}).get('name', job)} was lost with {count} workers")
+
+
+def spawn(argv, processes):
+    """Run ``processes`` copies of a worker command; return the worst exit status"""
+    children = [subprocess.Popen([sys.executable, "-m", "pipeline.jobqueue"] + argv) for _ in range(processes)]
+    try:
+        return max(child.wait() for child in children)
+    except BaseException:
+        for child in children:
+            child.terminate()
+        for child in children:
+            child.wait()
+        raise
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--queue", type=Path, default=QUEUE_ROOT, help=f"Queue directory (default: {QUEUE_ROOT})")
+    commands = parser.add_subparsers(dest="command", required=True)
+    submit_parser = commands.add_parser("submit", help="Queue a run; takes run_all's datasets and options")
+    submit_parser.add_argument("--reset", action="store_true",
+                               help="Discard the queue's current run, even if it has not finished")
+    work_parser = commands.add_parser("work", help="Run queued jobs")
+    work_parser.add_argument("--processes", type=int, default=1, help="Worker processes to start on this node")
+    work_parser.add_argument("--converter", choices=["worker", "subprocess"], default="worker",
+                             help="worker: a persistent converter worker per process; "
+                                  "subprocess: one wrapper-script process per call")
+    work_parser.add_argument("--wait", action="store_true",
+                             help="Keep polling for jobs once the queue is empty, e.g. for the next run")
+    work_parser.add_argument("--poll", type=float, default=POLL_INTERVAL,
+                             help="Seconds between looks at the queue while no job can start")
+    commands.add_parser("status", help="Show pending, running and failed jobs")
+    finish_parser = commands.add_parser("finish", help="Summarize, verify and record a drained run")
+    finish_parser.add_argument("--workers", type=int, help="Processes for the content check")
+    args, rest = parser.parse_known_args(argv)
+    if rest and args.command != "submit":
+        parser.error(f"unrecognized arguments: {' '.join(rest)}")
+    queue = JobQueue(args.queue)
+
+    if args.command == "submit":
+        run_args = parse_run_args(rest)
+        if run_args.stage:
+            parser.error("--stage is not supported: a site's staging and conversion may run on different nodes")
+        setup_logging(LOG_ROOT / "pipeline_jobqueue.log")
+        unfinished = queue.unfinished()
+        if unfinished and not args.reset:
+            logging.error(f"{queue.root} has {len(unfinished)} unfinished jobs; wait for them or use --reset")
+            return 1
+        submit(queue, run_args)
+        return 0
+
+    if args.command == "work":
+        if args.processes > 1:
+            argv = ["--queue", str(args.queue), "work", "--converter", args.converter, "--poll", str(args.poll)]
+            return spawn(argv + (["--wait"] if args.wait else []), args.processes)
+        setup_logging(LOG_ROOT / f"pipeline_worker_{socket.gethostname()}.log")
+        # A worker stopped by its batch system releases its job
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+        pool = ConverterPool(1) if args.converter == "worker" else None
+        try:
+            work(queue, pool, wait=args.wait, poll=args.poll)
+        finally:
+            if pool is not None:
+                pool.close()
+        return 0
+
+    setup_logging(LOG_ROOT / "pipeline_jobqueue.log")
+    if args.command == "status":
+        status(queue)
+        return 0
+    return finish(queue, args.workers)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
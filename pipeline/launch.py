@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""
+Run a PyNIDM converter with the pipeline's hooks installed.
+
+Runs inside the simple2 environment, e.g.
+    micromamba run -n simple2 python -m pipeline.launch bidsmri2nidm -d SITE_DIR -o OUT.ttl ...
+
+For bidsmri2nidm the module-level getsha512() is replaced by a lookup in the
+persistent hash cache (hashcache.py), so unchanged images are not re-read.
+Set SIMPLE2_NO_HASH_CACHE=1 to hash every file as before. Either way a
+"Hashing <image>" line is printed per image, which the pipeline reads as
+progress (capture.py).
+"""
+import importlib
+import logging
+import os
+import sys
+
+from .capture import PROGRESS_LINE
+from .hashcache import HashCache
+
+logger = logging.getLogger(__name__)
+
+TOOLS = {
+    "bidsmri2nidm": "nidm.experiment.tools.bidsmri2nidm",
+    "csv2nidm": "nidm.experiment.tools.csv2nidm",
+}
+
+
+def install_hooks(module, cache=None):
+    """Route ``module.getsha512`` through ``cache``, if any, and report each image; False if it is missing"""
+    if not hasattr(module, "getsha512"):
+        logger.warning(f"{module.__name__} has no getsha512(); sha512 cache and progress not installed")
+        return False
+    sha512 = cache.sha512 if cache is not None else module.getsha512
+
+    def getsha512(filename):
+        print(f"{PROGRESS_LINE}{filename}", flush=True)
+        return sha512(filename)
+
+    module.getsha512 = getsha512
+    return True
+
+
+def run_tool(tool, args):
+    """Import and run a converter's main() with ``args`` as its command line"""
+    module = importlib.import_module(TOOLS[tool])
+    cache = None
+    if tool == "bidsmri2nidm":
+        cache = None if os.environ.get("SIMPLE2_NO_HASH_CACHE") else HashCache()
+        if not install_hooks(module, cache):
+            cache = None
+
+    sys.argv = [tool] + list(args)
+    try:
+        module.main()
+    finally:
+        if cache is not None:
+            print(f"sha512 cache: {cache.hits} hits, {cache.misses} misses", file=sys.stderr)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] not in TOOLS:
+        print(f"Usage: python -m pipeline.launch {{{','.join(TOOLS)}}} [ARGS ...]")
+        return 1
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    run_tool(argv[0], argv[1:])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
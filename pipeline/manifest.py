@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+"""
+Content-addressed build manifest for site outputs.
+
+Each site gets a small JSON manifest under .pipeline/manifest/<dataset>/ that
+records, per step, digests of the step's inputs (BIDS tree listing, mapping
+JSON, phenotype CSV, converter version, upstream outputs) and of the outputs
+it produced. A step is rerun only when an input digest changed or an output
+is missing or was modified.
+
+Usage:
+    python -m pipeline.manifest status [DATASET ...]
+    python -m pipeline.manifest adopt [DATASET ...]   # record existing outputs as current
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+from functools import lru_cache
+from pathlib import Path
+
+from .config import DATASETS, STATE_ROOT, read_sites
+
+logger = logging.getLogger(__name__)
+
+# Directories that never affect the conversion
+IGNORED_DIRS = {".git", ".datalad", "derivatives", "sourcedata", "code"}
+
+_digest_cache = {}
+_digest_lock = threading.Lock()
+
+
+def file_digest(path):
+    """sha256 of a file's contents, memoized on (path, size, mtime)"""
+    path = Path(path)
+    st = path.stat()
+    key = (str(path), st.st_size, st.st_mtime_ns)
+    with _digest_lock:
+        if key in _digest_cache:
+            return _digest_cache[key]
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    digest = h.hexdigest()
+    with _digest_lock:
+        _digest_cache[key] = digest
+    return digest
+
+
+def walk_tree(root):
+    """Yield (relative path, fingerprint) for every file of a BIDS tree.
+
+    Datalad stores file content in the annex behind symlinks, so the link
+    target (which embeds the content key) is used instead of following it;
+    other files are fingerprinted by size and mtime.
+    """
+    root = Path(root)
+    stack = [root]
+    while stack:
+        current = stack.pop()
+        with os.scandir(current) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in IGNORED_DIRS:
+                        stack.append(entry.path)
+                    continue
+                rel = os.path.relpath(entry.path, root)
+                if entry.is_symlink():
+                    yield rel, f"link\0{os.readlink(entry.path)}"
+                else:
+                    st = entry.stat(follow_symlinks=False)
+                    yield rel, f"{st.st_size}\0{st.st_mtime_ns}"
+
+
+def listing_digest(entries):
+    """sha256 over the sorted (path, fingerprint) listing from walk_tree()"""
+    h = hashlib.sha256()
+    for rel, fingerprint in sorted(entries):
+        h.update(f"{rel}\0{fingerprint}".encode("utf-8", "surrogateescape"))
+        h.update(b"\n")
+    return h.hexdigest()
+
+
+_tree_digests = {}
+
+
+def seed_tree_digest(root, digest):
+    """Record a digest computed by another walk (preflight) for the next tree_digest(root)"""
+    with _digest_lock:
+        _tree_digests[str(root)] = digest
+
+
+def tree_digest(root):
+    """sha256 over the sorted (path, size, mtime) listing of a BIDS tree"""
+    with _digest_lock:
+        seeded = _tree_digests.pop(str(root), None)
+    return seeded or listing_digest(walk_tree(root))
+
+
+def tsv_columns(tsv_file):
+    """Stripped header columns of a TSV file, or an empty list if it is missing"""
+    try:
+        with open(tsv_file, "rb") as f:
+            header = f.readline()
+    except FileNotFoundError:
+        return []
+    return [col.strip() for col in header.decode("utf-8", "replace").rstrip("\r\n").split("\t")]
+
+
+def mapping_digest(json_map, columns=None):
+    """sha256 of the mapping JSON, optionally restricted to entries for ``columns``.
+
+    bidsmri2nidm only applies mapping entries for the site's participants.tsv
+    columns, so restricting the digest keeps a mapping fix for an unrelated
+    variable from invalidating the BIDS conversion.
+    """
+    if columns is None:
+        return file_digest(json_map)
+    with open(json_map, "r") as f:
+        mapping = json.load(f)
+    wanted = {col.strip() for col in columns}
+    subset = {key: value for key, value in mapping.items()
+              if str(value.get("source_variable", key)).strip() in wanted or key.strip() in wanted}
+    blob = json.dumps(subset, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(blob).hexdigest()
+
+
+@lru_cache(maxsize=None)
+def tool_version():
+    """Version of PyNIDM in the simple2 environment (or SIMPLE2_TOOL_VERSION)"""
+    if os.environ.get("SIMPLE2_TOOL_VERSION"):
+        return os.environ["SIMPLE2_TOOL_VERSION"]
+    cmd = ["micromamba", "run", "-n", "simple2", "python", "-c",
+           "import importlib.metadata as m; print(m.version('pynidm'))"]
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=120)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logger.warning(f"Could not determine converter version: {e}")
+        return "unknown"
+    if result.returncode != 0:
+        logger.warning(f"Could not determine converter version: {result.stderr.strip()}")
+        return "unknown"
+    return result.stdout.strip()
+
+
+class Manifest:
+    """Per-site record of step inputs and outputs"""
+
+    def __init__(self, dataset, site, root=None):
+        self.path = Path(root or STATE_ROOT / "manifest") / dataset / f"{site}.json"
+        self.steps = {}
+        if self.path.exists():
+            with open(self.path, "r") as f:
+                self.steps = json.load(f)
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp, "w") as f:
+            json.dump(self.steps, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.path)
+
+    def changes(self, step, inputs, outputs):
+        """Reasons the step is out of date; empty when it can be skipped"""
+        record = self.steps.get(step)
+        if record is None:
+            return ["never built"]
+        reasons = [f"{name} changed" for name, digest in inputs.items()
+                   if record["inputs"].get(name) != digest]
+        reasons += [f"{name} removed" for name in record["inputs"] if name not in inputs]
+        for output in outputs:
+            output = Path(output)
+            expected = record["outputs"].get(output.name)
+            if not output.exists():
+                reasons.append(f"{output.name} missing")
+            elif expected != file_digest(output):
+                reasons.append(f"{output.name} modified")
+        return reasons
+
+    def record(self, step, inputs, outputs):
+        self.steps[step] = {
+            "inputs": dict(inputs),
+            "outputs": {Path(o).name: file_digest(o) for o in outputs},
+            "completed": time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        self.save()
+
+
+def main(argv=None):
+    # Imported here: steps imports this module for the digest helpers
+    from .steps import DEFAULT_PHENOTYPE_MODE, PHENOTYPE_MODES, StepError, site_inputs
+
+    parser = argparse.ArgumentParser(description="Inspect or seed the build manifests")
+    parser.add_argument("command", choices=["status", "adopt"])
+    parser.add_argument("datasets", nargs="*", help="Datasets (default: all)")
+    parser.add_argument("--phenotype-mode", choices=PHENOTYPE_MODES, default=DEFAULT_PHENOTYPE_MODE)
+    parser.add_argument("--deterministic-iris", action="store_true",
+                        help="Check against runs with run_all --deterministic-iris")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    for dataset in args.datasets or sorted(DATASETS):
+        for site in read_sites(dataset):
+            manifest = Manifest(dataset, site)
+            steps = site_inputs(dataset, site, args.phenotype_mode, deterministic=args.deterministic_iris)
+            for step, (inputs_fn, outputs) in steps.items():
+                if not all(Path(o).exists() for o in outputs):
+                    print(f"{dataset:8s} {site:20s} {step:14s} missing outputs")
+                    continue
+                try:
+                    inputs = inputs_fn()
+                except (OSError, StepError) as e:
+                    print(f"{dataset:8s} {site:20s} {step:14s} inputs unavailable ({e})")
+                    continue
+                reasons = manifest.changes(step, inputs, outputs)
+                if args.command == "adopt" and reasons:
+                    manifest.record(step, inputs, outputs)
+                    reasons = ["adopted"]
+                print(f"{dataset:8s} {site:20s} {step:14s} {', '.join(reasons) or 'up to date'}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
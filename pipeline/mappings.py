@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+"""
+Infer variable types for the phenotype mappings from the data.
+
+create_abide2_json_mapping.py built abide2_variables_to_terms_complete.json
+from one site's participants.tsv and typed every column it did not know as
+xsd:string with no range, so numeric scores end up as string literals in the
+phenotype graphs. This tool reads each dataset's full phenotype table once,
+column by column, and infers for every variable:
+
+- valueType: xsd:integer (integral values, "3.0" included), xsd:float,
+  xsd:complexType with ``levels`` for low-cardinality text, else xsd:string;
+  integer codes with at most MAX_INT_LEVELS distinct values also get ``levels``
+- minValue / maxValue over the valid values
+- missingValues: "n/a"-style tokens are always missing; numeric sentinels
+  such as -9999 are detected when they sit an order of magnitude outside the
+  rest of the column
+
+By default only generic entries (xsd:string with no range, as the single-site
+script produced) and columns with no entry are re-typed; curated entries with
+a real type, levels or isAbout keep their type, range and levels unless
+``--overwrite``. The missing codes of numeric columns are merged into every
+entry, curated ones included, since a typed -9999 would read as real data.
+phenotype.py writes values of integer/float variables as typed literals and
+drops their missingValues, compared as numbers ("-9999.0" is -9999).
+
+Usage:
+    python -m pipeline.mappings [DATASET ...]            # report what would change
+    python -m pipeline.mappings abide2 --write           # update data/mappings/*.json
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+from pathlib import Path
+
+from .config import DATASETS
+from .elements import mapping_variable
+from .turtle import XSD, literal
+
+logger = logging.getLogger(__name__)
+
+XSD_STRING = f"{XSD}string"
+XSD_INTEGER = f"{XSD}integer"
+XSD_FLOAT = f"{XSD}float"
+XSD_COMPLEX = f"{XSD}complexType"
+INTEGER_TYPES = {XSD_INTEGER, f"{XSD}int", f"{XSD}long"}
+FLOAT_TYPES = {XSD_FLOAT, f"{XSD}double", f"{XSD}decimal"}
+MISSING_TOKENS = {"", "n/a", "na", "nan", "null", "missing", "."}
+SENTINEL_CANDIDATES = (-9999, -999, -99, 999, 9999)
+MAX_INT_LEVELS = 4
+MAX_TEXT_LEVELS = 20
+INFERRED_FIELDS = ("valueType", "minValue", "maxValue", "levels", "missingValues")
+
+
+def is_missing(value):
+    return value.strip().lower() in MISSING_TOKENS
+
+
+def _number(value):
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def missing_codes(values):
+    """Set of a variable's missingValues as stripped strings and, for numeric codes, as numbers"""
+    codes = set()
+    for value in values or ():
+        value = str(value).strip()
+        codes.add(value)
+        number = _number(value)
+        if number is not None and number == number:
+            codes.add(number)
+    return codes
+
+
+def is_missing_code(value, codes):
+    """Whether a stripped raw value is one of ``codes`` (missing_codes), as text or as a number"""
+    return value in codes or _number(value) in codes
+
+
+def _format(number):
+    """Shortest string for a number: 3 for 3.0"""
+    return str(int(number)) if float(number).is_integer() else repr(float(number))
+
+
+def typed_literal(value, value_type):
+    """Literal for a raw value: typed if ``value_type`` is numeric and the value parses"""
+    number = _number(value)
+    if number is not None and value_type in INTEGER_TYPES and number.is_integer():
+        return literal(int(number), XSD_INTEGER)
+    if number is not None and value_type in FLOAT_TYPES and number == number:
+        return literal(value, value_type)
+    return literal(value)
+
+
+def sentinels(numbers):
+    """Candidate codes in ``numbers`` an order of magnitude outside all other values"""
+    found = []
+    for code in SENTINEL_CANDIDATES:
+        if code not in numbers:
+            continue
+        others = [n for n in numbers if n not in SENTINEL_CANDIDATES]
+        if not others:
+            continue
+        if (code < 0 and min(others) > code / 10) or (code > 0 and max(others) < code / 10):
+            found.append(code)
+    return found
+
+
+def infer_column(values):
+    """Inferred mapping fields for one column's raw string values"""
+    present = [v.strip() for v in values if not is_missing(v)]
+    tokens = sorted({v.strip() for v in values if v.strip() and is_missing(v)})
+    fields = {"valueType": XSD_STRING, "minValue": "", "maxValue": ""}
+    if not present:
+        return dict(fields, missingValues=tokens) if tokens else fields
+
+    numbers = [_number(v) for v in present]
+    if all(n is not None for n in numbers):
+        codes = sentinels(set(numbers))
+        valid = [n for n in numbers if n not in codes]
+        missing = tokens + [v for v in sorted({v for v, n in zip(present, numbers) if n in codes})]
+        if valid:
+            integral = all(n.is_integer() for n in valid)
+            fields = {"valueType": XSD_INTEGER if integral else XSD_FLOAT,
+                      "minValue": _format(min(valid)), "maxValue": _format(max(valid))}
+            distinct = sorted(set(valid))
+            if integral and len(distinct) <= MAX_INT_LEVELS:
+                fields["levels"] = [_format(n) for n in distinct]
+        if missing:
+            fields["missingValues"] = missing
+        return fields
+
+    distinct = sorted(set(present))
+    if len(distinct) <= MAX_TEXT_LEVELS and len(distinct) < len(present):
+        fields = {"valueType": XSD_COMPLEX, "minValue": "", "maxValue": "", "levels": distinct}
+    if tokens:
+        fields["missingValues"] = tokens
+    return fields
+
+
+def read_columns(csv_file):
+    """{stripped column name: [values]} of a CSV, read in one pass"""
+    with open(csv_file, "r", newline="", encoding="utf-8-sig") as f:
+        reader = csv.reader(f)
+        header = [col.strip() for col in next(reader)]
+        columns = [[] for _ in header]
+        for row in reader:
+            for i, column in enumerate(columns):
+                column.append(row[i] if i < len(row) else "")
+    return dict(zip(header, columns))
+
+
+def is_generic(entry):
+    """True for the untyped defaults create_abide2_json_mapping.py wrote"""
+    return (entry.get("valueType", XSD_STRING) == XSD_STRING
+            and not str(entry.get("minValue", "")).strip() and not str(entry.get("maxValue", "")).strip()
+            and not entry.get("levels") and not entry.get("isAbout"))
+
+
+def default_entry(dataset, column):
+    return {
+        "label": column.replace("_", " ").title(),
+        "description": f"{dataset.upper()} {column} variable",
+        "valueType": XSD_STRING,
+        "associatedWith": "NIDM",
+        "hasUnit": "",
+        "minValue": "",
+        "maxValue": "",
+        "source_variable": column,
+    }
+
+
+def update_mapping(dataset, mapping, columns, overwrite=False):
+    """Apply inferred fields to ``mapping`` in place; return [(key, change)]"""
+    changes = []
+    keys = {mapping_variable(key, entry): key for key, entry in mapping.items()}
+    # Subject IDs look numeric but are identifiers
+    identifier = DATASETS[dataset]["subject_column"]
+    for column, values in columns.items():
+        key = keys.get(column)
+        if key is None:
+            key = column
+            mapping[key] = default_entry(dataset, column)
+            changes.append((key, "added"))
+        entry = mapping[key]
+        if column == identifier:
+            continue
+        inferred = infer_column(values)
+        before = {f: entry.get(f) for f in INFERRED_FIELDS}
+        if overwrite or is_generic(entry):
+            for field in INFERRED_FIELDS:
+                if field in inferred:
+                    entry[field] = inferred[field]
+                elif field in ("levels", "missingValues"):
+                    entry.pop(field, None)
+        elif inferred["valueType"] in (XSD_INTEGER, XSD_FLOAT) and inferred.get("missingValues"):
+            # A curated entry keeps its type and range, but gains the codes found in the data
+            known = list(entry.get("missingValues") or [])
+            codes = missing_codes(known)
+            added = [v for v in inferred["missingValues"] if not is_missing_code(v, codes)]
+            if added:
+                entry["missingValues"] = known + added
+        after = {f: entry.get(f) for f in INFERRED_FIELDS}
+        if after != before:
+            summary = entry["valueType"].rsplit("#", 1)[-1]
+            if entry.get("minValue") != "":
+                summary += f" [{entry['minValue']}, {entry['maxValue']}]"
+            if entry.get("missingValues"):
+                summary += f" missing={entry['missingValues']}"
+            changes.append((key, summary))
+    return changes
+
+
+def _indent(path):
+    """Indent width used by an existing JSON file"""
+    with open(path, "r") as f:
+        f.readline()
+        second = f.readline()
+    return (len(second) - len(second.lstrip(" "))) or 2
+
+
+def infer_dataset(dataset, write=False, overwrite=False):
+    """Infer and optionally write a dataset's mapping; return the changes"""
+    config = DATASETS[dataset]
+    json_map = Path(config["json_map"])
+    with open(json_map, "r") as f:
+        mapping = json.load(f)
+    changes = update_mapping(dataset, mapping, read_columns(config["phenotype_csv"]), overwrite)
+    if write and changes:
+        tmp = json_map.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp, "w") as f:
+            json.dump(mapping, f, indent=_indent(json_map), ensure_ascii=False)
+            f.write("\n")
+        os.replace(tmp, json_map)
+    return changes
+
+
+def main(argv=None):
+    default = [d for d in sorted(DATASETS) if DATASETS[d]["phenotype_csv"]]
+    parser = argparse.ArgumentParser(description="Infer phenotype variable types, ranges and missing codes")
+    parser.add_argument("datasets", nargs="*", help=f"Datasets (default: {', '.join(default)})")
+    parser.add_argument("--write", action="store_true", help="Update the mapping JSON files")
+    parser.add_argument("--overwrite", action="store_true", help="Also re-infer curated (typed) entries")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    unknown = [d for d in args.datasets if d not in DATASETS]
+    if unknown:
+        parser.error(f"Unknown dataset(s): {', '.join(unknown)}")
+
+    for dataset in args.datasets or default:
+        if not Path(DATASETS[dataset]["phenotype_csv"] or "").is_file():
+            logger.warning(f"{dataset}: no phenotype CSV, skipping")
+            continue
+        changes = infer_dataset(dataset, args.write, args.overwrite)
+        for key, change in changes:
+            print(f"{dataset:8s} {key}: {change}")
+        verb = "updated" if args.write else "would update"
+        print(f"{dataset}: {verb} {len(changes)} entries in {Path(DATASETS[dataset]['json_map']).name}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
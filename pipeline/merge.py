@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+"""
+Merge a dataset's per-site graphs into one file in two streaming passes.
+
+Loading every site graph into rdflib to re-serialize it as one graph needs
+memory for every triple. This tool streams the site graphs (see
+phenotype.site_graph_files: the BIDS graph plus the phenotype delta, or the
+full phenotype graph, never both) and the data element registry
+statement by statement: a first pass collects the repeated nodes, and the
+second writes each statement as soon as it is read:
+
+- prefixes are collected from the file headers first and written once, one
+  name per namespace (a clashing name from a later file gets a numeric suffix;
+  terms are expanded on read, so this only changes how they are abbreviated)
+- blank nodes are relabelled per file so they cannot collide
+- Projects and PersonalDataElements that say the same thing are collapsed
+  into the first one (shared_renames, a first pass over the files): csv2nidm
+  gives every site its own copy of each data element under a random-suffix
+  IRI, e.g. niiri:AGE_AT_SCAN_1hc9lpu. The kept element replaces the others
+  wherever they are used, including as assessment properties. Each site's
+  Project carries its own title ("ABIDE - Caltech"), so Projects stay one per
+  site unless their content is identical. Outputs built with the shared
+  registry (data_elements.ttl) already name each element once.
+- triples about shared nodes (data elements, concepts, anything not named by
+  a converter-generated UUID) are deduplicated against a set of 8-byte
+  digests; UUID-named nodes are unique to one conversion and are not tracked,
+  so memory grows with the shared vocabulary, not with the dataset
+
+Output is Turtle or N-Triples.
+
+Usage:
+    python -m pipeline.merge abide1                   # nidm_outputs/abide1_all.ttl
+    python -m pipeline.merge abide2 --format nt -o /tmp/abide2_all.nt
+"""
+import argparse
+import hashlib
+import logging
+import os
+import re
+import sys
+from pathlib import Path
+
+from . import vocab
+from .config import DATASETS, OUTPUT_ROOT, data_elements_path, read_sites, site_paths
+from .phenotype import site_graph_files
+from .turtle import XSD, TurtleWriter, iter_statements
+
+logger = logging.getLogger(__name__)
+
+FORMATS = {"ttl": "Turtle", "nt": "N-Triples"}
+_PREFIX = re.compile(r"@prefix\s+([\w\-.]*):\s*<([^>]*)>\s*\.")
+UUID_NODE = re.compile(rf"<{re.escape(vocab.NIIRI)}[0-9a-f]{{8}}(?:-[0-9a-f]{{4}}){{3}}-[0-9a-f]{{12}}>")
+
+
+def read_prefixes(path):
+    """[(name, namespace)] declared in the header of a Turtle file"""
+    prefixes = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            m = _PREFIX.match(line)
+            if not m:
+                break
+            prefixes.append(m.groups())
+    return prefixes
+
+
+def merge_prefixes(files):
+    """{name: namespace} for all files, one name per namespace"""
+    names = dict(vocab.PREFIXES)
+    namespaces = set(names.values())
+    for path in files:
+        for name, ns in read_prefixes(path):
+            if ns in namespaces:
+                continue
+            candidate, n = name, 1
+            while candidate in names:
+                n += 1
+                candidate = f"{name}_{n}"
+            names[candidate] = ns
+            namespaces.add(ns)
+    return names
+
+
+def triple_digest(triple):
+    """8-byte digest of a triple, for deduplication"""
+    return int.from_bytes(hashlib.blake2b("\x00".join(triple).encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def _content_key(subject, triples):
+    """Digest of a node's own properties; "x" and "x"^^xsd:string are the same literal"""
+    plain = f"^^<{XSD}string>"
+    props = sorted(f"{p} {o[:-len(plain)] if o.endswith(plain) else o}" for s, p, o in triples if s == subject)
+    return hashlib.blake2b("\n".join(props).encode("utf-8"), digest_size=16).digest()
+
+
+def shared_renames(files):
+    """{IRI: IRI of the first node with the same content} for repeated Projects and PersonalDataElements"""
+    kinds = {vocab.PROJECT, vocab.PERSONAL_DATA_ELEMENT}
+    first, renames = {}, {}
+    for path in files:
+        for subject, triples in iter_statements(path):
+            if subject is None or subject.startswith("_:"):
+                continue
+            types = {o for s, p, o in triples if s == subject and p == vocab.TYPE} & kinds
+            if not types:
+                continue
+            kept = first.setdefault((min(types), _content_key(subject, triples)), subject)
+            if kept != subject:
+                renames[subject] = kept
+    return renames
+
+
+def dataset_files(dataset, sites=None):
+    """Graph files to merge for a dataset, the shared registry once at the end"""
+    registry = data_elements_path()
+    files = []
+    uses_registry = False
+    for site in read_sites(dataset):
+        if sites and site not in sites:
+            continue
+        if not site_paths(dataset, site)["nidm"].exists():
+            logger.warning(f"{dataset}/{site}: no BIDS NIDM file, skipping")
+            continue
+        site_files = site_graph_files(dataset, site)
+        uses_registry = uses_registry or registry in site_files
+        files.extend(f for f in site_files if f != registry)
+    return files + [registry] if uses_registry else files
+
+
+def merge(files, output, fmt="ttl"):
+    """Stream ``files`` into ``output``; return (triples written, duplicates dropped)"""
+    renames = shared_renames(files)
+    if renames:
+        logger.info(f"Collapsing {len(renames)} repeated Projects and data elements")
+    output = Path(output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    tmp = output.with_suffix(f".{os.getpid()}.tmp")
+    seen = set()
+    written = dropped = 0
+    with open(tmp, "w", encoding="utf-8") as out:
+        writer = None
+        if fmt == "ttl":
+            writer = TurtleWriter(out, merge_prefixes(files))
+            writer.write_prefixes()
+        for i, path in enumerate(files):
+            for subject, triples in iter_statements(path, bnode_prefix=f"f{i}b"):
+                if subject is None:
+                    continue
+                blocks = {}
+                for triple in triples:
+                    if triple[0] in renames:
+                        # The kept node's own definition says the same
+                        dropped += 1
+                        continue
+                    if renames:
+                        triple = tuple(renames.get(t, t) for t in triple)
+                    if not triple[0].startswith("_:") and not UUID_NODE.fullmatch(triple[0]):
+                        digest = triple_digest(triple)
+                        if digest in seen:
+                            dropped += 1
+                            continue
+                        seen.add(digest)
+                    blocks.setdefault(triple[0], []).append(triple[1:])
+                    written += 1
+                for s, props in blocks.items():
+                    if writer is not None:
+                        writer.write_subject(s, props)
+                    else:
+                        out.writelines(f"{s} {p} {o} .\n" for p, o in props)
+            logger.info(f"Merged {path.name} ({written} triples so far)")
+    os.replace(tmp, output)
+    return written, dropped
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Merge a dataset's site graphs into one file")
+    parser.add_argument("dataset", choices=sorted(DATASETS))
+    parser.add_argument("--sites", nargs="+", help="Only these sites")
+    parser.add_argument("--format", choices=FORMATS, default="ttl", help="ttl (Turtle) or nt (N-Triples)")
+    parser.add_argument("-o", "--output", type=Path, help="Output file (default: nidm_outputs/{dataset}_all.{format})")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    output = args.output or OUTPUT_ROOT / f"{args.dataset}_all.{args.format}"
+    files = dataset_files(args.dataset, args.sites)
+    if not files:
+        logger.error(f"No graphs to merge for {args.dataset}")
+        return 1
+    written, dropped = merge(files, output, args.format)
+    logger.info(f"Wrote {written} triples ({FORMATS[args.format]}) to {output}; "
+                f"{dropped} duplicate triples dropped")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,381 @@
+#!/usr/bin/env python
+"""
+Compact in-memory model of the NIDM site graphs for reporting and checks.
+
+Counting subjects, listing a subject's scans or pulling one phenotype
+variable used to need the whole graph in memory, either in rdflib (hundreds
+of bytes per triple) or as export.load_graph's nested dicts. This module
+streams a site's graph files (phenotype.site_graph_files) once and keeps
+only four tables:
+
+    subjects       agents with an ndar:src_subject_id
+    sessions       nidm:Session nodes and their subject
+    acquisitions   AcquisitionObjects and their properties
+    assessments    assessment objects and their data element values
+
+Every term is interned once in a Terms table, which all sites loaded
+together share, so an IRI or value repeated across sites is stored once.
+Rows are integer columns in ``array`` objects. A row's properties are
+(predicate, object) id pairs in one flat array with per-row offsets. The
+activities, associations and sessions that link an object to its subject
+are resolved at load time and then dropped. The per-subject index is built
+on the first per-subject query.
+
+Like iter_statements, the loader expects all of a node's properties in one
+statement block, which is how rdflib and the pipeline's own writers lay out
+the files.
+
+Usage:
+    python -m pipeline.model                           # per-site counts for all datasets
+    python -m pipeline.model abide1 --sites Caltech --subject 51456
+    python -m pipeline.model abide1 --variable AGE_AT_SCAN
+"""
+import argparse
+import logging
+import sys
+import time
+import tracemalloc
+from array import array
+from collections import defaultdict
+
+from . import vocab
+from .config import DATASETS, read_sites, site_paths
+from .export import LINKS, column_name, local_name, typed_value
+from .phenotype import normalize_subject_id, site_graph_files
+from .store import parse_term
+from .turtle import iri, iter_statements, split_literal
+
+logger = logging.getLogger(__name__)
+
+NONE = -1  # row value for a missing link, e.g. an acquisition without a session
+
+
+def _iri(term):
+    return iri(term) if term.startswith("<") else term
+
+
+class Terms:
+    """Interned term table: each distinct term is stored once and referred to by its index"""
+
+    __slots__ = ("_ids", "_terms")
+
+    def __init__(self):
+        self._ids = {}
+        self._terms = []
+
+    def __len__(self):
+        return len(self._terms)
+
+    def __getitem__(self, i):
+        return self._terms[i]
+
+    def id(self, term):
+        i = self._ids.get(term)
+        if i is None:
+            i = self._ids[term] = len(self._terms)
+            self._terms.append(term)
+        return i
+
+    def get(self, term):
+        """Id of ``term``, or NONE if it was never interned"""
+        return self._ids.get(term, NONE)
+
+
+class _Table:
+    """Rows of nodes with a subject, a session and (predicate, object) properties"""
+
+    __slots__ = ("node", "subject", "session", "offsets", "props")
+
+    def __init__(self):
+        self.node = array("i")
+        self.subject = array("i")
+        self.session = array("i")
+        self.offsets = array("I", [0])
+        self.props = array("i")  # predicate, object, predicate, object, ...
+
+    def __len__(self):
+        return len(self.node)
+
+    def add(self, node, props):
+        self.node.append(node)
+        for p, o in props:
+            self.props.append(p)
+            self.props.append(o)
+        self.offsets.append(len(self.props))
+
+    def row_props(self, row):
+        start, end = self.offsets[row], self.offsets[row + 1]
+        props = self.props[start:end]
+        return list(zip(props[::2], props[1::2]))
+
+
+class Subject:
+    """One subject of a SiteModel; its rows are looked up through the model's per-subject index"""
+
+    __slots__ = ("model", "subject_id")
+
+    def __init__(self, model, subject_id):
+        self.model = model
+        self.subject_id = subject_id
+
+    @property
+    def iri(self):
+        """IRI of the subject's agent (the first one, if the graph has several with this ID)"""
+        m = self.model
+        return _iri(m.terms[m.subject_nodes[m.subject_ids.index(self.subject_id)]])
+
+    def sessions(self):
+        """IRIs of the subject's sessions"""
+        m = self.model
+        return [_iri(m.terms[m.session_nodes[row]]) for row in m._rows("sessions").get(self.subject_id, ())]
+
+    def acquisitions(self):
+        """[{column: value}] of the subject's scans, with their iri and session; columns as in export.column_name"""
+        return [self.model._acquisition(row) for row in self.model._rows("acquisitions").get(self.subject_id, ())]
+
+    def phenotype(self):
+        """{variable: [values]} of the subject's assessments"""
+        values = defaultdict(list)
+        for row in self.model._rows("assessments").get(self.subject_id, ()):
+            for variable, value in self.model._assessment_values(row):
+                values[variable].append(value)
+        return dict(values)
+
+
+class SiteModel:
+    """Subjects, sessions, acquisitions and assessments of one site graph"""
+
+    __slots__ = ("dataset", "site", "terms", "projects", "triples", "subject_ids", "subject_nodes",
+                 "session_nodes", "session_subject", "acquisitions", "assessments", "elements", "_by_subject")
+
+    def __init__(self, dataset, site, terms=None):
+        self.dataset = dataset
+        self.site = site
+        self.terms = terms if terms is not None else Terms()
+        self.projects = 0
+        self.triples = 0
+        self.subject_ids = []  # subject IDs, normalized as in phenotype.normalize_subject_id
+        self.subject_nodes = array("i")
+        self.session_nodes = array("i")
+        self.session_subject = array("i")
+        self.acquisitions = _Table()
+        self.assessments = _Table()
+        self.elements = {}  # {data element term id: variable name}
+        self._by_subject = {}
+
+    def load(self, files):
+        """Stream ``files`` into the tables; return self"""
+        t = self.terms.id
+        agents = {}  # agent term id -> subject row
+        qualified = defaultdict(list)  # activity -> association nodes
+        association_agent = {}
+        part_of = {}  # activity -> session node
+        generated = {"acquisitions": array("i"), "assessments": array("i")}  # activity of each row
+        sessions = {}
+        for i, path in enumerate(files):
+            for subject, triples in iter_statements(path, bnode_prefix=f"f{i}b"):
+                if subject is None:
+                    continue
+                self.triples += len(triples)
+                types = set()
+                for s, p, o in triples:
+                    if p == vocab.TYPE and s == subject:
+                        types.add(o)
+                    elif p == vocab.QUALIFIED_ASSOCIATION:
+                        qualified[t(s)].append(t(o))
+                    elif p == vocab.PROV_AGENT_PROP:
+                        association_agent[t(s)] = t(o)
+                    elif p == vocab.IS_PART_OF and s == subject:
+                        part_of[t(s)] = t(o)
+                node = t(subject)
+                if vocab.PROJECT in types:
+                    self.projects += 1
+                if vocab.SESSION in types:
+                    sessions.setdefault(node, len(sessions))
+                if vocab.PERSONAL_DATA_ELEMENT in types:
+                    props = {p: o for s, p, o in triples if s == subject}
+                    name = props.get(vocab.SOURCE_VARIABLE) or props.get(vocab.LABEL)
+                    self.elements[node] = split_literal(name)[0] if name else local_name(subject)
+                if vocab.ACQUISITION_OBJECT in types:
+                    name = "assessments" if vocab.ASSESSMENT_OBJECT in types else "acquisitions"
+                    activity = NONE
+                    props = []
+                    for s, p, o in triples:
+                        if s != subject:
+                            continue
+                        if p == vocab.WAS_GENERATED_BY:
+                            activity = t(o)
+                        elif p not in LINKS and not o.startswith("_:"):
+                            props.append((t(p), t(o)))
+                    getattr(self, name).add(node, props)
+                    generated[name].append(activity)
+                for s, p, o in triples:
+                    if p == vocab.SRC_SUBJECT_ID and s == subject and node not in agents:
+                        agents[node] = len(self.subject_ids)
+                        self.subject_ids.append(normalize_subject_id(split_literal(o)[0]))
+                        self.subject_nodes.append(node)
+
+        def activity_subject(activity):
+            for association in qualified.get(activity, ()):
+                row = agents.get(association_agent.get(association), NONE)
+                if row != NONE:
+                    return row
+            return NONE
+
+        session_subject = [NONE] * len(sessions)
+        for name in ("acquisitions", "assessments"):
+            table = getattr(self, name)
+            for activity in generated[name]:
+                subject = activity_subject(activity)
+                session = sessions.get(part_of.get(activity), NONE)
+                table.subject.append(subject)
+                table.session.append(session)
+                if session != NONE and session_subject[session] == NONE:
+                    session_subject[session] = subject
+        self.session_nodes.extend(sessions)
+        self.session_subject.extend(session_subject)
+        return self
+
+    def _rows(self, name):
+        """{subject ID: [table rows]} for "sessions", "acquisitions" or "assessments", built on first use"""
+        if name not in self._by_subject:
+            column = self.session_subject if name == "sessions" else getattr(self, name).subject
+            rows = defaultdict(lambda: array("i"))
+            for row, subject in enumerate(column):
+                if subject != NONE:
+                    rows[self.subject_ids[subject]].append(row)
+            self._by_subject[name] = dict(rows)
+        return self._by_subject[name]
+
+    def _acquisition(self, row):
+        table, terms = self.acquisitions, self.terms
+        session = table.session[row]
+        values = {"iri": _iri(terms[table.node[row]]),
+                  "session": _iri(terms[self.session_nodes[session]]) if session != NONE else None}
+        for p, o in table.row_props(row):
+            values.setdefault(column_name(terms[p]), typed_value(terms[o]))
+        return values
+
+    def _assessment_values(self, row):
+        for p, o in self.assessments.row_props(row):
+            if p in self.elements:
+                yield self.elements[p], typed_value(self.terms[o])
+
+    def counts(self):
+        """Node counts, with the keys verify.scan_file and verify.check_bids use"""
+        assessed = {s for s in self.assessments.subject if s != NONE}
+        return {"projects": self.projects, "subjects": len(set(self.subject_ids)),
+                "sessions": len(self.session_nodes), "acquisition_objects": len(self.acquisitions),
+                "assessments": len(self.assessments), "assessed_subjects": len({self.subject_ids[s] for s in assessed}),
+                "triples": self.triples}
+
+    def subjects(self):
+        """Sorted subject IDs"""
+        return sorted(set(self.subject_ids))
+
+    def subject(self, subject_id):
+        """The Subject with ``subject_id``; KeyError if the site has none"""
+        subject_id = normalize_subject_id(subject_id)
+        if subject_id not in self.subject_ids:
+            raise KeyError(subject_id)
+        return Subject(self, subject_id)
+
+    def assessed_subjects(self):
+        """IDs of the subjects with at least one assessment"""
+        return {self.subject_ids[s] for s in self.assessments.subject if s != NONE}
+
+    def variables(self):
+        """Names of the data elements with at least one value"""
+        used = {p for p in self.assessments.props[::2]}
+        return sorted({name for element, name in self.elements.items() if element in used})
+
+    def phenotype(self, variable):
+        """{subject ID: [values]} of one phenotype variable"""
+        elements = {element for element, name in self.elements.items() if name == variable}
+        table, values = self.assessments, defaultdict(list)
+        for row, subject in enumerate(table.subject):
+            for p, o in table.row_props(row):
+                if p in elements:
+                    values[self.subject_ids[subject] if subject != NONE else None].append(typed_value(self.terms[o]))
+        return dict(values)
+
+    def acquisition_values(self, prop):
+        """[(subject ID, value)] of one acquisition property, e.g. dicom:RepetitionTime"""
+        p = self.terms.get(parse_term(prop))
+        table, result = self.acquisitions, []
+        for row, subject in enumerate(table.subject):
+            for q, o in table.row_props(row):
+                if q == p:
+                    result.append((self.subject_ids[subject] if subject != NONE else None,
+                                   typed_value(self.terms[o])))
+        return result
+
+
+def load_site(dataset, site, terms=None):
+    """SiteModel of a site's most complete graph"""
+    return SiteModel(dataset, site, terms).load(site_graph_files(dataset, site))
+
+
+def load_outputs(pairs):
+    """{(dataset, site): SiteModel} of the converted sites in ``pairs``, sharing one Terms table"""
+    terms = Terms()
+    models = {}
+    for dataset, site in pairs:
+        if site_paths(dataset, site)["nidm"].exists():
+            models[(dataset, site)] = load_site(dataset, site, terms)
+    return models
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Summarize the NIDM outputs from a compact in-memory model")
+    parser.add_argument("datasets", nargs="*", help="Datasets (default: all)")
+    parser.add_argument("--sites", nargs="+", help="Only these sites")
+    parser.add_argument("--subject", help="Show this subject's sessions, scans and phenotype values")
+    parser.add_argument("--variable", help="Show this phenotype variable for every subject")
+    parser.add_argument("--memory", action="store_true", help="Also report the memory the model takes (slower)")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    unknown = [d for d in args.datasets if d not in DATASETS]
+    if unknown:
+        parser.error(f"Unknown dataset(s): {', '.join(unknown)}")
+
+    pairs = [(dataset, site) for dataset in (args.datasets or sorted(DATASETS))
+             for site in read_sites(dataset) if not args.sites or site in args.sites]
+    if args.memory:
+        tracemalloc.start()
+    start = time.time()
+    models = load_outputs(pairs)
+    elapsed = time.time() - start
+    memory = tracemalloc.get_traced_memory()[0] if args.memory else None
+    tracemalloc.stop()
+
+    for (dataset, site), model in models.items():
+        key = f"{dataset}/{site}"
+        if args.subject:
+            try:
+                subject = model.subject(args.subject)
+            except KeyError:
+                continue
+            print(f"{key} {subject.subject_id} {subject.iri}")
+            for session in subject.sessions():
+                print(f"    session {session}")
+            for scan in subject.acquisitions():
+                print(f"    scan    {scan.get('nfo_filename', scan['iri'])}")
+            for variable, values in sorted(subject.phenotype().items()):
+                print(f"    {variable:24s} {', '.join(str(v) for v in values)}")
+        elif args.variable:
+            for subject_id, values in sorted(model.phenotype(args.variable).items(), key=lambda kv: str(kv[0])):
+                print(f"{key}\t{subject_id}\t{', '.join(str(v) for v in values)}")
+        else:
+            counts = model.counts()
+            print(f"{key:28s} {counts['subjects']:4d} subjects {counts['sessions']:4d} sessions "
+                  f"{counts['acquisition_objects']:5d} scans {counts['assessments']:5d} assessments")
+    triples = sum(m.triples for m in models.values())
+    terms = len(next(iter(models.values())).terms) if models else 0
+    logger.info(f"Loaded {len(models)} sites ({triples} triples, {terms} distinct terms) in {elapsed:.1f} seconds"
+                + (f", {memory / 1e6:.1f} MB ({memory / max(triples, 1):.0f} bytes per triple)" if memory else ""))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
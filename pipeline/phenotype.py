@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+"""
+Batch phenotype integration.
+
+csv2nidm re-parses the whole phenotype CSV and mapping JSON for every site and
+scans all rows to find that site's subjects. This stage loads the CSV and the
+mapping once per dataset, indexes the rows by subject ID (SUB_ID /
+participant_id) and, for each site, adds an assessment for every subject found
+in the site's BIDS NIDM graph, in the same shape csv2nidm produces: a Session
+in the project, an instrument-based-assessment associated with the subject
+agent and an assessment-instrument entity holding the values, keyed by
+PersonalDataElements from the shared registry (elements.py,
+nidm_outputs/data_elements.ttl), which is rewritten on each run.
+
+In "full" output mode {site}_phenotype.ttl is the BIDS graph plus these
+additions. In "delta" mode only the additions are written, to
+{site}_phenotype_delta.ttl; they reference the BIDS graph's project and
+subject IRIs, so the site graph is the union of the two files
+(site_graph_files() / iter_site_triples(), or ``--materialize`` to write it).
+
+Usage:
+    python -m pipeline.phenotype [DATASET ...] [--sites SITE ...] [--output delta]
+    python -m pipeline.phenotype abide1 --materialize   # nidm + delta -> phenotype.ttl
+"""
+import argparse
+import csv
+import logging
+import os
+import sys
+import threading
+import uuid
+from itertools import chain
+from pathlib import Path
+
+from . import vocab
+from .config import DATASETS, data_elements_path, read_sites, site_paths
+from .elements import element_iri, load_mapping, write_registry
+from .mappings import is_missing_code, missing_codes, typed_literal
+from .turtle import TurtleReader, TurtleWriter, iter_statements, split_literal
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_subject_id(value):
+    """Canonical subject ID: no 'sub-' prefix, no leading zeros"""
+    value = str(value).strip()
+    if value.startswith("sub-"):
+        value = value[4:]
+    return value.lstrip("0") or value
+
+
+class PhenotypeIndex:
+    """A dataset's phenotype CSV and mapping, loaded once and indexed by subject"""
+
+    def __init__(self, csv_file, json_map, subject_column):
+        self.csv_file = Path(csv_file)
+        self.json_map = Path(json_map)
+        by_variable = {}
+        for dd_key, variable, entry in load_mapping(self.json_map):
+            missing = missing_codes(entry.get("missingValues"))
+            by_variable.setdefault(variable, (element_iri(dd_key, variable), entry.get("valueType"), missing))
+
+        self.rows = {}
+        with open(self.csv_file, "r", newline="", encoding="utf-8-sig") as f:
+            reader = csv.reader(f)
+            header = [col.strip() for col in next(reader)]
+            if subject_column not in header:
+                raise ValueError(f"{self.csv_file} has no {subject_column} column")
+            id_col = header.index(subject_column)
+            for row in reader:
+                if len(row) <= id_col or not row[id_col].strip():
+                    continue
+                self.rows.setdefault(normalize_subject_id(row[id_col]), []).append(row)
+
+        # (column index, data element IRI, valueType, missing value codes) for mapped columns only
+        self.elements = [(i,) + by_variable[col] for i, col in enumerate(header) if col in by_variable]
+        unmapped = [col for col in header if col not in by_variable]
+        if unmapped:
+            logger.info(f"{self.csv_file.name}: {len(unmapped)} columns have no mapping entry and are skipped")
+        logger.info(f"Indexed {sum(len(r) for r in self.rows.values())} rows for "
+                    f"{len(self.rows)} subjects from {self.csv_file.name}")
+
+    def assessment_blocks(self, project, agent, row):
+        """Session, assessment activity and assessment entity for one CSV row"""
+        session = f"<{vocab.NIIRI}{uuid.uuid1()}>"
+        activity = f"<{vocab.NIIRI}{uuid.uuid1()}>"
+        entity = f"<{vocab.NIIRI}{uuid.uuid1()}>"
+        yield session, [(vocab.TYPE, vocab.SESSION), (vocab.TYPE, vocab.PROV_ACTIVITY),
+                        (vocab.IS_PART_OF, project)]
+        yield activity, [(vocab.TYPE, vocab.ASSESSMENT), (vocab.TYPE, vocab.ACQUISITION),
+                         (vocab.TYPE, vocab.PROV_ACTIVITY), (vocab.IS_PART_OF, session),
+                         (vocab.QUALIFIED_ASSOCIATION, [(vocab.TYPE, vocab.PROV_ASSOCIATION),
+                                                        (vocab.PROV_AGENT_PROP, agent),
+                                                        (vocab.HAD_ROLE, vocab.SUBJECT_ROLE)])]
+        props = [(vocab.TYPE, vocab.ASSESSMENT_OBJECT), (vocab.TYPE, vocab.ACQUISITION_OBJECT),
+                 (vocab.TYPE, vocab.PROV_ENTITY)]
+        for i, element, value_type, missing in self.elements:
+            value = row[i].strip() if i < len(row) else ""
+            if value and not is_missing_code(value, missing):
+                props.append((element, typed_literal(value, value_type)))
+        props.append((vocab.WAS_GENERATED_BY, activity))
+        yield entity, props
+
+
+def site_subjects(nidm_file):
+    """(project IRI, {subject ID: agent IRI}) from a site's BIDS NIDM graph"""
+    project = None
+    agents = {}
+    for subject, triples in iter_statements(nidm_file):
+        for s, p, o in triples:
+            if s != subject:
+                continue
+            if p == vocab.TYPE and o == vocab.PROJECT:
+                project = subject
+            elif p == vocab.SRC_SUBJECT_ID:
+                agents[normalize_subject_id(split_literal(o)[0])] = subject
+    if project is None:
+        raise ValueError(f"No nidm:Project in {nidm_file}")
+    return project, agents
+
+
+def write_additions(f, index, project, agents):
+    """Write the phenotype additions for one site; return the number of subjects matched"""
+    writer = TurtleWriter(f, vocab.PREFIXES)
+    writer.write_prefixes()
+    matched = 0
+    for subject_id, agent in sorted(agents.items()):
+        rows = index.rows.get(subject_id, [])
+        if rows:
+            matched += 1
+        for row in rows:
+            for subject, props in index.assessment_blocks(project, agent, row):
+                writer.write_subject(subject, props)
+    return matched
+
+
+OUTPUT_MODES = ("full", "delta")
+
+
+def _atomic_write(path):
+    return path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+
+
+def _copy_into(out, path):
+    with open(path, "r", encoding="utf-8") as src:
+        for chunk in iter(lambda: src.read(1 << 20), ""):
+            out.write(chunk)
+
+
+def integrate_site(dataset, site, index=None, output="full"):
+    """Add phenotype data for a site, as a full graph or a delta; return subjects matched"""
+    if output not in OUTPUT_MODES:
+        raise ValueError(f"Unknown phenotype output mode: {output}")
+    index = index or get_index(dataset)
+    paths = site_paths(dataset, site)
+    project, agents = site_subjects(paths["nidm"])
+    target = paths["phenotype"] if output == "full" else paths["phenotype_delta"]
+    tmp = _atomic_write(target)
+    with open(tmp, "w", encoding="utf-8") as out:
+        if output == "full":
+            _copy_into(out, paths["nidm"])
+            out.write("\n")
+        matched = write_additions(out, index, project, agents)
+    os.replace(tmp, target)
+    # Only one representation is kept so they can never disagree;
+    # --materialize rebuilds the full file from nidm + delta
+    stale = paths["phenotype_delta"] if output == "full" else paths["phenotype"]
+    stale.unlink(missing_ok=True)
+    logger.info(f"{dataset}/{site}: phenotype data added for {matched} of {len(agents)} subjects "
+                f"({target.name})")
+    return matched
+
+
+def site_graph_files(dataset, site):
+    """Files whose union is the site's most complete graph, data element registry included"""
+    paths = site_paths(dataset, site)
+    if paths["phenotype_delta"].exists():
+        files = [paths["nidm"], paths["phenotype_delta"]]
+    elif paths["phenotype"].exists():
+        files = [paths["phenotype"]]
+    else:
+        return [paths["nidm"]]
+    registry = data_elements_path()
+    return files + [registry] if registry.exists() else files
+
+
+def iter_site_triples(dataset, site):
+    """Stream the triples of the site graph, unioning the BIDS graph and delta on demand"""
+    files = site_graph_files(dataset, site)
+    return chain.from_iterable(TurtleReader(f, bnode_prefix=f"f{i}b") for i, f in enumerate(files))
+
+
+def materialize(dataset, site):
+    """Write {site}_phenotype.ttl from the BIDS graph and the delta"""
+    paths = site_paths(dataset, site)
+    tmp = _atomic_write(paths["phenotype"])
+    with open(tmp, "w", encoding="utf-8") as out:
+        _copy_into(out, paths["nidm"])
+        out.write("\n")
+        _copy_into(out, paths["phenotype_delta"])
+    os.replace(tmp, paths["phenotype"])
+    return paths["phenotype"]
+
+
+_indexes = {}
+_index_lock = threading.Lock()
+
+
+def get_index(dataset):
+    """Load (once per process) the phenotype index for a dataset"""
+    with _index_lock:
+        config = DATASETS[dataset]
+        key = (dataset, os.stat(config["phenotype_csv"]).st_mtime_ns, os.stat(config["json_map"]).st_mtime_ns)
+        if key not in _indexes:
+            _indexes[key] = PhenotypeIndex(config["phenotype_csv"], config["json_map"],
+                                           config["subject_column"])
+        return _indexes[key]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Add phenotype data to every site of a dataset in one run")
+    parser.add_argument("datasets", nargs="*", help="Datasets (default: those with a phenotype CSV)")
+    parser.add_argument("--sites", nargs="+", help="Only these sites")
+    parser.add_argument("--output", choices=OUTPUT_MODES, default="full",
+                        help="full: {site}_phenotype.ttl; delta: only the additions in {site}_phenotype_delta.ttl")
+    parser.add_argument("--materialize", action="store_true",
+                        help="Write {site}_phenotype.ttl from existing nidm + delta files instead")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    datasets = args.datasets or [d for d in sorted(DATASETS) if DATASETS[d]["phenotype_csv"]]
+    if not args.materialize:
+        path, count = write_registry()
+        logger.info(f"Wrote {count} data elements to {path}")
+    failed = 0
+    for dataset in datasets:
+        index = None if args.materialize else get_index(dataset)
+        for site in read_sites(dataset):
+            if args.sites and site not in args.sites:
+                continue
+            paths = site_paths(dataset, site)
+            if not paths["nidm"].exists():
+                logger.warning(f"{dataset}/{site}: no BIDS NIDM file, skipping")
+                continue
+            try:
+                if args.materialize:
+                    if paths["phenotype_delta"].exists():
+                        logger.info(f"{dataset}/{site}: wrote {materialize(dataset, site).name}")
+                else:
+                    integrate_site(dataset, site, index, output=args.output)
+            except Exception as e:
+                logger.error(f"{dataset}/{site}: phenotype integration failed: {e}")
+                failed += 1
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
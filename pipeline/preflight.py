@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+"""
+Pre-flight check and index of the BIDS sites.
+
+Several sites failed only deep inside a long bidsmri2nidm run: NYU_1/NYU_2
+with an IndexError in get_bvec() (diffusion images without bvec files) and
+GU_1 with a UnicodeDecodeError in participants.tsv. This stage walks each site
+once, in parallel, reading only directory metadata, participants.tsv and
+dataset_description.json. It builds a compact index (subjects, sessions,
+images per modality and their bytes, sidecars, bvec/bval pairing,
+participants.tsv encoding and columns) and flags problems:
+
+    error    conversion would fail; run_all does not schedule the site
+    warning  conversion runs but the output may be incomplete
+
+The index is cached as JSON under .pipeline/preflight/<dataset>/<site>.json
+and keyed by the tree listing digest, so unchanged sites skip re-reading their
+TSV. The same digest seeds the build manifest, so the conversion step does
+not walk the tree again.
+
+Usage:
+    python -m pipeline.preflight [DATASET ...] [--sites SITE ...] [--include-excluded]
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from .config import DATASETS, STATE_ROOT, read_sites, site_paths
+from .manifest import listing_digest, seed_tree_digest, walk_tree
+from .scheduler import default_workers
+
+logger = logging.getLogger(__name__)
+
+INDEX_VERSION = 2
+IMAGE_EXTENSIONS = (".nii.gz", ".nii")
+MODALITIES = {"anat", "func", "dwi", "fmap", "perf", "pet", "meg", "eeg"}
+_ENTITY = re.compile(r"([a-zA-Z0-9]+)-([a-zA-Z0-9]+)")
+_ANNEX_SIZE = re.compile(r"-s(\d+)--")
+
+
+def index_path(dataset, site):
+    return STATE_ROOT / "preflight" / dataset / f"{site}.json"
+
+
+def fingerprint_size(fingerprint):
+    """File size from a walk_tree() fingerprint; annexed files carry it in their key"""
+    kind, _, rest = fingerprint.partition("\0")
+    if kind == "link":
+        m = _ANNEX_SIZE.search(rest)
+        return int(m.group(1)) if m else 0
+    return int(kind)
+
+
+def split_name(filename):
+    """(entities dict, suffix, extension) of a BIDS filename"""
+    for ext in IMAGE_EXTENSIONS + (".json", ".bvec", ".bval", ".tsv"):
+        if filename.endswith(ext):
+            stem = filename[:-len(ext)]
+            break
+    else:
+        stem, ext = os.path.splitext(filename)
+    parts = stem.split("_")
+    entities = dict(m.groups() for m in map(_ENTITY.fullmatch, parts[:-1]) if m)
+    return entities, parts[-1], ext
+
+
+def inherited(image, files, candidates, ext):
+    """True if a file with extension ``ext`` applies to ``image``.
+
+    ``files`` is the set of all paths in the site; ``candidates`` are the
+    split_name()d files above the datatype level that may be inherited.
+    """
+    for image_ext in IMAGE_EXTENSIONS:
+        if image.endswith(image_ext) and image[:-len(image_ext)] + ext in files:
+            return True
+    image_dir = os.path.dirname(image)
+    entities, suffix, _ = split_name(os.path.basename(image))
+    for c_dir, c_entities, c_suffix, c_ext in candidates:
+        if c_ext != ext or c_suffix != suffix:
+            continue
+        if c_dir and image_dir != c_dir and not image_dir.startswith(c_dir + os.sep):
+            continue
+        if all(entities.get(k) == v for k, v in c_entities.items()):
+            return True
+    return False
+
+
+def read_participants(tsv_file):
+    """Encoding, columns and subject IDs of participants.tsv, read once as bytes"""
+    data = tsv_file.read_bytes()
+    info = {"encoding": "utf-8", "decode_error": None}
+    try:
+        text = data.decode("utf-8-sig")
+    except UnicodeDecodeError as e:
+        info["encoding"] = "latin-1"
+        info["decode_error"] = f"byte 0x{data[e.start]:02x} at position {e.start} is not valid UTF-8"
+        text = data.decode("latin-1")
+    lines = [line for line in text.splitlines() if line.strip()]
+    header = lines[0].split("\t") if lines else []
+    info["columns"] = [col.strip() for col in header]
+    info["padded_columns"] = [col for col in header if col != col.strip()]
+    id_col = info["columns"].index("participant_id") if "participant_id" in info["columns"] else 0
+    info["subjects"] = sorted({line.split("\t")[id_col].strip() for line in lines[1:]
+                               if len(line.split("\t")) > id_col})
+    return info
+
+
+def build_index(site_dir, entries):
+    """Index and problems for a site from its walk_tree() listing"""
+    subjects = defaultdict(lambda: {"sessions": set(), "modalities": defaultdict(int), "image_bytes": 0})
+    images, candidates = [], []
+    files = set()
+    top_level = set()
+    for rel, fingerprint in entries:
+        files.add(rel)
+        parts = rel.split(os.sep)
+        if len(parts) == 1:
+            top_level.add(rel)
+        name = parts[-1]
+        if name.endswith((".json", ".bvec", ".bval")) and (len(parts) < 2 or parts[-2] not in MODALITIES):
+            candidates.append((os.path.dirname(rel),) + split_name(name))
+        if not parts[0].startswith("sub-") or len(parts) < 3:
+            continue
+        subject = subjects[parts[0]]
+        if parts[1].startswith("ses-"):
+            subject["sessions"].add(parts[1])
+        if parts[-2] in MODALITIES and name.endswith(IMAGE_EXTENSIONS):
+            subject["modalities"][parts[-2]] += 1
+            subject["image_bytes"] += fingerprint_size(fingerprint)
+            images.append(rel)
+
+    problems = []
+    index = {
+        "subjects": {sub: {"sessions": sorted(info["sessions"]), "modalities": dict(info["modalities"]),
+                           "image_bytes": info["image_bytes"]}
+                     for sub, info in sorted(subjects.items())},
+        "images": len(images),
+        "image_bytes": sum(info["image_bytes"] for info in subjects.values()),
+        "missing_sidecars": [],
+        "unpaired_dwi": [],
+        "participants": None,
+    }
+    if not subjects:
+        problems.append(("error", "no-subjects", "no sub-* directories with images"))
+    if "dataset_description.json" not in top_level:
+        problems.append(("error", "no-description", "dataset_description.json is missing"))
+
+    for image in images:
+        if not inherited(image, files, candidates, ".json"):
+            index["missing_sidecars"].append(image)
+        if image.split(os.sep)[-2] == "dwi":
+            missing = [ext for ext in (".bvec", ".bval") if not inherited(image, files, candidates, ext)]
+            if missing:
+                index["unpaired_dwi"].append(image)
+    if index["unpaired_dwi"]:
+        problems.append(("error", "unpaired-dwi",
+                         f"{len(index['unpaired_dwi'])} diffusion images without bvec/bval "
+                         f"(e.g. {index['unpaired_dwi'][0]})"))
+    if index["missing_sidecars"]:
+        problems.append(("warning", "missing-sidecar",
+                         f"{len(index['missing_sidecars'])} images without a JSON sidecar "
+                         f"(e.g. {index['missing_sidecars'][0]})"))
+
+    tsv = Path(site_dir) / "participants.tsv"
+    if "participants.tsv" not in top_level:
+        problems.append(("warning", "no-participants", "participants.tsv is missing"))
+    else:
+        try:
+            participants = read_participants(tsv)
+        except OSError as e:
+            # e.g. an annexed file whose content was never fetched
+            problems.append(("error", "tsv-unreadable", f"participants.tsv: {e}"))
+            index["problems"] = problems
+            return index
+        index["participants"] = {k: v for k, v in participants.items() if k != "subjects"}
+        index["participants"]["rows"] = len(participants["subjects"])
+        if participants["decode_error"]:
+            problems.append(("error", "tsv-encoding", f"participants.tsv: {participants['decode_error']}"))
+        if participants["padded_columns"]:
+            problems.append(("warning", "tsv-header", "participants.tsv columns with surrounding spaces: "
+                             + ", ".join(repr(c) for c in participants["padded_columns"])))
+        listed = {s if s.startswith("sub-") else f"sub-{s}" for s in participants["subjects"]}
+        unlisted = sorted(set(subjects) - listed)
+        if unlisted:
+            problems.append(("warning", "unlisted-subjects",
+                             f"{len(unlisted)} subject directories not in participants.tsv "
+                             f"(e.g. {unlisted[0]})"))
+    index["problems"] = problems
+    return index
+
+
+def check_site(dataset, site, use_cache=True):
+    """Scan (or load the cached index of) a site; return its index"""
+    site_dir = site_paths(dataset, site)["site_dir"]
+    if not site_dir.is_dir():
+        return {"dataset": dataset, "site": site, "problems": [("error", "no-site-dir",
+                                                                f"{site_dir} does not exist")]}
+    start = time.time()
+    entries = list(walk_tree(site_dir))
+    digest = listing_digest(entries)
+    seed_tree_digest(site_dir, digest)
+
+    path = index_path(dataset, site)
+    if use_cache and path.exists():
+        with open(path, "r") as f:
+            cached = json.load(f)
+        if cached.get("version") == INDEX_VERSION and cached.get("tree_digest") == digest:
+            return cached
+
+    index = build_index(site_dir, entries)
+    index.update({"version": INDEX_VERSION, "dataset": dataset, "site": site, "tree_digest": digest,
+                  "files": len(entries), "scan_seconds": round(time.time() - start, 3)})
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp, "w") as f:
+        json.dump(index, f, indent=1)
+    os.replace(tmp, path)
+    return index
+
+
+def errors(index):
+    return [message for severity, _, message in index["problems"] if severity == "error"]
+
+
+def check_sites(pairs, workers=None, use_cache=True):
+    """{(dataset, site): index} for ``pairs``, scanned in parallel"""
+    workers = workers or default_workers()[1]
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="preflight") as pool:
+        indexes = pool.map(lambda pair: check_site(*pair, use_cache=use_cache), pairs)
+        return dict(zip(pairs, indexes))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check BIDS sites for problems that would fail conversion")
+    parser.add_argument("datasets", nargs="*", help="Datasets (default: all)")
+    parser.add_argument("--sites", nargs="+", help="Only these sites")
+    parser.add_argument("--include-excluded", action="store_true",
+                        help="Also check sites excluded for known data issues")
+    parser.add_argument("--workers", type=int, help="Sites scanned concurrently")
+    parser.add_argument("--no-cache", action="store_true", help="Ignore cached indexes")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    unknown = [d for d in args.datasets if d not in DATASETS]
+    if unknown:
+        parser.error(f"Unknown dataset(s): {', '.join(unknown)}")
+
+    pairs = [(dataset, site) for dataset in (args.datasets or sorted(DATASETS))
+             for site in read_sites(dataset, include_excluded=args.include_excluded)
+             if not args.sites or site in args.sites]
+    start = time.time()
+    indexes = check_sites(pairs, args.workers, use_cache=not args.no_cache)
+    blocked = 0
+    for (dataset, site), index in indexes.items():
+        blocked += bool(errors(index))
+        subjects = len(index.get("subjects", {}))
+        print(f"{dataset:8s} {site:20s} {subjects:4d} subjects  {'BLOCKED' if errors(index) else 'ok'}")
+        for severity, code, message in index["problems"]:
+            print(f"    {severity:7s} {code}: {message}")
+    print(f"{len(pairs)} sites checked in {time.time() - start:.1f} seconds, {blocked} blocked")
+    return 1 if blocked else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+"""
+Process all sites of one or more datasets concurrently.
+
+Replaces the serial scripts/run_all/run_all_*.sh loops: every site's
+bidsmri2nidm -> phenotype chain is scheduled as a DAG, so steps from
+different sites share the CPU and I/O worker pools. Every stage and step is
+recorded in logs/telemetry.jsonl (see telemetry.py), and that history
+predicts each step's runtime: sites start longest-first and converter calls
+get timeouts scaled to their prediction (see costs.py). A converter whose
+output and CPU time stop advancing is killed and started again (see
+capture.py). The outputs are then checked by content (verify.py), and the
+run fails if any site does not pass.
+With --stage, sites are copied from the shared store to local scratch ahead
+of their conversion (see staging.py). With --deterministic-iris the graphs
+get content-derived node IRIs, so runs can be compared with diff.py.
+To spread a run over several nodes, submit it to jobqueue.py instead.
+
+Usage:
+    python -m pipeline.run_all                        # all datasets
+    python -m pipeline.run_all abide1 adhd200 --cpu-workers 16
+    python -m pipeline.run_all abide2 --sites ABIDEII-BNI_1 ABIDEII-EMC_1
+    python -m pipeline.run_all adhd200 --stage --stage-quota 200
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+
+from . import telemetry
+from .config import DATASETS, LOG_ROOT, has_phenotype, read_sites, site_paths
+from .capture import STALL_TIMEOUT
+from .cophenotype import build_dataset
+from .costs import CostModel, features
+from .elements import write_registry
+from .hashcache import HashCache
+from .preflight import check_sites, errors
+from .scheduler import Scheduler, DONE, FAILED, SKIPPED, UP_TO_DATE
+from .shards import DEFAULT_SHARD_SIZE
+from .staging import DEFAULT_QUOTA_GB, Stager
+from .steps import DEFAULT_PHENOTYPE_MODE, DEFAULT_TIMEOUT, PHENOTYPE_MODES, site_steps
+from .verify import REPORT_FILE, errors as verify_errors, verify
+from .worker import ConverterPool
+
+
+def setup_logging(log_file):
+    """Log to both the run log and the console"""
+    log_file.parent.mkdir(parents=True, exist_ok=True)
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.FileHandler(log_file),
+            logging.StreamHandler()
+        ]
+    )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("datasets", nargs="*", metavar="DATASET",
+                        help=f"Datasets to process: {', '.join(sorted(DATASETS))} (default: all)")
+    parser.add_argument("--sites", nargs="+", help="Only process these sites")
+    parser.add_argument("--include-excluded", action="store_true",
+                        help="Also process sites excluded for known data issues")
+    parser.add_argument("--cpu-workers", type=int, help="Concurrent converter steps (default: CPU count)")
+    parser.add_argument("--io-workers", type=int, help="Concurrent file copy steps")
+    parser.add_argument("--fixed-timeout", action="store_true",
+                        help="Use --timeout for every converter call and start sites in list order, "
+                             "instead of predicting runtimes from logs/telemetry.jsonl")
+    parser.add_argument("--timeout", type=int, default=DEFAULT_TIMEOUT,
+                        help="Per-step converter timeout in seconds; the upper bound for predicted timeouts")
+    parser.add_argument("--stall-timeout", type=int, default=STALL_TIMEOUT,
+                        help="Kill and restart a converter whose output and CPU time have not advanced for this "
+                             "many seconds (0: only --timeout applies)")
+    parser.add_argument("--phenotype-mode", choices=PHENOTYPE_MODES, default=DEFAULT_PHENOTYPE_MODE,
+                        help="batch: index the phenotype CSV once and add every site in-process; "
+                             "delta: as batch, but write only the additions to {site}_phenotype_delta.ttl; "
+                             "csv2nidm: copy the BIDS graph and run csv2nidm per site")
+    parser.add_argument("--converter", choices=["worker", "subprocess"], default="worker",
+                        help="worker: run converters on persistent in-process workers (one per CPU "
+                             "worker); subprocess: one wrapper-script process per call")
+    parser.add_argument("--shard-size", type=int, default=DEFAULT_SHARD_SIZE,
+                        help="Convert sites with more subjects than this as parallel subject shards "
+                             "(0: convert every site whole)")
+    parser.add_argument("--compact", action="store_true",
+                        help="Also pack each site's graph into {site}.nidmz (see pipeline.compact)")
+    parser.add_argument("--deterministic-iris", action="store_true",
+                        help="Name graph nodes from their content, so unchanged inputs give identical files "
+                             "(see pipeline.canonical and pipeline.diff)")
+    parser.add_argument("--stage", action="store_true",
+                        help="Copy each site to local scratch ($SIMPLE2_STAGE_ROOT) before converting it")
+    parser.add_argument("--stage-quota", type=float, default=DEFAULT_QUOTA_GB,
+                        help=f"GB of scratch staged sites may use at a time (default: {DEFAULT_QUOTA_GB})")
+    parser.add_argument("--stage-workers", type=int, default=2, help="Sites copied concurrently")
+    parser.add_argument("--no-preflight", action="store_true",
+                        help="Schedule every site without checking it first (see pipeline.preflight)")
+    parser.add_argument("--no-verify", action="store_true",
+                        help="Skip the content check of the outputs (see pipeline.verify)")
+    parser.add_argument("--force", action="store_true",
+                        help="Rerun steps even if the build manifest says they are up to date")
+    args = parser.parse_args(argv)
+    unknown = [d for d in args.datasets if d not in DATASETS]
+    if unknown:
+        parser.error(f"Unknown dataset(s): {', '.join(unknown)}")
+    return args
+
+
+def collect_sites(datasets, sites=None, include_excluded=False):
+    """(dataset, site) pairs to process"""
+    pairs = []
+    for dataset in datasets:
+        for site in read_sites(dataset, include_excluded=include_excluded):
+            if sites is None or site in sites:
+                pairs.append((dataset, site))
+    return pairs
+
+
+def preflight(pairs, workers=None):
+    """Check the sites; return ({pair: error messages} for those that would fail, {pair: index})"""
+    blocked = {}
+    indexes = check_sites(pairs, workers)
+    for pair, index in indexes.items():
+        for severity, code, message in index["problems"]:
+            log = logging.error if severity == "error" else logging.warning
+            log(f"{pair[0]}/{pair[1]}: preflight {code}: {message}")
+        if errors(index):
+            blocked[pair] = errors(index)
+    return blocked, indexes
+
+
+def step_records(run, steps, indexes):
+    """Telemetry records for the scheduler's steps, with subject/scan/byte counts from preflight"""
+    records = []
+    for name, step in steps.items():
+        dataset, site, step_name = name.split("/", 2)
+        # Shard steps are named <step>/shard-NNN
+        step_name, _, shard = step_name.partition("/")
+        extra = {"shard": shard} if shard else {}
+        # Input features (the shard's for shard steps), prediction and timeout the step was planned with
+        info = step.info or features(indexes.get((dataset, site)))
+        records.append(telemetry.record(run, dataset, site, step_name + ("-shard" if shard else ""), step.status,
+                                        step.metrics, error=step.error, **dict(info, **extra)))
+    return records
+
+
+def summarize(pairs, steps, total_time, blocked=None):
+    """Log and write a per-site summary; return the number of failed sites"""
+    blocked = blocked or {}
+    summary_file = LOG_ROOT / "pipeline_summary.txt"
+    failed_sites = 0
+    lines = [
+        "Pipeline Processing Summary",
+        "=" * 50,
+        f"Processing completed at: {time.strftime('%Y-%m-%d %H:%M:%S')}",
+        f"Total time: {total_time:.2f} seconds ({total_time/60:.1f} minutes)",
+        "",
+    ]
+    for dataset, site in pairs:
+        prefix = f"{dataset}/{site}/"
+        site_steps_ = [s for name, s in steps.items() if name.startswith(prefix)]
+        if (dataset, site) in blocked:
+            failed_sites += 1
+            status = "BLOCKED (" + "; ".join(blocked[(dataset, site)]) + ")"
+        elif all(s.status == UP_TO_DATE for s in site_steps_):
+            status = "up to date"
+        elif all(s.status in (DONE, UP_TO_DATE) for s in site_steps_):
+            status = "complete"
+        else:
+            failed_sites += 1
+            bad = [f"{s.name[len(prefix):]}={s.status}" for s in site_steps_
+                   if s.status in (FAILED, SKIPPED)]
+            status = "FAILED (" + ", ".join(bad) + ")"
+        outputs = ", ".join(p.name for p in (site_paths(dataset, site)[k] for k in ("nidm", "phenotype", "phenotype_delta"))
+                            if p.exists())
+        lines.append(f"  {dataset:8s} {site:20s} {status:30s} {outputs}")
+
+    lines.append("")
+    lines.append(f"Sites: {len(pairs)}  Failed: {failed_sites}")
+    for line in lines:
+        logging.info(line)
+    with open(summary_file, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    logging.info(f"Summary saved to: {summary_file}")
+    return failed_sites
+
+
+def prepare(datasets, pairs, run, io_workers=None, check=True):
+    """Pre-run stages: co-phenotype CSVs, the data element registry and preflight; return (blocked, indexes)"""
+    stages = []
+    for dataset in datasets:
+        if DATASETS[dataset]["phenotype_from_participants"]:
+            # Only new or changed participants.tsv files are re-parsed
+            with telemetry.measure(process=True) as metrics:
+                build_dataset(dataset, io_workers)
+            stages.append(telemetry.record(run, dataset, None, "cophenotype", "done", metrics))
+
+    if any(has_phenotype(dataset) for dataset in datasets):
+        # The phenotype steps reference, rather than define, the data elements
+        with telemetry.measure() as metrics:
+            path, count = write_registry()
+        stages.append(telemetry.record(run, None, None, "registry", "done", metrics))
+        logging.info(f"Wrote {count} data elements to {path}")
+
+    blocked, indexes = {}, {}
+    if check:
+        with telemetry.measure(process=True) as metrics:
+            blocked, indexes = preflight(pairs, io_workers)
+        stages.append(telemetry.record(run, None, None, "preflight", "done", metrics, sites=len(pairs)))
+    telemetry.append(stages)
+    if blocked:
+        logging.warning(f"{len(blocked)} sites fail preflight checks and will not be processed")
+    return blocked, indexes
+
+
+def conclude(run, pairs, steps, total_time, blocked, indexes, check=True, workers=None):
+    """Summarize a finished run, verify its outputs and record its telemetry; return the exit status"""
+    records = step_records(run, steps, indexes)
+    failed = summarize(pairs, steps, total_time, blocked)
+
+    if check:
+        checked = [pair for pair in pairs if pair not in blocked]
+        with telemetry.measure(process=True) as metrics:
+            report = verify(checked, indexes or None, workers)
+        unverified = {key: verify_errors(site) for key, site in report["sites"].items() if verify_errors(site)}
+        status = "failed" if unverified else "done"
+        records.append(telemetry.record(run, None, None, "verify", status, metrics, sites=len(checked)))
+        for key, problems in unverified.items():
+            logging.error(f"{key}: verification failed: {'; '.join(problems)}")
+        logging.info(f"Verified {len(checked)} sites, {len(unverified)} failed (report: {REPORT_FILE})")
+        failed += len(unverified)
+    telemetry.append(records)
+    logging.info(f"Telemetry appended to {telemetry.TELEMETRY_FILE} (python -m pipeline.telemetry report)")
+
+    return 1 if failed else 0
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    datasets = args.datasets or sorted(DATASETS)
+    setup_logging(LOG_ROOT / "pipeline_run_all.log")
+
+    pairs = collect_sites(datasets, args.sites, args.include_excluded)
+    logging.info(f"Found {len(pairs)} sites to process in {', '.join(datasets)}")
+
+    run = telemetry.new_run_id()
+    blocked, indexes = prepare(datasets, pairs, run, args.io_workers, check=not args.no_preflight)
+
+    scheduler = Scheduler(cpu_workers=args.cpu_workers, io_workers=args.io_workers)
+    # Workers are started on first use, so a fully up-to-date run starts none
+    pool = ConverterPool(scheduler.workers["cpu"]) if args.converter == "worker" else None
+    # Predicted runtimes order the sites longest-first and bound each converter call
+    costs = None if args.fixed_timeout else CostModel()
+    stager = None
+    if args.stage:
+        cache = None if os.environ.get("SIMPLE2_NO_HASH_CACHE") else HashCache()
+        stager = Stager(quota=int(args.stage_quota * 10**9), cache=cache)
+        scheduler.add_pool("stage", args.stage_workers)
+    for dataset, site in pairs:
+        if (dataset, site) in blocked:
+            continue
+        for step in site_steps(dataset, site, force=args.force, timeout=args.timeout,
+                               phenotype_mode=args.phenotype_mode, pool=pool, shard_size=args.shard_size,
+                               compact=args.compact, costs=costs, index=indexes.get((dataset, site)),
+                               stager=stager, deterministic=args.deterministic_iris,
+                               stall_timeout=args.stall_timeout):
+            scheduler.add(step)
+
+    start_time = time.time()
+    try:
+        steps = scheduler.run()
+    finally:
+        if pool is not None:
+            pool.close()
+        if stager is not None:
+            stager.close()
+    return conclude(run, pairs, steps, time.time() - start_time, blocked, indexes, check=not args.no_verify,
+                    workers=args.cpu_workers)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,167 @@
+"""
+Dependency-aware step scheduler.
+
+Each site contributes a small chain of steps (bidsmri2nidm -> copy -> csv2nidm).
+Steps whose dependencies have finished are handed to a CPU or I/O worker pool,
+so steps from different sites run concurrently. A step is only handed over
+when its pool has a free worker. Among the ready steps, the one with the
+longest predicted chain to the end of the DAG goes first (``cost``, see
+costs.py), so long sites are not left to start last.
+"""
+import logging
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from . import telemetry
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+SKIPPED = "skipped"
+UP_TO_DATE = "up-to-date"  # returned by a step func that found nothing to do
+
+
+class Step:
+    """A unit of work in the DAG; ``func`` raises on failure and may return UP_TO_DATE.
+
+    ``cost`` is the predicted wall time in seconds, if known; ``info`` holds
+    the input features and limits the step was planned with, for telemetry.
+    """
+
+    def __init__(self, name, func, deps=(), pool="cpu", cost=None, info=None):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.pool = pool
+        self.cost = cost
+        self.info = info or {}
+        self.status = PENDING
+        self.elapsed = 0.0
+        self.metrics = {}
+        self.error = None
+
+    def __repr__(self):
+        return f"Step({self.name!r}, {self.status})"
+
+
+def default_workers():
+    """Default (cpu, io) worker counts for this node"""
+    cpus = os.cpu_count() or 1
+    return cpus, max(2, cpus // 2)
+
+
+class Scheduler:
+    """Run a DAG of steps on separate CPU and I/O thread pools"""
+
+    def __init__(self, cpu_workers=None, io_workers=None):
+        default_cpu, default_io = default_workers()
+        self.workers = {
+            "cpu": cpu_workers or default_cpu,
+            "io": io_workers or default_io,
+        }
+        self.steps = {}
+
+    def add_pool(self, name, workers):
+        """Add a worker pool, e.g. for staging, that steps can name"""
+        self.workers[name] = workers
+
+    def add(self, step):
+        """Register a step; dependencies must be added before it"""
+        if step.name in self.steps:
+            raise ValueError(f"Duplicate step: {step.name}")
+        for dep in step.deps:
+            if dep not in self.steps:
+                raise ValueError(f"Step {step.name} depends on unknown step {dep}")
+        if step.pool not in self.workers:
+            raise ValueError(f"Unknown pool {step.pool!r} for step {step.name}")
+        self.steps[step.name] = step
+        return step
+
+    def _ready(self):
+        """Pending steps whose dependencies are done; skip those behind a failure"""
+        ready = []
+        for step in self.steps.values():
+            if step.status != PENDING:
+                continue
+            dep_status = [self.steps[dep].status for dep in step.deps]
+            if any(s in (FAILED, SKIPPED) for s in dep_status):
+                step.status = SKIPPED
+                logger.warning(f"Skipping {step.name}: an upstream step did not complete")
+            elif all(s in (DONE, UP_TO_DATE) for s in dep_status):
+                ready.append(step)
+        return ready
+
+    def ranks(self):
+        """{name: predicted seconds from the step's start to the end of its longest chain}"""
+        children = defaultdict(list)
+        for step in self.steps.values():
+            for dep in step.deps:
+                children[dep].append(step.name)
+        ranks = {}
+        # Dependencies are added first, so walking backwards ranks children before parents
+        for step in reversed(list(self.steps.values())):
+            ranks[step.name] = (step.cost or 0) + max((ranks[c] for c in children[step.name]), default=0)
+        return ranks
+
+    @staticmethod
+    def _run_step(step):
+        start_time = time.time()
+        try:
+            with telemetry.measure() as step.metrics:
+                return step.func()
+        finally:
+            step.elapsed = time.time() - start_time
+
+    def run(self):
+        """Run all steps to completion and return them keyed by name"""
+        logger.info(f"Scheduling {len(self.steps)} steps with "
+                    f"{self.workers['cpu']} CPU and {self.workers['io']} I/O workers")
+        ranks = self.ranks()
+        predicted = [s for s in self.steps.values() if s.cost is not None]
+        if predicted:
+            work = sum(s.cost for s in predicted if s.pool == "cpu")
+            logger.info(f"Predicted {work:.0f} s of CPU-pool work for {len(predicted)} steps; longest chain "
+                        f"{max(ranks.values()):.0f} s, lower bound on wall time "
+                        f"{max(work / self.workers['cpu'], max(ranks.values())):.0f} s")
+        pools = {name: ThreadPoolExecutor(max_workers=count, thread_name_prefix=name)
+                 for name, count in self.workers.items()}
+        running = {}
+        busy = defaultdict(int)
+        try:
+            while True:
+                # Steps are stored in insertion order with dependencies first,
+                # so a single pass propagates skips down a whole chain
+                for step in sorted(self._ready(), key=lambda s: -ranks[s.name]):
+                    if busy[step.pool] >= self.workers[step.pool]:
+                        continue
+                    step.status = RUNNING
+                    busy[step.pool] += 1
+                    logger.info(f"Starting {step.name}")
+                    running[pools[step.pool].submit(self._run_step, step)] = step
+                if not running:
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    step = running.pop(future)
+                    busy[step.pool] -= 1
+                    try:
+                        if future.result() == UP_TO_DATE:
+                            step.status = UP_TO_DATE
+                            logger.info(f"{step.name} is up to date")
+                        else:
+                            step.status = DONE
+                            logger.info(f"Finished {step.name} in {step.elapsed:.2f} seconds")
+                    except Exception as e:
+                        step.status = FAILED
+                        step.error = str(e)
+                        logger.error(f"{step.name} failed after {step.elapsed:.2f} seconds: {e}")
+        finally:
+            for pool in pools.values():
+                pool.shutdown(wait=True)
+        return self.steps
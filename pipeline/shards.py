@@ -0,0 +1,230 @@
+"""
+Subject-level sharding of large sites.
+
+A single bidsmri2nidm call per site makes the converter timeout all or
+nothing: a big site (ABIDEII-KKI_1, ABIDE1 NYU) either converts in one serial
+run or loses all its work. Sites with more than ``shard_size`` subjects are
+instead split into contiguous subject shards. Each shard is converted on its
+own, from a view directory under .pipeline/shards/<dataset>/<site>/ that links
+the site's top-level files and the shard's sub-* directories and has a
+participants.tsv with only the shard's rows. Each converted shard is
+checkpointed with digests of its inputs, so a rerun only converts shards whose
+subjects changed or whose conversion failed.
+
+merge_shards() then streams the shard graphs into the site's {site}_nidm.ttl:
+every shard's Project is renamed to the first shard's, so there is one
+Project node; PersonalDataElements defined by several shards (bidsmri2nidm
+gives each a random IRI) are renamed to the first definition; duplicate
+triples about shared nodes are dropped; and file locations under a view
+directory are rewritten to the site directory.
+"""
+import json
+import logging
+import os
+import shutil
+import threading
+from pathlib import Path
+
+from . import vocab
+from .config import STATE_ROOT, site_paths
+from .manifest import file_digest, listing_digest, walk_tree
+from .merge import UUID_NODE, merge_prefixes, triple_digest
+from .turtle import TurtleWriter, escape, is_literal, iter_statements, iter_triples, split_literal
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SHARD_SIZE = 50  # subjects; sites with at most this many are converted whole
+SHARD_RETRIES = 1  # extra attempts for a failed shard within one run
+
+
+def shard_root(dataset, site):
+    return STATE_ROOT / "shards" / dataset / site
+
+
+def subject_dirs(site_dir):
+    """Sorted sub-* directory names of a site"""
+    with os.scandir(site_dir) as it:
+        return sorted(e.name for e in it if e.name.startswith("sub-") and e.is_dir())
+
+
+def plan(subjects, shard_size):
+    """Split ``subjects`` into contiguous shards of at most ``shard_size``, evenly sized"""
+    if not shard_size or len(subjects) <= shard_size:
+        return [subjects]
+    count = -(-len(subjects) // shard_size)
+    return [subjects[i * len(subjects) // count:(i + 1) * len(subjects) // count] for i in range(count)]
+
+
+def filter_participants(data, subjects):
+    """participants.tsv bytes with only the header and the rows of ``subjects``"""
+    lines = data.splitlines(keepends=True)
+    if not lines:
+        return data
+    header = [col.strip() for col in lines[0].split(b"\t")]
+    id_col = header.index(b"participant_id") if b"participant_id" in header else 0
+    wanted = {s.encode("utf-8") for s in subjects} | {s[4:].encode("utf-8") for s in subjects}
+    rows = [line for line in lines[1:]
+            if len(line.split(b"\t")) > id_col and line.split(b"\t")[id_col].strip() in wanted]
+    return b"".join([lines[0]] + rows)
+
+
+class SiteShards:
+    """Shard plan, view directories and checkpoints for one site"""
+
+    def __init__(self, dataset, site, shard_size=DEFAULT_SHARD_SIZE):
+        self.dataset = dataset
+        self.site = site
+        self.site_dir = site_paths(dataset, site)["site_dir"]
+        self.root = shard_root(dataset, site)
+        self.shards = plan(subject_dirs(self.site_dir), shard_size)
+        self._lock = threading.Lock()
+        self._memo = {}
+
+    def __len__(self):
+        return len(self.shards)
+
+    def once(self, key, func):
+        """``func()`` computed once per site and shared by its shard steps"""
+        with self._lock:
+            if key not in self._memo:
+                self._memo[key] = func()
+            return self._memo[key]
+
+    def view(self, k):
+        return self.root / f"shard-{k:03d}"
+
+    def output(self, k):
+        return self.root / f"shard-{k:03d}.ttl"
+
+    def checkpoint(self, k):
+        return self.root / f"shard-{k:03d}.json"
+
+    def outputs(self):
+        return [self.output(k) for k in range(len(self))]
+
+    def top_level(self):
+        """Site entries every shard shares (everything but the sub-* directories)"""
+        with os.scandir(self.site_dir) as it:
+            return sorted(e.name for e in it if not (e.name.startswith("sub-") and e.is_dir()))
+
+    def listing(self, k):
+        """Digest of the files a shard's conversion reads: top-level files and its subjects' trees"""
+        entries = [(name, _fingerprint(self.site_dir / name)) for name in self.top_level()
+                   if not (self.site_dir / name).is_dir()]
+        for subject in self.shards[k]:
+            entries.extend((os.path.join(subject, rel), fp) for rel, fp in walk_tree(self.site_dir / subject))
+        return listing_digest(entries)
+
+    def is_current(self, k, inputs):
+        """True if shard ``k`` was converted from ``inputs`` and its output is intact"""
+        try:
+            with open(self.checkpoint(k), "r") as f:
+                recorded = json.load(f)
+            return recorded["inputs"] == inputs and recorded["output"] == file_digest(self.output(k))
+        except (OSError, ValueError, KeyError):
+            return False
+
+    def record(self, k, inputs):
+        tmp = self.checkpoint(k).with_suffix(".tmp")
+        with open(tmp, "w") as f:
+            json.dump({"subjects": self.shards[k], "inputs": inputs, "output": file_digest(self.output(k))},
+                      f, indent=1)
+        os.replace(tmp, self.checkpoint(k))
+
+    def build_view(self, k, source=None):
+        """(Re)create shard ``k``'s view directory, linking into ``source`` (default: the site); return it"""
+        source = Path(source or self.site_dir)
+        view = self.view(k)
+        if view.exists():
+            shutil.rmtree(view)
+        view.mkdir(parents=True)
+        for name in self.top_level():
+            if name == "participants.tsv":
+                data = (self.site_dir / name).read_bytes()
+                (view / name).write_bytes(filter_participants(data, self.shards[k]))
+            else:
+                os.symlink(source / name, view / name)
+        for subject in self.shards[k]:
+            os.symlink(source / subject, view / subject)
+        return view
+
+
+def _fingerprint(path):
+    if path.is_symlink():
+        return f"link\0{os.readlink(path)}"
+    st = path.stat()
+    return f"{st.st_size}\0{st.st_mtime_ns}"
+
+
+def _renames(files):
+    """{IRI: canonical IRI} that collapses the shards' Projects and repeated data elements"""
+    renames = {}
+    project = None
+    elements = {}
+    for path in files:
+        types, keys = {}, {}
+        for s, p, o in iter_triples(path):
+            if p == vocab.TYPE:
+                types.setdefault(s, set()).add(o)
+            elif p in (vocab.SOURCE_VARIABLE, vocab.LABEL) and is_literal(o):
+                keys.setdefault(s, {})[p] = split_literal(o)[0]
+        for node, node_types in types.items():
+            if vocab.PROJECT in node_types:
+                project = project or node
+                if node != project:
+                    renames[node] = project
+            elif vocab.PERSONAL_DATA_ELEMENT in node_types:
+                props = keys.get(node, {})
+                key = props.get(vocab.SOURCE_VARIABLE) or props.get(vocab.LABEL)
+                if key is None:
+                    continue
+                first = elements.setdefault(key, node)
+                if node != first:
+                    renames[node] = first
+    return renames
+
+
+def merge_shards(files, views, site_dir, output):
+    """Stream shard graphs into one site graph; return the number of triples written"""
+    renames = _renames(files)
+    shared = set(renames.values())
+    replacements = [(str(view), str(site_dir)) for view in views]
+    seen = set()
+    written = 0
+    output = Path(output)
+    tmp = output.with_suffix(f".{os.getpid()}.shards.tmp")
+
+    def term(t):
+        if t in renames:
+            return renames[t]
+        if is_literal(t):
+            for view, real in replacements:
+                if view in t:
+                    value, datatype, lang = split_literal(t)
+                    value = value.replace(view, real)
+                    suffix = f"^^<{datatype}>" if datatype else (f"@{lang}" if lang else "")
+                    return f'"{escape(value)}"{suffix}'
+        return t
+
+    with open(tmp, "w", encoding="utf-8") as out:
+        writer = TurtleWriter(out, merge_prefixes(files))
+        writer.write_prefixes()
+        for i, path in enumerate(files):
+            for subject, triples in iter_statements(path, bnode_prefix=f"s{i}b"):
+                if subject is None:
+                    continue
+                blocks = {}
+                for triple in triples:
+                    triple = tuple(term(t) for t in triple)
+                    s = triple[0]
+                    if s in shared or not (s.startswith("_:") or UUID_NODE.fullmatch(s)):
+                        digest = triple_digest(triple)
+                        if digest in seen:
+                            continue
+                        seen.add(digest)
+                    blocks.setdefault(s, []).append(triple[1:])
+                    written += 1
+                for s, props in blocks.items():
+                    writer.write_subject(s, props)
+    os.replace(tmp, output)
+    return written
@@ -0,0 +1,165 @@
+"""
+Stage BIDS sites from the shared datalad store onto node-local scratch.
+
+Without staging, every converter call reads its site tree from the network
+filesystem: the metadata walk and the full reads for the image sha512s go
+over the wire while the CPU waits. With ``run_all --stage`` each site gets a
+stage step on its own worker pool. The scheduler starts these steps in the
+same longest-first order as the conversions, so the next sites are copied
+while the current ones convert. A Stager copies a site to
+$SIMPLE2_STAGE_ROOT/<dataset>/<site> (default: the system temp directory):
+
+- at most ``quota`` bytes are staged at a time; a site waits up to STAGE_WAIT
+  seconds for space, and a site that does not fit is converted in place
+- the sha512 of every file is computed while it is copied and recorded in the
+  hash cache for the staged copy, so bidsmri2nidm does not read it again
+- the converter reads the staged copy, and the file locations in its output
+  are rewritten to the site directory (relocate())
+- the copy is evicted once the site's NIDM output passes verification, and
+  whatever is left is evicted at the end of the run
+
+Sites whose conversion is up to date are not staged.
+"""
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from .config import site_paths
+from .hashcache import BLOCK_SIZE
+from .manifest import IGNORED_DIRS
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUOTA_GB = 100
+STAGE_WAIT = 600  # seconds a site waits for quota before it is converted in place
+
+
+def default_root():
+    return Path(os.environ.get("SIMPLE2_STAGE_ROOT", Path(tempfile.gettempdir()) / "simple2_stage"))
+
+
+def site_files(site_dir):
+    """Yield (relative path, size) of the files a conversion reads, following annex links"""
+    for root, dirs, files in os.walk(site_dir):
+        dirs[:] = [d for d in dirs if d not in IGNORED_DIRS]
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                size = os.stat(path).st_size
+            except FileNotFoundError:
+                # An annexed file whose content was never fetched
+                size = 0
+            yield os.path.relpath(path, site_dir), size
+
+
+def copy_file(src, dst):
+    """Copy ``src`` to ``dst`` with its mtime; return the sha512 computed on the way"""
+    h = hashlib.sha512()
+    with open(src, "rb") as fin, open(dst, "wb") as fout:
+        for block in iter(lambda: fin.read(BLOCK_SIZE), b""):
+            h.update(block)
+            fout.write(block)
+    shutil.copystat(src, dst)
+    return h.hexdigest()
+
+
+def relocate(path, staged, site_dir):
+    """Rewrite the staged directory to the site directory throughout a Turtle file"""
+    staged, site_dir = str(staged), str(site_dir)
+    path = Path(path)
+    tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(path, "r", encoding="utf-8") as src, open(tmp, "w", encoding="utf-8") as out:
+        for line in src:
+            out.write(line.replace(staged, site_dir))
+    os.replace(tmp, path)
+
+
+class Stager:
+    """Copies sites to local scratch within a disk quota"""
+
+    def __init__(self, root=None, quota=DEFAULT_QUOTA_GB * 10**9, cache=None, wait=STAGE_WAIT):
+        self.root = Path(root or default_root())
+        self.quota = quota
+        self.cache = cache
+        self.wait = wait
+        self.used = 0
+        self._staged = {}  # (dataset, site) -> (path, bytes)
+        self._cond = threading.Condition()
+
+    def stage(self, dataset, site):
+        """Copy a site to scratch; return the staged directory, or None if it was not staged"""
+        site_dir = site_paths(dataset, site)["site_dir"]
+        files = list(site_files(site_dir))
+        size = sum(s for _, s in files)
+        if size > self.quota:
+            logger.warning(f"{dataset}/{site}: {size / 1e9:.1f} GB exceeds the staging quota; converting in place")
+            return None
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.used + size <= self.quota, timeout=self.wait):
+                logger.warning(f"{dataset}/{site}: no staging space after {self.wait} seconds; converting in place")
+                return None
+            self.used += size
+
+        start = time.time()
+        dest = self.root / dataset / site
+        partial = dest.with_name(f"{site}.partial")
+        try:
+            for path in (dest, partial):
+                if path.exists():
+                    shutil.rmtree(path)
+            for rel, _ in files:
+                src, dst = site_dir / rel, partial / rel
+                dst.parent.mkdir(parents=True, exist_ok=True)
+                if not src.exists():
+                    os.symlink(os.readlink(src), dst)
+                    continue
+                digest = copy_file(src, dst)
+                if self.cache is not None:
+                    self.cache.add(dst, digest)
+            os.rename(partial, dest)
+        except BaseException:
+            shutil.rmtree(partial, ignore_errors=True)
+            self._release(size)
+            raise
+        with self._cond:
+            self._staged[(dataset, site)] = (dest, size)
+        elapsed = time.time() - start
+        logger.info(f"{dataset}/{site}: staged {len(files)} files ({size / 1e9:.2f} GB) in {elapsed:.1f} seconds "
+                    f"({size / 1e6 / max(elapsed, 1e-3):.0f} MB/s)")
+        return dest
+
+    def source(self, dataset, site):
+        """Directory a conversion should read: the staged copy if there is one"""
+        with self._cond:
+            staged = self._staged.get((dataset, site))
+        return staged[0] if staged else site_paths(dataset, site)["site_dir"]
+
+    def is_staged(self, dataset, site):
+        with self._cond:
+            return (dataset, site) in self._staged
+
+    def _release(self, size):
+        with self._cond:
+            self.used -= size
+            self._cond.notify_all()
+
+    def evict(self, dataset, site):
+        with self._cond:
+            staged = self._staged.pop((dataset, site), None)
+        if staged is None:
+            return
+        shutil.rmtree(staged[0], ignore_errors=True)
+        self._release(staged[1])
+        logger.info(f"{dataset}/{site}: evicted the staged copy")
+
+    def close(self):
+        """Evict every remaining staged site"""
+        with self._cond:
+            keys = list(self._staged)
+        for key in keys:
+            self.evict(*key)
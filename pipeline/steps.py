@@ -0,0 +1,476 @@
+"""
+Per-site processing steps: bidsmri2nidm -> phenotype integration
+
+Phenotype integration is either the in-process batch stage (phenotype.py),
+writing the full {site}_phenotype.ttl ("batch") or only the additions to
+{site}_phenotype_delta.ttl ("delta"), or the original copy -> csv2nidm pair.
+
+Converters run either through the wrapper scripts (one micromamba process per
+call) or as jobs on a persistent ConverterPool (worker.py). Sites with more
+than ``shard_size`` subjects are converted as parallel subject shards and
+merged (shards.py). With ``compact`` a last step packs the site graph into
+{site}.nidmz (compact.py). With ``deterministic`` every graph a step writes
+gets content-derived IRIs (canonical.py). Step costs and converter timeouts
+can come from the runtime history (costs.py). Converter output is streamed
+into the site log, and a converter that stalls is killed and started again
+(capture.py).
+
+Each step consults the site's build manifest (see manifest.py) and is skipped
+when its inputs and outputs are unchanged since it last ran.
+"""
+import codecs
+import logging
+import os
+import select
+import shutil
+import subprocess
+import time
+from pathlib import Path
+
+from . import telemetry
+
+from .canonical import canonicalize
+from .capture import STALL_TIMEOUT, Monitor, RotatingLog, kill_tree, rotate_log
+from .compact import pack_site, site_archive_files
+from .config import DATASETS, WRAPPER_DIR, site_paths, has_phenotype
+from .costs import features
+from .manifest import (Manifest, file_digest, mapping_digest, seed_tree_digest, tree_digest, tsv_columns,
+                       tool_version)
+from .phenotype import integrate_site
+from .scheduler import Step, UP_TO_DATE
+from .shards import DEFAULT_SHARD_SIZE, SHARD_RETRIES, SiteShards, merge_shards
+from .staging import relocate
+from .verify import verify_nidm
+from .worker import WorkerError
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 3600  # seconds, per converter call
+STALL_RETRIES = 1  # extra attempts for a converter killed as stalled
+PHENOTYPE_MODES = ("batch", "delta", "csv2nidm")
+DEFAULT_PHENOTYPE_MODE = "batch"
+
+
+class StepError(Exception):
+    """Raised when a processing step fails"""
+
+
+class ConverterStalled(StepError):
+    """Raised when a converter was killed because its output and CPU time stopped advancing"""
+
+
+def _label(log_file, tool):
+    """"dataset/site tool" for progress messages, from the site log's path"""
+    site = log_file.name[:-len("_processing.log")] if log_file.name.endswith("_processing.log") else log_file.stem
+    return f"{log_file.parent.name}/{site} {tool}"
+
+
+def run_converter(cmd, log_file, timeout=DEFAULT_TIMEOUT, stall_timeout=STALL_TIMEOUT):
+    """Run a converter command, streaming its output into the site log"""
+    log_file = Path(log_file)
+    log_file.parent.mkdir(parents=True, exist_ok=True)
+    tool = Path(cmd[0]).name
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    with RotatingLog(log_file) as log:
+        log.write(f"Command: {' '.join(str(c) for c in cmd)}\n")
+        # Unbuffered, so the converter's output arrives as it is printed
+        proc = subprocess.Popen([str(c) for c in cmd], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                env=dict(os.environ, PYTHONUNBUFFERED="1"))
+        monitor = Monitor(_label(log_file, tool), proc.pid, stall_timeout)
+        output = proc.stdout.fileno()
+        deadline = time.time() + timeout
+        try:
+            while True:
+                readable, _, _ = select.select([output], [], [], 0.1) if output is not None else ([], [], [])
+                if readable:
+                    data = os.read(output, 1 << 16)
+                    if not data:
+                        output = None
+                    text = decoder.decode(data, final=not data)
+                    log.write(text)
+                    monitor.feed(text)
+                elif output is None:
+                    time.sleep(0.1)
+                # Reap the child with wait4() so its CPU time, peak RSS and I/O can be recorded
+                pid, status, usage = os.wait4(proc.pid, os.WNOHANG)
+                if pid:
+                    proc.returncode = os.waitstatus_to_exitcode(status)
+                    break
+                if time.time() > deadline:
+                    kill_tree(proc)
+                    raise StepError(f"{tool} timed out after {timeout} seconds (see {log_file})")
+                if monitor.stalled():
+                    kill_tree(proc)
+                    log.write(f"Killed: no output or CPU time for {stall_timeout} seconds\n")
+                    raise ConverterStalled(f"{tool} stalled: no output or CPU time for {stall_timeout} seconds "
+                                           f"after {monitor.progress()} (see {log_file})")
+            # Output still in the pipe after the exit
+            while output is not None and select.select([output], [], [], 1.0)[0]:
+                data = os.read(output, 1 << 16)
+                if not data:
+                    break
+                text = decoder.decode(data)
+                log.write(text)
+                monitor.feed(text)
+        finally:
+            proc.stdout.close()
+    telemetry.add(**telemetry.child_usage(usage))
+    if proc.returncode != 0:
+        last = monitor.last_line()
+        raise StepError(f"{tool} exited with code {proc.returncode} (see {log_file})"
+                        + (f": {last}" if last else ""))
+
+
+def run_pooled(pool, cmd, log_file, timeout=DEFAULT_TIMEOUT, stall_timeout=STALL_TIMEOUT):
+    """Run a wrapper command's converter as a job on a persistent worker"""
+    tool = Path(cmd[0]).name[len("run_"):-len("_noninteractive.sh")]
+    log_file = Path(log_file)
+    log_file.parent.mkdir(parents=True, exist_ok=True)
+    # The worker appends to the log itself, so it is rotated between jobs
+    rotate_log(log_file)
+    with open(log_file, "a") as log:
+        log.write(f"Command (worker): {tool} {' '.join(str(c) for c in cmd[1:])}\n")
+    try:
+        result = pool.run(tool, cmd[1:], log_file, timeout, stall_timeout=stall_timeout,
+                          label=_label(log_file, tool))
+    except WorkerError as e:
+        raise StepError(str(e))
+    telemetry.add(**result.get("usage", {}))
+    if not result["ok"]:
+        error = ConverterStalled if result.get("stalled") else StepError
+        raise error(f"{result['error']} (see {log_file})")
+    timing = f"{tool} finished in {result['seconds']:.2f} seconds"
+    if "cache_hits" in result:
+        timing += f" (sha512 cache: {result['cache_hits']} hits, {result['cache_misses']} misses)"
+    with open(log_file, "a") as log:
+        log.write(timing + "\n")
+    logger.info(f"{log_file.parent.name}: {timing}")
+
+
+def convert(cmd, log_file, timeout=DEFAULT_TIMEOUT, pool=None, stall_timeout=STALL_TIMEOUT):
+    """Run a converter wrapper command, on ``pool`` if one is given; a stalled run is killed and started again"""
+    for attempt in range(STALL_RETRIES + 1):
+        try:
+            if pool is None:
+                run_converter(cmd, log_file, timeout=timeout, stall_timeout=stall_timeout)
+            else:
+                run_pooled(pool, cmd, log_file, timeout=timeout, stall_timeout=stall_timeout)
+            return
+        except ConverterStalled as e:
+            if attempt == STALL_RETRIES:
+                raise
+            logger.warning(f"{e}; starting it again")
+
+
+def bidsmri2nidm_cmd(dataset, bids_dir, output):
+    return [
+        WRAPPER_DIR / "run_bidsmri2nidm_noninteractive.sh",
+        "-json_map", DATASETS[dataset]["json_map"],
+        "-d", bids_dir,
+        "-o", output,
+        "-no_concepts",
+    ]
+
+
+def bidsmri2nidm(dataset, site, timeout=DEFAULT_TIMEOUT, pool=None, stager=None, stall_timeout=STALL_TIMEOUT):
+    """Step 1: convert the BIDS site to NIDM, from its staged copy if there is one"""
+    paths = site_paths(dataset, site)
+    if not paths["site_dir"].is_dir():
+        raise StepError(f"Site directory not found: {paths['site_dir']}")
+    source = stager.source(dataset, site) if stager else paths["site_dir"]
+    convert(bidsmri2nidm_cmd(dataset, source, paths["nidm"]), paths["log"], timeout=timeout, pool=pool,
+            stall_timeout=stall_timeout)
+    if source != paths["site_dir"]:
+        relocate(paths["nidm"], source, paths["site_dir"])
+
+
+def stage_site(stager, dataset, site, force=False, shards=None, deterministic=False):
+    """Step 0: copy the site to local scratch unless its conversion is current"""
+    current = (lambda: site_current(dataset, site, deterministic))
+    if not force and (shards.once("site_current", current) if shards is not None else current()):
+        return UP_TO_DATE
+    stager.stage(dataset, site)
+
+
+def evict_site(stager, dataset, site, index=None):
+    """Step 1c: check the site's NIDM output, then drop its staged copy"""
+    if not stager.is_staged(dataset, site):
+        return UP_TO_DATE
+    problems = verify_nidm(dataset, site, index)
+    stager.evict(dataset, site)
+    if problems:
+        raise StepError(f"{site_paths(dataset, site)['nidm'].name} failed verification: {'; '.join(problems)}")
+
+
+def site_current(dataset, site, deterministic=False):
+    """True if the manifest says the site's bidsmri2nidm output is current"""
+    inputs_fn, outputs = site_inputs(dataset, site, deterministic=deterministic)["bidsmri2nidm"]
+    inputs = inputs_fn()
+    # The merge step checks the manifest again; spare it a second walk of the tree
+    seed_tree_digest(site_paths(dataset, site)["site_dir"], inputs["bids_tree"])
+    return not Manifest(dataset, site).changes("bidsmri2nidm", inputs, outputs)
+
+
+def convert_shard(shards, k, timeout=DEFAULT_TIMEOUT, pool=None, force=False, stager=None, deterministic=False,
+                  stall_timeout=STALL_TIMEOUT):
+    """Step 1a: convert subject shard ``k`` of a site unless its checkpoint is current"""
+    dataset, site = shards.dataset, shards.site
+    paths = site_paths(dataset, site)
+    if not force and shards.once("site_current", lambda: site_current(dataset, site, deterministic)):
+        return UP_TO_DATE
+    columns = tsv_columns(paths["site_dir"] / "participants.tsv")
+    inputs = {
+        "bids_tree": shards.listing(k),
+        "json_map": mapping_digest(DATASETS[dataset]["json_map"], columns),
+        "tool_version": tool_version(),
+    }
+    if not force and shards.is_current(k, inputs):
+        return UP_TO_DATE
+    view = shards.build_view(k, stager.source(dataset, site) if stager else None)
+    try:
+        for attempt in range(SHARD_RETRIES + 1):
+            try:
+                convert(bidsmri2nidm_cmd(dataset, view, shards.output(k)), paths["log"], timeout=timeout, pool=pool,
+                        stall_timeout=stall_timeout)
+                break
+            except ConverterStalled:
+                raise  # convert() already started it again
+            except StepError as e:
+                if attempt == SHARD_RETRIES:
+                    raise
+                logger.warning(f"{dataset}/{site} shard {k}: {e}; retrying")
+    finally:
+        shutil.rmtree(view, ignore_errors=True)
+    shards.record(k, inputs)
+
+
+def merge_site_shards(shards):
+    """Step 1b: merge the converted shards into the site's NIDM file"""
+    paths = site_paths(shards.dataset, shards.site)
+    views = [shards.view(k) for k in range(len(shards))]
+    triples = merge_shards(shards.outputs(), views, shards.site_dir, paths["nidm"])
+    logger.info(f"{shards.dataset}/{shards.site}: merged {len(shards)} shards ({triples} triples) "
+                f"into {paths['nidm'].name}")
+
+
+def canonicalize_output(dataset, site, path):
+    """Rename the converter-named nodes of a written graph from their content"""
+    start = time.time()
+    renamed = canonicalize(path, dataset, site)
+    logger.info(f"{dataset}/{site}: {renamed} nodes of {Path(path).name} renamed from their content "
+                f"in {time.time() - start:.1f} seconds")
+
+
+def copy_for_phenotype(dataset, site):
+    """Step 2: copy the BIDS NIDM file as the base for phenotype integration"""
+    paths = site_paths(dataset, site)
+    shutil.copy2(paths["nidm"], paths["phenotype"])
+
+
+def csv2nidm(dataset, site, timeout=DEFAULT_TIMEOUT, pool=None, stall_timeout=STALL_TIMEOUT):
+    """Step 3: merge phenotype data into the copied NIDM file"""
+    config = DATASETS[dataset]
+    paths = site_paths(dataset, site)
+    cmd = [
+        WRAPPER_DIR / "run_csv2nidm_noninteractive.sh",
+        "-csv", config["phenotype_csv"],
+        "-json_map", config["json_map"],
+        "-nidm", paths["phenotype"],
+        "-log", paths["log_dir"],
+        "-no_concepts",
+    ]
+    convert(cmd, paths["log"], timeout=timeout, pool=pool, stall_timeout=stall_timeout)
+    # csv2nidm leaves a backup of the input graph behind
+    Path(f"{paths['phenotype']}.bak").unlink(missing_ok=True)
+
+
+def bids_inputs(dataset, site, deterministic=False):
+    """Input digests that determine the bidsmri2nidm output"""
+    paths = site_paths(dataset, site)
+    if not paths["site_dir"].is_dir():
+        raise StepError(f"Site directory not found: {paths['site_dir']}")
+    columns = tsv_columns(paths["site_dir"] / "participants.tsv")
+    inputs = {
+        "bids_tree": tree_digest(paths["site_dir"]),
+        "json_map": mapping_digest(DATASETS[dataset]["json_map"], columns),
+        "tool_version": tool_version(),
+    }
+    if deterministic:
+        inputs["iris"] = "deterministic"
+    return inputs
+
+
+def phenotype_inputs(dataset, site, mode=DEFAULT_PHENOTYPE_MODE, deterministic=False):
+    """Input digests that determine the phenotype output"""
+    config = DATASETS[dataset]
+    paths = site_paths(dataset, site)
+    inputs = {
+        "nidm": file_digest(paths["nidm"]),
+        "json_map": mapping_digest(config["json_map"]),
+        "phenotype_csv": file_digest(config["phenotype_csv"]),
+        "phenotype_mode": mode,
+    }
+    if mode == "csv2nidm":
+        inputs["tool_version"] = tool_version()
+    if deterministic:
+        inputs["iris"] = "deterministic"
+    return inputs
+
+
+def compact_inputs(dataset, site):
+    """Digests of the Turtle files packed into the site's .nidmz"""
+    return {path.name: file_digest(path) for path in site_archive_files(dataset, site)}
+
+
+def site_inputs(dataset, site, phenotype_mode=DEFAULT_PHENOTYPE_MODE, compact=False, deterministic=False):
+    """Map of manifest step name -> (input digest function, outputs)"""
+    paths = site_paths(dataset, site)
+    steps = {"bidsmri2nidm": (lambda: bids_inputs(dataset, site, deterministic), [paths["nidm"]])}
+    if has_phenotype(dataset):
+        output = paths["phenotype_delta"] if phenotype_mode == "delta" else paths["phenotype"]
+        steps["phenotype"] = (lambda: phenotype_inputs(dataset, site, phenotype_mode, deterministic), [output])
+    if compact:
+        steps["compact"] = (lambda: compact_inputs(dataset, site), [paths["compact"]])
+    return steps
+
+
+def cached(dataset, site, name, manifest_step, run, force=False, record=True,
+           phenotype_mode=DEFAULT_PHENOTYPE_MODE, compact=False, deterministic=False):
+    """Wrap ``run`` so it is skipped when the manifest says ``manifest_step`` is current.
+
+    With ``record=False`` the step only consults a later step's record: the
+    copy is only redone when csv2nidm has to be rerun.
+    """
+    def func():
+        inputs_fn, outputs = site_inputs(dataset, site, phenotype_mode, compact, deterministic)[manifest_step]
+        manifest = Manifest(dataset, site)
+        start = time.time()
+        inputs = inputs_fn()
+        telemetry.add(hash=round(time.time() - start, 3))
+        if not force:
+            reasons = manifest.changes(manifest_step, inputs, outputs)
+            if not reasons:
+                return UP_TO_DATE
+            logger.info(f"{dataset}/{site}/{name}: rebuilding ({', '.join(reasons)})")
+        run()
+        if record:
+            manifest.record(manifest_step, inputs, outputs)
+    return func
+
+
+def site_steps(dataset, site, force=False, timeout=DEFAULT_TIMEOUT, phenotype_mode=DEFAULT_PHENOTYPE_MODE,
+               pool=None, shard_size=DEFAULT_SHARD_SIZE, compact=False, costs=None, index=None, stager=None,
+               deterministic=False, stall_timeout=STALL_TIMEOUT):
+    """Build the steps for a site; each one is skipped at run time if current.
+
+    ``phenotype_mode`` is "batch" (phenotype.py, CSV indexed once per run),
+    "delta" (the same, writing only the additions) or "csv2nidm" (copy the
+    BIDS graph and run csv2nidm on it). Converters run on ``pool`` (a
+    worker.ConverterPool) when given, else through the wrapper scripts. A site
+    with more than ``shard_size`` subjects (0: never) gets one conversion step
+    per shard and a bidsmri2nidm-merge step in place of the single
+    bidsmri2nidm step, so the merge's runtime is recorded apart from the
+    conversions'. With
+    ``compact`` the site's final graph is also packed into {site}.nidmz. With
+    ``deterministic`` each graph is rewritten with content-derived IRIs as
+    soon as it is written.
+
+    With a ``costs`` model (costs.CostModel) and the site's preflight
+    ``index``, each step gets a predicted cost and each converter call a
+    timeout derived from it instead of ``timeout``. A converter whose output
+    and CPU time stop advancing for ``stall_timeout`` seconds (0: never) is
+    killed and started once more (capture.py).
+
+    With a ``stager`` (staging.Stager) the site is first copied to local
+    scratch by a step on the "stage" pool, the conversion reads the copy, and
+    the copy is evicted once the NIDM output passes verification.
+    """
+    if phenotype_mode not in PHENOTYPE_MODES:
+        raise ValueError(f"Unknown phenotype mode: {phenotype_mode}")
+    paths = site_paths(dataset, site)
+    paths["output_dir"].mkdir(parents=True, exist_ok=True)
+    paths["log_dir"].mkdir(parents=True, exist_ok=True)
+    prefix = f"{dataset}/{site}"
+    options = {"force": force, "phenotype_mode": phenotype_mode, "compact": compact, "deterministic": deterministic}
+
+    def canonical(run, output):
+        """``run``, then with ``deterministic`` its output renamed from content"""
+        if not deterministic:
+            return run
+        return lambda: (run(), canonicalize_output(dataset, site, output))
+
+    def plan(step, shard=None, subjects=None, converter=False):
+        """(cost, info, converter timeout) of a step"""
+        info = features(index, subjects)
+        if costs is None:
+            return None, info, timeout
+        cost = costs.predict(dataset, site, step, info, shard)
+        info["predicted"] = None if cost is None else round(cost, 1)
+        if not converter:
+            return cost, info, timeout
+        info["timeout"] = costs.timeout(dataset, site, step, info, timeout, shard)
+        return cost, info, info["timeout"]
+
+    shards = SiteShards(dataset, site, shard_size) if shard_size and paths["site_dir"].is_dir() else None
+    steps, first = [], []
+    if stager is not None:
+        cost, info, _ = plan("stage")
+        steps.append(Step(f"{prefix}/stage", lambda: stage_site(stager, dataset, site, force, shards, deterministic),
+                          pool="stage", cost=cost, info=info))
+        first = [f"{prefix}/stage"]
+    if shards is not None and len(shards) > 1:
+        for k in range(len(shards)):
+            cost, info, limit = plan("bidsmri2nidm-shard", f"shard-{k:03d}", shards.shards[k], converter=True)
+            steps.append(Step(f"{prefix}/bidsmri2nidm/shard-{k:03d}",
+                              lambda k=k, limit=limit: convert_shard(shards, k, timeout=limit, pool=pool,
+                                                                     force=force, stager=stager,
+                                                                     deterministic=deterministic,
+                                                                     stall_timeout=stall_timeout),
+                              deps=first, cost=cost, info=info))
+        cost, info, _ = plan("bidsmri2nidm-merge")
+        bids_step = f"{prefix}/bidsmri2nidm-merge"
+        steps.append(Step(bids_step,
+                          cached(dataset, site, "bidsmri2nidm-merge", "bidsmri2nidm",
+                                 canonical(lambda: merge_site_shards(shards), paths["nidm"]), **options),
+                          deps=[step.name for step in steps], cost=cost, info=info))
+    else:
+        cost, info, limit = plan("bidsmri2nidm", converter=True)
+        bids_step = f"{prefix}/bidsmri2nidm"
+        steps.append(Step(bids_step,
+                          cached(dataset, site, "bidsmri2nidm", "bidsmri2nidm",
+                                 canonical(lambda: bidsmri2nidm(dataset, site, timeout=limit, pool=pool,
+                                                                stager=stager, stall_timeout=stall_timeout),
+                                           paths["nidm"]),
+                                 **options),
+                          deps=first, cost=cost, info=info))
+    if has_phenotype(dataset) and phenotype_mode in ("batch", "delta"):
+        output = "delta" if phenotype_mode == "delta" else "full"
+        cost, info, _ = plan("phenotype")
+        steps.append(Step(f"{prefix}/phenotype",
+                          cached(dataset, site, "phenotype", "phenotype",
+                                 canonical(lambda: integrate_site(dataset, site, output=output),
+                                           paths["phenotype_delta" if output == "delta" else "phenotype"]),
+                                 **options),
+                          deps=[bids_step], cost=cost, info=info))
+    elif has_phenotype(dataset):
+        cost, info, _ = plan("copy")
+        steps.append(Step(f"{prefix}/copy",
+                          cached(dataset, site, "copy", "phenotype",
+                                 lambda: copy_for_phenotype(dataset, site), record=False, **options),
+                          deps=[bids_step], pool="io", cost=cost, info=info))
+        cost, info, limit = plan("csv2nidm", converter=True)
+        steps.append(Step(f"{prefix}/csv2nidm",
+                          cached(dataset, site, "csv2nidm", "phenotype",
+                                 canonical(lambda: csv2nidm(dataset, site, timeout=limit, pool=pool,
+                                                            stall_timeout=stall_timeout),
+                                           paths["phenotype"]), **options),
+                          deps=[f"{prefix}/copy"], cost=cost, info=info))
+    if compact:
+        cost, info, _ = plan("compact")
+        steps.append(Step(f"{prefix}/compact",
+                          cached(dataset, site, "compact", "compact", lambda: pack_site(dataset, site), **options),
+                          deps=[steps[-1].name], cost=cost, info=info))
+    if stager is not None:
+        steps.append(Step(f"{prefix}/evict", lambda: evict_site(stager, dataset, site, index),
+                          deps=[bids_step]))
+    return steps
@@ -0,0 +1,418 @@
+#!/usr/bin/env python
+"""
+Local indexed triple store over nidm_outputs.
+
+Answering a cohort question ("ASD subjects with a T1 at 3T and TR < 2 s across
+ABIDE1 and ABIDE2") otherwise means loading every Turtle file into rdflib.
+This module ingests the per-site graphs (see phenotype.site_graph_files)
+into a SQLite database at .pipeline/store.sqlite:
+
+- terms are dictionary-encoded (N-Triples text -> integer id); numeric
+  literals also keep their value, so filters like ``?tr < 2`` use it
+- triples are stored once per site graph with SPO, POS and OSP indexes
+- the shared data element registry is its own graph, not copied per site
+- ingest is incremental: a site is reloaded only when the digest of its graph
+  files changed, and sites whose files are gone are dropped
+
+Queries are conjunctions of triple patterns with ``?variables`` and numeric or
+equality filters, compiled to one SQL join. Results are memoized in the
+database keyed by the query text and the store generation. Every ingest that
+changes a graph bumps the generation, which invalidates the cache.
+
+Usage:
+    python -m pipeline.store ingest [DATASET ...]
+    python -m pipeline.store query '?acq dicom:MagneticFieldStrength ?t' '?acq dicom:RepetitionTime ?tr' \\
+        --filter '?t = 3' '?tr < 2' --select ?acq ?tr
+    python -m pipeline.store stats
+
+Set SIMPLE2_STORE to move the database.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from pathlib import Path
+
+from . import vocab
+from .config import DATASETS, STATE_ROOT, data_elements_path, read_sites, site_paths
+from .manifest import file_digest
+from .phenotype import site_graph_files
+from .turtle import TurtleReader, TurtleWriter, is_literal, literal, split_literal
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PATH = Path(os.environ.get("SIMPLE2_STORE", STATE_ROOT / "store.sqlite"))
+REGISTRY_GRAPH = ("*", "data_elements")
+BATCH_SIZE = 50000
+_TOKEN = re.compile(r'\?\w+|<[^>]*>|"(?:[^"\\]|\\.)*"(?:\^\^\S+|@[\w\-]+)?|\S+')
+_OPS = {"<", "<=", ">", ">=", "=", "!="}
+
+
+class QueryError(ValueError):
+    """Raised for a query the store cannot parse"""
+
+
+def numeric_value(term):
+    """Float value of a literal term whose text is a number, else None"""
+    if not is_literal(term):
+        return None
+    try:
+        value = float(split_literal(term)[0])
+    except ValueError:
+        return None
+    return value if value == value else None
+
+
+def parse_term(token):
+    """N-Triples term for a query token; ?variables are returned as is"""
+    if token.startswith("?"):
+        return token
+    if token == "a":
+        return vocab.TYPE
+    if token.startswith("<"):
+        return token
+    if token.startswith('"'):
+        end = token.rfind('"')
+        value = token[1:end].replace('\\"', '"').replace("\\\\", "\\")
+        suffix = token[end + 1:]
+        if suffix.startswith("^^"):
+            return literal(value, datatype=parse_term(suffix[2:])[1:-1])
+        if suffix.startswith("@"):
+            return literal(value, lang=suffix[1:])
+        return literal(value)
+    prefix, sep, local = token.partition(":")
+    if sep and prefix in vocab.PREFIXES:
+        return f"<{vocab.PREFIXES[prefix]}{local}>"
+    raise QueryError(f"Cannot parse term {token!r} (known prefixes: {', '.join(sorted(vocab.PREFIXES))})")
+
+
+def parse_pattern(text):
+    tokens = _TOKEN.findall(text)
+    if len(tokens) != 3:
+        raise QueryError(f"A pattern needs subject, predicate and object: {text!r}")
+    return tuple(parse_term(t) for t in tokens)
+
+
+def parse_filter(text):
+    tokens = _TOKEN.findall(text)
+    if len(tokens) != 3 or not tokens[0].startswith("?") or tokens[1] not in _OPS:
+        raise QueryError(f"A filter looks like '?var < 2' or '?var = \"R\"': {text!r}")
+    try:
+        value = float(tokens[2])
+    except ValueError:
+        value = parse_term(tokens[2])
+    return tokens[0], tokens[1], value
+
+
+class Store:
+    """SQLite-backed triple store with a query result cache"""
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        self._memo = {}
+        db = self._connect()
+        with db:
+            db.executescript("""
+                CREATE TABLE IF NOT EXISTS terms (
+                    id INTEGER PRIMARY KEY,
+                    term TEXT NOT NULL UNIQUE,
+                    num REAL);
+                CREATE TABLE IF NOT EXISTS graphs (
+                    id INTEGER PRIMARY KEY,
+                    dataset TEXT NOT NULL,
+                    site TEXT NOT NULL,
+                    digest TEXT NOT NULL,
+                    triples INTEGER NOT NULL,
+                    ingested REAL NOT NULL,
+                    UNIQUE (dataset, site));
+                CREATE TABLE IF NOT EXISTS triples (
+                    s INTEGER NOT NULL,
+                    p INTEGER NOT NULL,
+                    o INTEGER NOT NULL,
+                    g INTEGER NOT NULL,
+                    PRIMARY KEY (s, p, o, g)) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS triples_pos ON triples (p, o, s);
+                CREATE INDEX IF NOT EXISTS triples_osp ON triples (o, s, p);
+                CREATE INDEX IF NOT EXISTS triples_g ON triples (g);
+                CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS query_cache (
+                    key TEXT PRIMARY KEY,
+                    generation INTEGER NOT NULL,
+                    result TEXT NOT NULL);
+                INSERT OR IGNORE INTO meta VALUES ('generation', '0');
+            """)
+
+    def _connect(self):
+        # One connection per thread; sqlite3 connections are not thread-safe
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=60)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def generation(self):
+        return int(self._connect().execute("SELECT value FROM meta WHERE key='generation'").fetchone()[0])
+
+    def _term_ids(self, db, terms, cache):
+        """Ids for ``terms``, inserting new ones; ``cache`` maps term -> id across batches"""
+        missing = [t for t in set(terms) if t not in cache]
+        for t in missing:
+            row = db.execute("SELECT id FROM terms WHERE term=?", (t,)).fetchone()
+            if row is None:
+                cur = db.execute("INSERT INTO terms (term, num) VALUES (?, ?)", (t, numeric_value(t)))
+                cache[t] = cur.lastrowid
+            else:
+                cache[t] = row[0]
+        return cache
+
+    def load_graph(self, dataset, site, files, digest):
+        """Replace the triples of graph (dataset, site) with those of ``files``; return the count"""
+        db = self._connect()
+        cache = {}
+        count = 0
+        with db:
+            row = db.execute("SELECT id FROM graphs WHERE dataset=? AND site=?", (dataset, site)).fetchone()
+            if row is not None:
+                gid = row[0]
+                db.execute("DELETE FROM triples WHERE g=?", (gid,))
+            else:
+                gid = db.execute("INSERT INTO graphs (dataset, site, digest, triples, ingested) "
+                                 "VALUES (?, ?, '', 0, 0)", (dataset, site)).lastrowid
+            batch = []
+            for i, path in enumerate(files):
+                for triple in TurtleReader(path, bnode_prefix=f"g{gid}f{i}b"):
+                    batch.append(triple)
+                    if len(batch) >= BATCH_SIZE:
+                        count += self._insert(db, gid, batch, cache)
+                        batch = []
+            count += self._insert(db, gid, batch, cache)
+            db.execute("UPDATE graphs SET digest=?, triples=?, ingested=? WHERE id=?",
+                       (digest, count, time.time(), gid))
+            self._bump(db)
+        return count
+
+    def _insert(self, db, gid, batch, cache):
+        self._term_ids(db, (t for triple in batch for t in triple), cache)
+        db.executemany("INSERT OR IGNORE INTO triples VALUES (?, ?, ?, ?)",
+                       [(cache[s], cache[p], cache[o], gid) for s, p, o in batch])
+        return len(batch)
+
+    def drop_graph(self, dataset, site):
+        db = self._connect()
+        with db:
+            row = db.execute("SELECT id FROM graphs WHERE dataset=? AND site=?", (dataset, site)).fetchone()
+            if row is None:
+                return
+            db.execute("DELETE FROM triples WHERE g=?", (row[0],))
+            db.execute("DELETE FROM graphs WHERE id=?", (row[0],))
+            self._bump(db)
+
+    def _bump(self, db):
+        db.execute("UPDATE meta SET value = CAST(value AS INTEGER) + 1 WHERE key='generation'")
+        db.execute("DELETE FROM query_cache")
+
+    def graphs(self):
+        """{(dataset, site): (digest, triples)}"""
+        rows = self._connect().execute("SELECT dataset, site, digest, triples FROM graphs")
+        return {(d, s): (digest, n) for d, s, digest, n in rows}
+
+    def ingest(self, datasets=None, sites=None):
+        """Bring the store up to date with nidm_outputs; return {"loaded", "unchanged", "dropped"}"""
+        stats = {"loaded": [], "unchanged": 0, "dropped": []}
+        current = self.graphs()
+        registry = data_elements_path()
+        wanted = {}
+        for dataset in datasets or sorted(DATASETS):
+            for site in read_sites(dataset):
+                if sites and site not in sites:
+                    continue
+                if not site_paths(dataset, site)["nidm"].exists():
+                    continue
+                wanted[(dataset, site)] = [f for f in site_graph_files(dataset, site) if f != registry]
+        if registry.exists():
+            wanted[REGISTRY_GRAPH] = [registry]
+
+        for key, files in wanted.items():
+            digest = hashlib.sha256("\n".join(f"{f.name}:{file_digest(f)}" for f in files).encode()).hexdigest()
+            if current.get(key, (None,))[0] == digest:
+                stats["unchanged"] += 1
+                continue
+            start = time.time()
+            count = self.load_graph(*key, files, digest)
+            logger.info(f"{key[0]}/{key[1]}: loaded {count} triples in {time.time() - start:.1f} seconds")
+            stats["loaded"].append(key)
+        # Only graphs in the ingested scope can be stale
+        for key in current:
+            in_scope = (datasets is None or key[0] in datasets) and (sites is None or key[1] in sites)
+            if key not in wanted and key != REGISTRY_GRAPH and in_scope:
+                self.drop_graph(*key)
+                stats["dropped"].append(key)
+        if stats["loaded"] or stats["dropped"]:
+            with self._connect() as db:
+                db.execute("ANALYZE")
+        return stats
+
+    def _lookup(self, term):
+        row = self._connect().execute("SELECT id FROM terms WHERE term=?", (term,)).fetchone()
+        return row[0] if row else None
+
+    def compile(self, patterns, filters=(), select=None, datasets=None, limit=None):
+        """(sql, params, variables) for a conjunctive query, or None if a constant is unknown"""
+        columns = {}
+        joins, where, params = [], [], []
+        for i, pattern in enumerate(patterns):
+            joins.append(f"triples t{i}")
+            for col, term in zip("spo", pattern):
+                ref = f"t{i}.{col}"
+                if term.startswith("?"):
+                    if term in columns:
+                        where.append(f"{ref} = {columns[term]}")
+                    else:
+                        columns[term] = ref
+                else:
+                    term_id = self._lookup(term)
+                    if term_id is None:
+                        return None
+                    where.append(f"{ref} = ?")
+                    params.append(term_id)
+            if datasets:
+                marks = ", ".join("?" * (len(datasets) + 1))
+                where.append(f"t{i}.g IN (SELECT id FROM graphs WHERE dataset IN ({marks}))")
+                params.extend(list(datasets) + [REGISTRY_GRAPH[0]])
+        for n, (var, op, value) in enumerate(filters):
+            if var not in columns:
+                raise QueryError(f"Filter variable {var} is not in any pattern")
+            if isinstance(value, float):
+                joins.append(f"terms f{n}")
+                where.append(f"f{n}.id = {columns[var]}")
+                where.append(f"f{n}.num {op} ?")
+                params.append(value)
+            else:
+                if op not in ("=", "!="):
+                    raise QueryError(f"Only = and != compare with non-numeric values: {var} {op}")
+                term_id = self._lookup(value)
+                if term_id is None:
+                    if op == "=":
+                        return None
+                    continue
+                where.append(f"{columns[var]} {op} ?")
+                params.append(term_id)
+
+        select = list(select or columns)
+        unknown = [v for v in select if v not in columns]
+        if unknown:
+            raise QueryError(f"Selected variables not in any pattern: {', '.join(unknown)}")
+        out = []
+        for n, var in enumerate(select):
+            joins.append(f"terms v{n}")
+            where.append(f"v{n}.id = {columns[var]}")
+            out.append(f"v{n}.term")
+        sql = (f"SELECT DISTINCT {', '.join(out)} FROM {', '.join(joins)}"
+               + (f" WHERE {' AND '.join(where)}" if where else "")
+               + (f" LIMIT {int(limit)}" if limit else ""))
+        return sql, params, select
+
+    def query(self, patterns, filters=(), select=None, datasets=None, limit=None, use_cache=True):
+        """(variables, rows of N-Triples terms) for a query; cached until the next ingest"""
+        patterns = [parse_pattern(p) if isinstance(p, str) else tuple(p) for p in patterns]
+        filters = [parse_filter(f) if isinstance(f, str) else tuple(f) for f in filters]
+        key = hashlib.sha256(json.dumps([patterns, filters, select, sorted(datasets or []), limit]).encode()).hexdigest()
+        generation = self.generation()
+        if use_cache:
+            if (generation, key) in self._memo:
+                return self._memo[(generation, key)]
+            row = self._connect().execute("SELECT result FROM query_cache WHERE key=? AND generation=?",
+                                          (key, generation)).fetchone()
+            if row is not None:
+                result = tuple(json.loads(row[0]))
+                self._memo[(generation, key)] = result
+                return result
+
+        compiled = self.compile(patterns, filters, select, datasets, limit)
+        if compiled is None:
+            variables = list(select or dict.fromkeys(t for p in patterns for t in p if t.startswith("?")))
+            result = (variables, [])
+        else:
+            sql, params, variables = compiled
+            result = (variables, [list(r) for r in self._connect().execute(sql, params)])
+        db = self._connect()
+        with db:
+            db.execute("INSERT OR REPLACE INTO query_cache VALUES (?, ?, ?)", (key, generation, json.dumps(result)))
+        self._memo[(generation, key)] = result
+        return result
+
+    def stats(self):
+        db = self._connect()
+        return {
+            "path": str(self.path),
+            "graphs": db.execute("SELECT COUNT(*) FROM graphs").fetchone()[0],
+            "triples": db.execute("SELECT COALESCE(SUM(triples), 0) FROM graphs").fetchone()[0],
+            "terms": db.execute("SELECT COUNT(*) FROM terms").fetchone()[0],
+            "generation": self.generation(),
+            "cached_queries": db.execute("SELECT COUNT(*) FROM query_cache").fetchone()[0],
+            "size_mb": round(self.path.stat().st_size / 1e6, 1),
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Ingest NIDM outputs into an indexed store and query it")
+    parser.add_argument("--store", type=Path, default=DEFAULT_PATH, help="Store database path")
+    sub = parser.add_subparsers(dest="command", required=True)
+    ing = sub.add_parser("ingest", help="Load new or changed site graphs")
+    ing.add_argument("datasets", nargs="*", help="Datasets (default: all)")
+    ing.add_argument("--sites", nargs="+", help="Only these sites")
+    q = sub.add_parser("query", help="Run a conjunctive triple-pattern query")
+    q.add_argument("patterns", nargs="+", help="Triple patterns, e.g. '?acq dicom:RepetitionTime ?tr'")
+    q.add_argument("--filter", nargs="+", default=[], help="Filters, e.g. '?tr < 2' or '?hand = \"R\"'")
+    q.add_argument("--select", nargs="+", help="Variables to return (default: all)")
+    q.add_argument("--datasets", nargs="+", help="Only graphs of these datasets (plus the registry)")
+    q.add_argument("--limit", type=int)
+    q.add_argument("--no-cache", action="store_true", help="Ignore cached results")
+    q.add_argument("--count", action="store_true", help="Print only the number of rows")
+    sub.add_parser("stats", help="Show store size and cache state")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    store = Store(args.store)
+    if args.command == "ingest":
+        unknown = [d for d in args.datasets if d not in DATASETS]
+        if unknown:
+            parser.error(f"Unknown dataset(s): {', '.join(unknown)}")
+        start = time.time()
+        stats = store.ingest(args.datasets or None, args.sites)
+        logger.info(f"Loaded {len(stats['loaded'])} graphs, {stats['unchanged']} unchanged, "
+                    f"{len(stats['dropped'])} dropped in {time.time() - start:.1f} seconds")
+    elif args.command == "query":
+        start = time.time()
+        try:
+            variables, rows = store.query(args.patterns, args.filter, args.select, args.datasets, args.limit,
+                                          use_cache=not args.no_cache)
+        except QueryError as e:
+            parser.error(str(e))
+        elapsed = time.time() - start
+        if args.count:
+            print(len(rows))
+        else:
+            writer = TurtleWriter(sys.stdout, vocab.PREFIXES)
+            print("\t".join(variables))
+            for row in rows:
+                print("\t".join(writer.compact(t) for t in row))
+        logger.info(f"{len(rows)} rows in {elapsed * 1000:.1f} ms")
+    else:
+        for key, value in store.stats().items():
+            print(f"{key}: {value}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+"""
+Structured per-site, per-step performance telemetry.
+
+Every step run_all executes is written as one JSON line to
+logs/telemetry.jsonl: the pre-run stages (co-phenotype, data element
+registry, preflight indexing) and each site's bidsmri2nidm, phenotype, copy
+and csv2nidm steps. A record carries:
+
+    run, time, dataset, site, step, status, error
+    wall, cpu              seconds; cpu includes the converter process
+    hash                   seconds spent computing manifest input digests
+    peak_rss_mb            converter steps: the converter process' high-water
+                           mark; in-process steps: the pipeline process'
+    read_bytes, write_bytes   storage I/O of the step (null if unavailable)
+    subjects, scans        from the site's preflight index
+
+Runs append to the file, so ``report`` can compare them: it prints per-dataset
+tables for the latest run and flags steps that got markedly slower than their
+median over earlier runs.
+
+Usage:
+    python -m pipeline.telemetry report [--dataset DATASET] [--threshold 1.5]
+"""
+import argparse
+import json
+import logging
+import resource
+import statistics
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+
+from .config import LOG_ROOT
+
+logger = logging.getLogger(__name__)
+
+TELEMETRY_FILE = LOG_ROOT / "telemetry.jsonl"
+MIN_REGRESSION_SECONDS = 5.0  # ignore slowdowns of steps faster than this
+_local = threading.local()
+_write_lock = threading.Lock()
+
+
+def new_run_id():
+    return time.strftime("%Y%m%dT%H%M%S") + f"-{uuid.uuid4().hex[:6]}"
+
+
+def io_counters(path="/proc/thread-self/io"):
+    """(read_bytes, write_bytes) of storage I/O from a /proc io file, or None"""
+    try:
+        with open(path, "r") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+        return int(fields["read_bytes"]), int(fields["write_bytes"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def peak_rss_mb(usage=None):
+    """ru_maxrss of ``usage`` (default: this process) in MB"""
+    usage = usage or resource.getrusage(resource.RUSAGE_SELF)
+    return round(usage.ru_maxrss / 1024, 1)
+
+
+def process_usage(before=None):
+    """CPU seconds, peak RSS and I/O of this process, as a delta from ``before`` if given"""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    io = io_counters("/proc/self/io")
+    current = {"cpu": usage.ru_utime + usage.ru_stime, "peak_rss_mb": peak_rss_mb(usage),
+               "read_bytes": io[0] if io else None, "write_bytes": io[1] if io else None}
+    if before is None:
+        return current
+    delta = dict(current)
+    for key in ("cpu", "read_bytes", "write_bytes"):
+        if current[key] is not None and before.get(key) is not None:
+            delta[key] = current[key] - before[key]
+    return delta
+
+
+def child_usage(usage):
+    """Metrics of a reaped child from its os.wait4() rusage (blocks are 512 bytes)"""
+    return {"cpu": usage.ru_utime + usage.ru_stime, "peak_rss_mb": peak_rss_mb(usage),
+            "read_bytes": usage.ru_inblock * 512, "write_bytes": usage.ru_oublock * 512}
+
+
+def add(**metrics):
+    """Add metrics to the step measured on this thread; cpu and byte counts accumulate"""
+    current = getattr(_local, "metrics", None)
+    if current is None:
+        return
+    for key, value in metrics.items():
+        if value is None:
+            continue
+        if key in ("cpu", "read_bytes", "write_bytes", "hash"):
+            current[key] = (current.get(key) or 0) + value
+        elif key == "peak_rss_mb":
+            current[key] = max(current.get(key) or 0, value)
+        else:
+            current[key] = value
+
+
+@contextmanager
+def measure(process=False):
+    """Measure the calling thread; yields the metrics dict, filled in on exit.
+
+    With ``process=True`` CPU and I/O are counted for the whole process, for
+    stages that fan out to thread pools while nothing else is running.
+    """
+    metrics = {}
+    previous = getattr(_local, "metrics", None)
+    _local.metrics = metrics
+    start, cpu = time.time(), time.thread_time()
+    io = io_counters()
+    before = process_usage() if process else None
+    try:
+        yield metrics
+    finally:
+        _local.metrics = previous
+        metrics["wall"] = round(time.time() - start, 3)
+        if process:
+            usage = process_usage(before)
+            metrics.update(usage, cpu=round(usage["cpu"], 3))
+        else:
+            metrics["cpu"] = round(time.thread_time() - cpu + metrics.get("cpu", 0), 3)
+            end_io = io_counters()
+            for i, key in enumerate(("read_bytes", "write_bytes")):
+                if io and end_io:
+                    metrics[key] = metrics.get(key, 0) + end_io[i] - io[i]
+                else:
+                    metrics.setdefault(key, None)
+            # In-process steps report the pipeline's own high-water mark
+            metrics.setdefault("peak_rss_mb", peak_rss_mb())
+
+
+def record(run, dataset, site, step, status, metrics, error=None, **counts):
+    """One telemetry record"""
+    return dict({"run": run, "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "dataset": dataset, "site": site,
+                 "step": step, "status": status, "error": error}, **metrics, **counts)
+
+
+def append(records, path=None):
+    """Append records to the telemetry file as JSON lines"""
+    path = Path(path or TELEMETRY_FILE)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with _write_lock, open(path, "a") as f:
+        for rec in records:
+            f.write(json.dumps(rec, sort_keys=True) + "\n")
+
+
+def read(path=None):
+    """All records of the telemetry file, skipping unparseable lines"""
+    path = Path(path or TELEMETRY_FILE)
+    records = []
+    if not path.exists():
+        return records
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return records
+
+
+def _size(n):
+    if n is None:
+        return "-"
+    for unit in ("B", "KB", "MB", "GB"):
+        if n < 1024 or unit == "GB":
+            return f"{n:.0f}{unit}" if unit == "B" else f"{n:.1f}{unit}"
+        n /= 1024
+
+
+def step_table(records):
+    """Lines of a per-step table for one dataset's records"""
+    by_step = defaultdict(list)
+    for rec in records:
+        by_step[rec["step"]].append(rec)
+    lines = [f"  {'step':14s} {'ok':>4s} {'fail':>4s} {'skip':>4s} {'cur':>4s} {'wall s':>9s} {'median':>8s} "
+             f"{'max':>8s} {'cpu s':>9s} {'rss MB':>7s} {'read':>8s} {'written':>8s}"]
+    for step, recs in by_step.items():
+        status = defaultdict(int)
+        for r in recs:
+            status[r["status"]] += 1
+        ran = [r for r in recs if r["status"] in ("done", "failed")]
+        walls = [r["wall"] for r in ran]
+        rss = max((r.get("peak_rss_mb") or 0 for r in ran), default=0)
+        read_ = sum(r.get("read_bytes") or 0 for r in ran) if ran else None
+        written = sum(r.get("write_bytes") or 0 for r in ran) if ran else None
+        lines.append(f"  {step:14s} {status['done']:4d} {status['failed']:4d} {status['skipped']:4d} "
+                     f"{status['up-to-date']:4d} {sum(walls):9.1f} "
+                     f"{statistics.median(walls) if walls else 0:8.1f} {max(walls, default=0):8.1f} "
+                     f"{sum(r.get('cpu') or 0 for r in ran):9.1f} {rss:7.0f} {_size(read_):>8s} "
+                     f"{_size(written):>8s}")
+    return lines
+
+
+def regressions(records, run, threshold=1.5, min_seconds=MIN_REGRESSION_SECONDS):
+    """[(record, baseline median)] for steps of ``run`` slower than threshold x their history"""
+    history = defaultdict(list)
+    for rec in records:
+        if rec["run"] != run and rec["status"] == "done":
+            history[(rec["dataset"], rec["site"], rec["step"])].append(rec["wall"])
+    found = []
+    for rec in records:
+        if rec["run"] != run or rec["status"] != "done":
+            continue
+        past = history.get((rec["dataset"], rec["site"], rec["step"]))
+        if not past:
+            continue
+        baseline = statistics.median(past)
+        if rec["wall"] >= min_seconds and rec["wall"] > threshold * baseline:
+            found.append((rec, baseline))
+    return found
+
+
+def report(records, threshold=1.5):
+    """Lines of the report for the latest run in ``records``"""
+    if not records:
+        return ["No telemetry recorded yet"]
+    runs = list(dict.fromkeys(r["run"] for r in records))
+    latest = runs[-1]
+    current = [r for r in records if r["run"] == latest]
+    lines = [f"Run {latest} ({len(runs)} runs recorded)", ""]
+    by_dataset = defaultdict(list)
+    for rec in current:
+        by_dataset[rec["dataset"] or "-"].append(rec)
+    for name, recs in sorted(by_dataset.items()):
+        whole = [r for r in recs if r["step"] in ("bidsmri2nidm", "bidsmri2nidm-merge")]
+        subjects = sum(r.get("subjects") or 0 for r in whole)
+        scans = sum(r.get("scans") or 0 for r in whole)
+        lines.append(f"{name}: {len({r['site'] for r in recs if r['site']})} sites, "
+                     f"{subjects} subjects, {scans} scans")
+        lines.extend(step_table(recs))
+        slowest = sorted((r for r in recs if r["site"] and r["status"] in ("done", "failed")),
+                         key=lambda r: -r["wall"])[:5]
+        if slowest:
+            lines.append("  slowest: " + ", ".join(f"{r['site']}/{r['step']} {r['wall']:.1f}s"
+                                                   for r in slowest))
+        for rec in recs:
+            if rec["status"] == "failed":
+                lines.append(f"  FAILED {rec['site']}/{rec['step']}: {rec.get('error')}")
+        lines.append("")
+
+    found = regressions(records, latest, threshold)
+    lines.append(f"Regressions (> {threshold}x the median of earlier runs): {len(found)}")
+    for rec, baseline in found:
+        lines.append(f"  {rec['dataset']}/{rec['site']}/{rec['step']}: {rec['wall']:.1f}s "
+                     f"vs {baseline:.1f}s ({rec['wall'] / baseline:.1f}x)")
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Summarize pipeline telemetry")
+    sub = parser.add_subparsers(dest="command", required=True)
+    rep = sub.add_parser("report", help="Per-dataset tables for the latest run and regressions")
+    rep.add_argument("--dataset", help="Only this dataset")
+    rep.add_argument("--threshold", type=float, default=1.5,
+                     help="Flag steps slower than this multiple of their median in earlier runs")
+    rep.add_argument("--file", type=Path, help=f"Telemetry file (default: {TELEMETRY_FILE})")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    records = [r for r in read(args.file) if not args.dataset or r["dataset"] == args.dataset]
+    print("\n".join(report(records, args.threshold)))
+    return 1 if records and regressions(records, records[-1]["run"], args.threshold) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,376 @@
+"""
+Minimal streaming Turtle reader and writer for the pipeline's own outputs.
+
+The NIDM files are written by rdflib, one statement per block terminated by a
+line ending in " .". The reader buffers one statement at a time, so memory is
+bounded by the largest statement rather than the file. Terms are returned as
+N-Triples strings (``<iri>``, ``_:label``, ``"lexical"^^<datatype>``), which
+makes them hashable, comparable across files and directly writable as N-Triples.
+"""
+import re
+
+XSD = "http://www.w3.org/2001/XMLSchema#"
+RDF = "http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+RDF_TYPE = f"<{RDF}type>"
+
+_TOKEN = re.compile(r'''
+    (?P<ws>\s+|\#[^\n]*)
+  | (?P<iri><[^<>"{}|^`\\\s]*>)
+  | (?P<long>"""(?:[^"\\]|\\.|"(?!""))*"""|\'\'\'(?:[^'\\]|\\.|'(?!''))*\'\'\')
+  | (?P<string>"(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*')
+  | (?P<directive>@prefix|@base)\b
+  | (?P<lang>@[A-Za-z]+(?:-[A-Za-z0-9]+)*)
+  | (?P<dtype>\^\^)
+  | (?P<bnode>_:[\w\-.]*[\w\-])
+  | (?P<number>[+-]?(?:\d+\.\d*(?:[eE][+-]?\d+)?|\.\d+(?:[eE][+-]?\d+)?|\d+[eE][+-]?\d+|\d+))
+  | (?P<keyword>(?:a|true|false|PREFIX|BASE|prefix|base)(?![\w:\-]))
+  | (?P<pname>(?:[A-Za-z][\w\-.]*[\w\-]|[A-Za-z])?:(?:(?:[\w\-:%]|\\.)(?:(?:[\w\-:.%]|\\.)*(?:[\w\-:%]|\\.))?)?)
+  | (?P<punct>[\[\]();,.])
+''', re.VERBOSE)
+
+_ESCAPES = {"t": "\t", "b": "\b", "n": "\n", "r": "\r", "f": "\f", '"': '"', "'": "'", "\\": "\\"}
+_PN_ESCAPE = re.compile(r"\\(.)")
+_UNESCAPE = re.compile(r'\\(u[0-9A-Fa-f]{4}|U[0-9A-Fa-f]{8}|.)', re.DOTALL)
+
+
+class TurtleError(ValueError):
+    """Raised on Turtle the reader does not understand"""
+
+
+class _Incomplete(TurtleError):
+    """The buffered text ends mid-statement"""
+
+
+def unescape(text):
+    """Decode Turtle string escapes"""
+    def repl(m):
+        esc = m.group(1)
+        if esc[0] in "uU":
+            return chr(int(esc[1:], 16))
+        return _ESCAPES.get(esc, esc)
+    return _UNESCAPE.sub(repl, text)
+
+
+def escape(text):
+    """Encode a string for an N-Triples / Turtle double-quoted literal"""
+    return (text.replace("\\", "\\\\").replace('"', '\\"')
+            .replace("\n", "\\n").replace("\r", "\\r").replace("\t", "\\t"))
+
+
+def literal(value, datatype=None, lang=None):
+    """Build an N-Triples literal term"""
+    term = f'"{escape(str(value))}"'
+    if lang:
+        return f"{term}@{lang}"
+    if datatype:
+        return f"{term}^^<{datatype}>"
+    return term
+
+
+def split_literal(term):
+    """(value, datatype, lang) of an N-Triples literal term"""
+    end = term.rfind('"')
+    value = unescape(term[1:end])
+    suffix = term[end + 1:]
+    if suffix.startswith("^^<"):
+        return value, suffix[3:-1], None
+    if suffix.startswith("@"):
+        return value, None, suffix[1:]
+    return value, None, None
+
+
+def is_literal(term):
+    return term.startswith('"')
+
+
+def iri(term):
+    """IRI string of an ``<iri>`` term"""
+    return term[1:-1]
+
+
+def _statements(lines):
+    """Group lines into complete statements (ending with '.' outside long strings)"""
+    buf = []
+    in_long = False
+    for line in lines:
+        buf.append(line)
+        # An odd number of long-string delimiters toggles whether we are inside one
+        if (line.count('"""') + line.count("'''")) % 2:
+            in_long = not in_long
+        stripped = line.rstrip()
+        if not in_long and stripped.endswith(".") and not stripped.startswith("#"):
+            yield "".join(buf)
+            buf = []
+    if "".join(buf).strip():
+        yield "".join(buf)
+
+
+class TurtleReader:
+    """Iterate the triples of a Turtle document one statement at a time.
+
+    ``bnode_prefix`` relabels blank nodes so that documents can be merged
+    without their blank node labels colliding.
+    """
+
+    def __init__(self, source, bnode_prefix="b"):
+        self.source = source
+        self.bnode_prefix = bnode_prefix
+        self.prefixes = {}
+        self.base = ""
+        self._bnode_count = 0
+        self._bnode_labels = {}
+
+    def __iter__(self):
+        for _, triples in self.statements():
+            yield from triples
+
+    def statements(self):
+        """Yield (subject, triples) for each statement.
+
+        ``triples`` includes those of blank nodes nested in the statement;
+        ``subject`` is None for prefix and base directives.
+        """
+        if isinstance(self.source, (str, bytes)) or hasattr(self.source, "__fspath__"):
+            with open(self.source, "r", encoding="utf-8") as f:
+                yield from self._parse(f)
+        else:
+            yield from self._parse(self.source)
+
+    def _parse(self, lines):
+        pending = ""
+        for chunk in _statements(lines):
+            # A '.' at the end of a line inside a literal can split a statement;
+            # keep buffering until the text parses as complete statements
+            pending += chunk
+            try:
+                self._tokens = self._tokenize(pending)
+                self._pos = 0
+                self._triples = []
+                subjects = []
+                while self._pos < len(self._tokens):
+                    subjects.append(self._statement())
+            except _Incomplete:
+                continue
+            pending = ""
+            if self._triples:
+                yield next((s for s in subjects if s is not None), None), self._triples
+        if pending.strip():
+            raise TurtleError(f"Unterminated statement: {pending[:200]!r}")
+
+    @staticmethod
+    def _tokenize(statement):
+        tokens = []
+        pos = 0
+        for m in _TOKEN.finditer(statement):
+            if m.start() != pos:
+                break
+            pos = m.end()
+            if m.lastgroup != "ws":
+                tokens.append((m.lastgroup, m.group()))
+        if pos != len(statement):
+            if statement[pos] in "\"'":
+                raise _Incomplete()
+            raise TurtleError(f"Cannot tokenize near: {statement[pos:pos + 80]!r}")
+        return tokens
+
+    # -- token helpers --
+
+    def _peek(self):
+        return self._tokens[self._pos] if self._pos < len(self._tokens) else (None, None)
+
+    def _next(self):
+        if self._pos >= len(self._tokens):
+            raise _Incomplete()
+        token = self._tokens[self._pos]
+        self._pos += 1
+        return token
+
+    def _expect(self, value):
+        kind, text = self._next()
+        if text != value:
+            raise TurtleError(f"Expected {value!r}, got {text!r}")
+
+    # -- grammar --
+
+    def _statement(self):
+        kind, text = self._peek()
+        if kind == "directive" or (kind == "keyword" and text.lower() in ("prefix", "base")):
+            self._next()
+            if text.lower().endswith("prefix"):
+                _, name = self._next()
+                _, ref = self._next()
+                self.prefixes[name[:-1]] = self._resolve(ref[1:-1])
+            else:
+                _, ref = self._next()
+                self.base = ref[1:-1]
+            if kind == "directive":
+                self._expect(".")
+            return None
+        if kind == "punct" and text == "[":
+            subject = self._blank_node_property_list()
+            if self._peek()[1] != ".":
+                self._predicate_object_list(subject)
+        else:
+            subject = self._term(self._next())
+            self._predicate_object_list(subject)
+        self._expect(".")
+        return subject
+
+    def _predicate_object_list(self, subject):
+        while True:
+            kind, text = self._next()
+            predicate = RDF_TYPE if (kind == "keyword" and text == "a") else self._term((kind, text))
+            while True:
+                self._triples.append((subject, predicate, self._object()))
+                if self._peek()[1] != ",":
+                    break
+                self._next()
+            if self._peek()[1] != ";":
+                return
+            while self._peek()[1] == ";":
+                self._next()
+            if self._peek()[1] in (".", "]", None):
+                return
+
+    def _object(self):
+        kind, text = self._peek()
+        if kind == "punct" and text == "[":
+            return self._blank_node_property_list()
+        if kind == "punct" and text == "(":
+            return self._collection()
+        return self._term(self._next())
+
+    def _blank_node_property_list(self):
+        self._expect("[")
+        node = self._new_bnode()
+        if self._peek()[1] != "]":
+            self._predicate_object_list(node)
+        self._expect("]")
+        return node
+
+    def _collection(self):
+        self._expect("(")
+        items = []
+        while self._peek()[1] != ")":
+            items.append(self._object())
+        self._next()
+        if not items:
+            return f"<{RDF}nil>"
+        head = node = self._new_bnode()
+        for i, item in enumerate(items):
+            self._triples.append((node, f"<{RDF}first>", item))
+            rest = self._new_bnode() if i < len(items) - 1 else f"<{RDF}nil>"
+            self._triples.append((node, f"<{RDF}rest>", rest))
+            node = rest
+        return head
+
+    def _new_bnode(self):
+        self._bnode_count += 1
+        return f"_:{self.bnode_prefix}{self._bnode_count}"
+
+    def _resolve(self, ref):
+        if self.base and not re.match(r"[A-Za-z][\w+.-]*:", ref):
+            return self.base + ref
+        return ref
+
+    def _term(self, token):
+        kind, text = token
+        if kind == "iri":
+            return f"<{self._resolve(unescape(text[1:-1]))}>"
+        if kind == "pname":
+            prefix, _, local = text.partition(":")
+            if prefix not in self.prefixes:
+                raise TurtleError(f"Undefined prefix: {prefix}:")
+            return "<" + self.prefixes[prefix] + _PN_ESCAPE.sub(r"\1", local) + ">"
+        if kind == "bnode":
+            label = text[2:]
+            if label not in self._bnode_labels:
+                self._bnode_labels[label] = self._new_bnode()
+            return self._bnode_labels[label]
+        if kind in ("string", "long"):
+            quote = 3 if kind == "long" else 1
+            value = unescape(text[quote:-quote])
+            nkind, ntext = self._peek()
+            if nkind == "lang":
+                self._next()
+                return literal(value, lang=ntext[1:])
+            if nkind == "dtype":
+                self._next()
+                return literal(value, datatype=iri(self._term(self._next())))
+            return literal(value)
+        if kind == "number":
+            if re.fullmatch(r"[+-]?\d+", text):
+                datatype = XSD + "integer"
+            elif "e" in text or "E" in text:
+                datatype = XSD + "double"
+            else:
+                datatype = XSD + "decimal"
+            return literal(text, datatype=datatype)
+        if kind == "keyword" and text in ("true", "false"):
+            return literal(text, datatype=XSD + "boolean")
+        raise TurtleError(f"Unexpected token {text!r}")
+
+
+def iter_triples(source, bnode_prefix="b"):
+    """Shorthand for iterating a TurtleReader"""
+    return iter(TurtleReader(source, bnode_prefix=bnode_prefix))
+
+
+def iter_statements(source, bnode_prefix="b"):
+    """Yield (subject, triples) for each statement block.
+
+    rdflib writes all of a subject's properties (and any nested blank nodes)
+    in one block, so a block is a natural per-node unit.
+    """
+    return TurtleReader(source, bnode_prefix=bnode_prefix).statements()
+
+
+class TurtleWriter:
+    """Write subjects as Turtle blocks, compacting IRIs with known prefixes"""
+
+    def __init__(self, f, prefixes):
+        self.f = f
+        # Longest namespace first so the most specific prefix wins
+        self.prefixes = sorted(prefixes.items(), key=lambda kv: -len(kv[1]))
+
+    def write_prefixes(self):
+        for name, ns in sorted(self.prefixes):
+            self.f.write(f"@prefix {name}: <{ns}> .\n")
+        self.f.write("\n")
+
+    def compact(self, term):
+        if term == RDF_TYPE:
+            return "a"
+        if term.startswith("<"):
+            value = iri(term)
+            for name, ns in self.prefixes:
+                if value.startswith(ns):
+                    local = value[len(ns):]
+                    if re.fullmatch(r"(?:[\w\-][\w\-.]*[\w\-]|[\w\-])?", local):
+                        return f"{name}:{local}"
+            return term
+        if term.startswith('"') and "^^<" in term:
+            value, datatype, _ = split_literal(term)
+            return f'"{escape(value)}"^^{self.compact(f"<{datatype}>")}'
+        return term
+
+    def _object(self, obj, indent):
+        # A list of (predicate, object) pairs is written as a nested blank node
+        if isinstance(obj, (list, tuple)):
+            pad = " " * (indent + 4)
+            inner = f" ;\n{pad}".join(f"{self.compact(p)} {self._object(o, indent + 4)}" for p, o in obj)
+            return f"[ {inner} ]"
+        return self.compact(obj)
+
+    def write_subject(self, subject, props):
+        """Write one subject block; ``props`` is a list of (predicate, object)"""
+        lines = []
+        last = None
+        for p, o in props:
+            # Repeated predicates become an object list: "a nidm:Session, prov:Activity"
+            if p == last:
+                lines[-1] += f",\n        {self._object(o, 8)}"
+            else:
+                lines.append(f"{self.compact(p)} {self._object(o, 8)}")
+            last = p
+        self.f.write(f"{self.compact(subject)} " + " ;\n    ".join(lines) + " .\n\n")
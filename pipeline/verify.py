@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+"""
+Verify the content of the NIDM outputs, not just that the files exist.
+
+The original verify_outputs() counted a site as complete once
+{site}_nidm.ttl and {site}_phenotype.ttl existed. That passed truncated
+files, csv2nidm runs that matched no subjects, and phenotype files identical
+to the BIDS copy. This stage instead stream-parses every output in parallel
+worker processes, without building a graph, and counts projects, subjects
+(agents with a src_subject_id), sessions, AcquisitionObjects, assessments and
+the subjects the assessments are about. It then checks each site:
+
+    error    parse failures, a missing output, subjects or scans in the
+             BIDS index (preflight) that are missing from the graph,
+             subjects with phenotype CSV rows that got no assessment, or
+             counts lower than in the previous report (a regression)
+    warning  fewer assessments than CSV rows, no BIDS index to check against
+
+The report is written to logs/verification.json. Each site also records
+the counts of its last error-free check, which are the baseline for
+regressions. run_all runs this stage after the conversions, and fails the run
+if any site has errors.
+
+Usage:
+    python -m pipeline.verify [DATASET ...] [--sites SITE ...] [--workers N] [--accept]
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from . import vocab
+from .config import DATASETS, LOG_ROOT, has_phenotype, read_sites, site_paths
+from .manifest import file_digest
+from .phenotype import get_index, normalize_subject_id
+from .preflight import check_sites
+from .scheduler import default_workers
+from .turtle import TurtleError, iter_statements, split_literal
+
+logger = logging.getLogger(__name__)
+
+REPORT_FILE = LOG_ROOT / "verification.json"
+COUNTS = ("subjects", "sessions", "acquisition_objects", "assessments")
+
+
+def scan_file(path):
+    """Counts of one Turtle file from a single streaming pass"""
+    path = Path(path)
+    counts = {"file": path.name, "bytes": path.stat().st_size, "triples": 0, "projects": 0, "sessions": 0,
+              "acquisition_objects": 0, "assessments": 0, "agents": {}, "assessed": set(), "error": None}
+    try:
+        for subject, triples in iter_statements(path):
+            if subject is None:
+                continue
+            counts["triples"] += len(triples)
+            types = {o for s, p, o in triples if s == subject and p == vocab.TYPE}
+            if vocab.PROJECT in types:
+                counts["projects"] += 1
+            if vocab.SESSION in types:
+                counts["sessions"] += 1
+            if vocab.ASSESSMENT_OBJECT in types:
+                counts["assessments"] += 1
+            elif vocab.ACQUISITION_OBJECT in types:
+                counts["acquisition_objects"] += 1
+            for s, p, o in triples:
+                if p == vocab.SRC_SUBJECT_ID and s == subject:
+                    counts["agents"][subject] = normalize_subject_id(split_literal(o)[0])
+                elif p == vocab.PROV_AGENT_PROP and vocab.ASSESSMENT in types:
+                    counts["assessed"].add(o)
+    except (TurtleError, UnicodeDecodeError, ValueError) as e:
+        counts["error"] = f"{type(e).__name__}: {str(e)[:120]}"
+    return counts
+
+
+def site_files(dataset, site):
+    """{role: path} of a site's outputs: the BIDS graph and its phenotype output, if any"""
+    paths = site_paths(dataset, site)
+    files = {"nidm": paths["nidm"]}
+    if paths["phenotype_delta"].exists():
+        files["phenotype"] = paths["phenotype_delta"]
+    elif paths["phenotype"].exists() or has_phenotype(dataset):
+        files["phenotype"] = paths["phenotype"]
+    return files
+
+
+def check_bids(bids, index=None):
+    """(counts, problems) of a BIDS graph's scan against the site's preflight index"""
+    problems = []
+    subjects = set(bids["agents"].values())
+    counts = {"projects": bids["projects"], "subjects": len(subjects), "sessions": bids["sessions"],
+              "acquisition_objects": bids["acquisition_objects"], "triples": bids["triples"]}
+    if bids["projects"] != 1:
+        problems.append(("error", "projects", f"{bids['file']} has {bids['projects']} nidm:Project nodes"))
+    if index and "subjects" in index:
+        expected = {normalize_subject_id(s) for s in index["subjects"]}
+        missing = sorted(expected - subjects)
+        if missing:
+            problems.append(("error", "missing-subjects", f"{len(missing)} of {len(expected)} BIDS subjects "
+                             f"are not in the graph (e.g. {missing[0]})"))
+        if bids["acquisition_objects"] < index["images"]:
+            problems.append(("error", "missing-scans", f"{bids['acquisition_objects']} AcquisitionObjects "
+                             f"for {index['images']} images"))
+        counts["bids_subjects"], counts["bids_images"] = len(expected), index["images"]
+    else:
+        problems.append(("warning", "no-bids-index", "no BIDS index to check subjects and scans against"))
+    return counts, problems
+
+
+def verify_nidm(dataset, site, index=None):
+    """Errors of a site's BIDS graph alone, checked as soon as it is written"""
+    path = site_paths(dataset, site)["nidm"]
+    if not path.exists():
+        return [f"{path.name} does not exist"]
+    scan = scan_file(path)
+    if scan["error"]:
+        return [f"{path.name}: {scan['error']}"]
+    return [message for severity, _, message in check_bids(scan, index)[1] if severity == "error"]
+
+
+def check_site(dataset, site, scans, index=None, phenotype=None, previous=None):
+    """Report for one site from its file scans, BIDS index and phenotype rows"""
+    problems = []
+    files = site_files(dataset, site)
+    for role, path in files.items():
+        scan = scans.get(path)
+        if scan is None:
+            problems.append(("error", "missing-output", f"{path.name} does not exist"))
+        elif scan["error"]:
+            problems.append(("error", "parse-error", f"{path.name}: {scan['error']}"))
+    bids = scans.get(files["nidm"])
+    pheno = scans.get(files.get("phenotype"))
+    counts = {}
+    if bids is not None:
+        subjects = set(bids["agents"].values())
+        counts, bids_problems = check_bids(bids, index)
+        problems.extend(bids_problems)
+
+        if phenotype is not None and pheno is not None and not pheno["error"]:
+            # Agents are defined in the BIDS graph; the full phenotype file repeats them
+            agents = dict(bids["agents"], **pheno["agents"])
+            with_rows = {s for s in subjects if s in phenotype}
+            assessed = {agents[a] for a in pheno["assessed"] if a in agents}
+            rows = sum(phenotype[s] for s in with_rows)
+            counts.update(assessments=pheno["assessments"], assessed_subjects=len(assessed),
+                          phenotype_subjects=len(with_rows), phenotype_rows=rows)
+            if files["phenotype"] == site_paths(dataset, site)["phenotype"] and \
+                    file_digest(files["phenotype"]) == file_digest(files["nidm"]):
+                problems.append(("error", "phenotype-unchanged",
+                                 f"{files['phenotype'].name} is identical to {files['nidm'].name}"))
+            elif with_rows and not assessed:
+                problems.append(("error", "no-phenotype-matches",
+                                 f"none of the {len(with_rows)} subjects with phenotype rows has an assessment"))
+            elif with_rows - assessed:
+                missing = sorted(with_rows - assessed)
+                problems.append(("error", "missing-phenotype", f"{len(missing)} subjects with phenotype rows "
+                                 f"have no assessment (e.g. {missing[0]})"))
+            if assessed and pheno["assessments"] < rows:
+                problems.append(("warning", "missing-assessments",
+                                 f"{pheno['assessments']} assessments for {rows} phenotype rows"))
+
+    baseline = (previous or {}).get("baseline", {})
+    for key in COUNTS:
+        if key in baseline and counts.get(key, 0) < baseline[key]:
+            problems.append(("error", "regression", f"{key} fell from {baseline[key]} to {counts.get(key, 0)}"))
+    report = {"dataset": dataset, "site": site, "files": {p.name: scans[p]["bytes"] for p in files.values()
+                                                          if p in scans},
+              "counts": counts, "problems": problems}
+    # A failing site keeps the counts of its last good report as the baseline
+    report["baseline"] = baseline if errors(report) else {k: counts[k] for k in COUNTS if k in counts}
+    return report
+
+
+def errors(report):
+    return [message for severity, _, message in report["problems"] if severity == "error"]
+
+
+def phenotype_rows(dataset):
+    """{subject ID: number of CSV rows} for a dataset with phenotype data, else None"""
+    if not has_phenotype(dataset):
+        return None
+    return {subject: len(rows) for subject, rows in get_index(dataset).rows.items()}
+
+
+def read_report(path=None):
+    path = Path(path or REPORT_FILE)
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_report(report, path=None):
+    path = Path(path or REPORT_FILE)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp, "w") as f:
+        json.dump(report, f, indent=1)
+    os.replace(tmp, path)
+
+
+def verify(pairs, indexes=None, workers=None, report_file=None, accept=False):
+    """Scan and check ``pairs``; write and return the report.
+
+    With ``accept`` the current counts become the baseline, e.g. after
+    subjects were deliberately removed from a site.
+    """
+    start = time.time()
+    previous = {} if accept else read_report(report_file).get("sites", {})
+    if indexes is None:
+        indexes = check_sites(pairs, workers)
+    paths = sorted({p for dataset, site in pairs for p in site_files(dataset, site).values() if p.exists()})
+    # Parsing is CPU-bound, so files are scanned in worker processes
+    with ProcessPoolExecutor(max_workers=workers or default_workers()[0]) as pool:
+        scans = dict(zip(paths, pool.map(scan_file, paths, chunksize=1)))
+
+    rows = {dataset: phenotype_rows(dataset) for dataset in {d for d, _ in pairs}}
+    sites = {}
+    for dataset, site in pairs:
+        key = f"{dataset}/{site}"
+        sites[key] = check_site(dataset, site, scans, indexes.get((dataset, site)), rows[dataset],
+                                previous.get(key))
+    report = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "seconds": round(time.time() - start, 2),
+              "files": len(paths), "bytes": sum(s["bytes"] for s in scans.values()), "sites": sites}
+    write_report(report, report_file)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check the content of the NIDM outputs")
+    parser.add_argument("datasets", nargs="*", help="Datasets (default: all)")
+    parser.add_argument("--sites", nargs="+", help="Only these sites")
+    parser.add_argument("--workers", type=int, help="Files parsed concurrently (default: CPU count)")
+    parser.add_argument("--report", type=Path, default=REPORT_FILE, help="Report file")
+    parser.add_argument("--accept", action="store_true",
+                        help="Take the current counts as the baseline instead of checking for regressions")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    unknown = [d for d in args.datasets if d not in DATASETS]
+    if unknown:
+        parser.error(f"Unknown dataset(s): {', '.join(unknown)}")
+
+    pairs = [(dataset, site) for dataset in (args.datasets or sorted(DATASETS))
+             for site in read_sites(dataset) if not args.sites or site in args.sites]
+    report = verify(pairs, workers=args.workers, report_file=args.report, accept=args.accept)
+    failed = 0
+    for key, site in report["sites"].items():
+        failed += bool(errors(site))
+        counts = site["counts"]
+        print(f"{key:28s} {counts.get('subjects', 0):4d} subjects {counts.get('acquisition_objects', 0):5d} scans "
+              f"{counts.get('assessments', 0):5d} assessments  {'FAILED' if errors(site) else 'ok'}")
+        for severity, code, message in site["problems"]:
+            print(f"    {severity:7s} {code}: {message}")
+    print(f"{len(pairs)} sites, {report['files']} files ({report['bytes'] / 1e6:.1f} MB) verified in "
+          f"{report['seconds']:.1f} seconds, {failed} failed; report: {args.report}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
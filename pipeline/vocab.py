@@ -0,0 +1,62 @@
+"""
+Namespaces and terms used in the NIDM outputs
+"""
+from .turtle import RDF, XSD, RDF_TYPE
+
+PROV = "http://www.w3.org/ns/prov#"
+NIDM = "http://purl.org/nidash/nidm#"
+NIIRI = "http://iri.nidash.org/"
+DCT = "http://purl.org/dc/terms/"
+DCTYPES = "http://purl.org/dc/dcmitype/"
+RDFS = "http://www.w3.org/2000/01/rdf-schema#"
+ONLI = "http://neurolog.unice.fr/ontoneurolog/v3.0/instrument.owl#"
+SIO = "http://semanticscience.org/ontology/sio.owl#"
+ILX = "http://uri.interlex.org/"
+NDAR = "https://ndar.nih.gov/api/datadictionary/v2/dataelement/"
+BIDS = "http://bids.neuroimaging.io/"
+DICOM = "http://neurolex.org/wiki/Category/DICOM_term/"
+NFO = "http://www.semanticdesktop.org/ontologies/2007/03/22/nfo#"
+CRYPTO = "http://id.loc.gov/vocabulary/preservation/cryptographicHashFunctions#"
+
+PREFIXES = {
+    "rdf": RDF, "xsd": XSD, "prov": PROV, "nidm": NIDM, "niiri": NIIRI, "dct": DCT,
+    "dctypes": DCTYPES, "rdfs": RDFS, "onli": ONLI, "sio": SIO, "ilx": ILX, "ndar": NDAR,
+    "bids": BIDS, "dicom": DICOM, "nfo": NFO, "crypto": CRYPTO,
+}
+
+# Node types
+PROJECT = f"<{NIDM}Project>"
+SESSION = f"<{NIDM}Session>"
+ACQUISITION = f"<{NIDM}Acquisition>"
+ACQUISITION_OBJECT = f"<{NIDM}AcquisitionObject>"
+PERSONAL_DATA_ELEMENT = f"<{NIDM}PersonalDataElement>"
+ASSESSMENT = f"<{ONLI}instrument-based-assessment>"
+ASSESSMENT_OBJECT = f"<{ONLI}assessment-instrument>"
+PROV_ACTIVITY = f"<{PROV}Activity>"
+PROV_ENTITY = f"<{PROV}Entity>"
+PROV_AGENT = f"<{PROV}Agent>"
+PROV_PERSON = f"<{PROV}Person>"
+PROV_ASSOCIATION = f"<{PROV}Association>"
+
+# Properties
+TYPE = RDF_TYPE
+IS_PART_OF = f"<{DCT}isPartOf>"
+LABEL = f"<{RDFS}label>"
+DESCRIPTION = f"<{DCT}description>"
+TITLE = f"<{DCTYPES}title>"
+IS_ABOUT = f"<{NIDM}isAbout>"
+SOURCE_VARIABLE = f"<{NIDM}sourceVariable>"
+VALUE_TYPE = f"<{NIDM}valueType>"
+HAS_UNIT = f"<{NIDM}hasUnit>"
+MIN_VALUE = f"<{NIDM}minValue>"
+MAX_VALUE = f"<{NIDM}maxValue>"
+ASSOCIATED_WITH = f"<{ILX}ilx_0739289>"
+QUALIFIED_ASSOCIATION = f"<{PROV}qualifiedAssociation>"
+PROV_AGENT_PROP = f"<{PROV}agent>"
+HAD_ROLE = f"<{PROV}hadRole>"
+WAS_GENERATED_BY = f"<{PROV}wasGeneratedBy>"
+SRC_SUBJECT_ID = f"<{NDAR}src_subject_id>"
+SHA512 = f"<{CRYPTO}sha512>"
+FILENAME = f"<{NFO}filename>"
+LOCATION = f"<{PROV}Location>"
+SUBJECT_ROLE = f"<{SIO}Subject>"
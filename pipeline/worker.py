@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+"""
+Long-lived converter workers.
+
+The wrapper scripts start a fresh ``micromamba run -n simple2`` process for
+every converter call and pipe a block of newlines into it to answer prompts,
+so each step pays environment activation, interpreter startup and the
+rdflib/pybids/PyNIDM imports. A ConverterPool instead keeps up to one worker
+process per CPU slot. Each worker imports the converters once and then runs
+jobs sent over its stdin as JSON lines, answering input() prompts from a fixed
+list of answers instead of piped stdin. It reports one JSON result line per job
+with the job's wall time and resource usage (see telemetry.py).
+
+A worker is started on first use. It is replaced if it dies, a job times
+out, or a job's log and CPU time stop advancing (a stall, see capture.py);
+otherwise it lives until the pool is closed.
+
+Worker side (runs inside the simple2 environment):
+    python -m pipeline.worker
+
+Set SIMPLE2_WORKER_CMD to change how workers are started (default:
+micromamba run -n simple2 python -m pipeline.worker).
+"""
+import builtins
+import importlib
+import json
+import logging
+import os
+import queue
+import select
+import shlex
+import subprocess
+import sys
+import threading
+import time
+
+from .capture import STALL_TIMEOUT, LogFollower, Monitor, kill_tree
+from .config import REPO_DIR
+from .launch import TOOLS, install_hooks
+from .telemetry import process_usage
+
+logger = logging.getLogger(__name__)
+
+WORKER_CMD = shlex.split(os.environ.get(
+    "SIMPLE2_WORKER_CMD", "micromamba run -n simple2 python -m pipeline.worker"))
+# Same answers the wrapper scripts pipe in; anything past these gets the default ("")
+PROMPT_ANSWERS = ["", "", "3"]
+STARTUP_TIMEOUT = 600  # seconds to import the converters
+
+
+class WorkerError(Exception):
+    """Raised when a worker cannot be started or dies mid-job"""
+
+
+class Worker:
+    """Handle on one worker process"""
+
+    def __init__(self, cmd=None):
+        env = dict(os.environ)
+        env["PYTHONPATH"] = str(REPO_DIR) + (os.pathsep + env["PYTHONPATH"] if env.get("PYTHONPATH") else "")
+        self.proc = subprocess.Popen(cmd or WORKER_CMD, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                     text=True, bufsize=1, env=env, cwd=REPO_DIR)
+        ready = self._read(STARTUP_TIMEOUT)
+        if ready is None or not ready.get("ready"):
+            self.kill()
+            raise WorkerError(f"Converter worker failed to start: {ready and ready.get('error')}")
+        logger.info(f"Converter worker {self.proc.pid} ready (imports took {ready['seconds']:.1f} seconds)")
+
+    def _read(self, timeout):
+        """Next result line, or None on timeout or exit"""
+        readable, _, _ = select.select([self.proc.stdout], [], [], timeout)
+        if not readable:
+            return None
+        line = self.proc.stdout.readline()
+        return json.loads(line) if line else None
+
+    def run(self, tool, args, log_file, timeout, monitor=None):
+        """Run one job; return the worker's result dict, or None if it timed out, stalled or died.
+
+        A ``monitor`` (capture.Monitor) follows the job's log while it runs;
+        the job is abandoned once the monitor finds it stalled.
+        """
+        follower = LogFollower(log_file)
+        self.proc.stdin.write(json.dumps({"tool": tool, "args": [str(a) for a in args],
+                                          "log": str(log_file)}) + "\n")
+        self.proc.stdin.flush()
+        if monitor is None:
+            return self._read(timeout)
+        deadline = time.time() + timeout
+        while True:
+            readable, _, _ = select.select([self.proc.stdout], [], [], min(1.0, max(0.0, deadline - time.time())))
+            monitor.feed(follower.read())
+            if readable:
+                line = self.proc.stdout.readline()
+                return json.loads(line) if line else None
+            if time.time() >= deadline or monitor.stalled():
+                return None
+
+    def alive(self):
+        return self.proc.poll() is None
+
+    def kill(self):
+        kill_tree(self.proc)
+
+    def close(self):
+        if self.alive():
+            self.proc.stdin.close()
+            try:
+                self.proc.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                self.kill()
+
+
+class ConverterPool:
+    """Up to ``size`` worker processes shared by the scheduler's CPU threads"""
+
+    def __init__(self, size, cmd=None):
+        self.size = size
+        self.cmd = cmd
+        self._idle = queue.LifoQueue()
+        self._started = 0
+        self._lock = threading.Lock()
+        self._workers = []
+
+    def _checkout(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            start = self._started < self.size
+            if start:
+                self._started += 1
+        if not start:
+            return self._idle.get()
+        try:
+            worker = Worker(self.cmd)
+        except Exception:
+            with self._lock:
+                self._started -= 1
+            raise
+        with self._lock:
+            self._workers.append(worker)
+        return worker
+
+    def _retire(self, worker):
+        worker.kill()
+        with self._lock:
+            self._started -= 1
+            self._workers.remove(worker)
+
+    def run(self, tool, args, log_file, timeout, stall_timeout=STALL_TIMEOUT, label=None):
+        """Run a converter job; return its result dict ({"ok", "seconds", "error", ...}).
+
+        A job whose log and CPU time stop advancing for ``stall_timeout``
+        seconds (0: never) is abandoned and its worker killed; the result
+        then has "stalled" set.
+        """
+        worker = self._checkout()
+        monitor = Monitor(label or tool, worker.proc.pid, stall_timeout)
+        try:
+            result = worker.run(tool, args, log_file, timeout, monitor)
+        except Exception:
+            self._retire(worker)
+            raise
+        if result is None:
+            # A timed-out or stalled job may still be running and a dead worker cannot be reused
+            stalled = worker.alive() and monitor.stuck
+            if not worker.alive():
+                reason = "died"
+            elif stalled:
+                reason = f"stalled: no output or CPU time for {stall_timeout} seconds after {monitor.progress()}"
+            else:
+                reason = f"timed out after {timeout} seconds"
+            self._retire(worker)
+            last = monitor.last_line()
+            return {"ok": False, "error": f"{tool} {reason}" + (f"; last output: {last}" if last else ""),
+                    "stalled": stalled}
+        self._idle.put(worker)
+        return result
+
+    def close(self):
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for worker in workers:
+            worker.close()
+
+
+# Worker side
+
+def answer_prompts(answers=PROMPT_ANSWERS):
+    """Replacement for builtins.input that replays ``answers``, then accepts defaults"""
+    remaining = list(answers)
+
+    def _input(prompt=""):
+        answer = remaining.pop(0) if remaining else ""
+        print(f"{prompt}{answer}  [answered automatically]")
+        return answer
+    return _input
+
+
+def run_job(job, modules, cache):
+    """Run one job with stdout/stderr going to its log file; return the result dict"""
+    start = time.time()
+    usage = process_usage()
+    hits, misses = (cache.hits, cache.misses) if cache is not None else (0, 0)
+    result = {"ok": True, "error": None}
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = os.dup(1), os.dup(2)
+    with open(job["log"], "a") as log:
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+        builtins.input = answer_prompts()
+        sys.argv = [job["tool"]] + job["args"]
+        try:
+            modules[job["tool"]].main()
+        except SystemExit as e:
+            if e.code not in (None, 0):
+                result = {"ok": False, "error": f"{job['tool']} exited with code {e.code}"}
+        except BaseException as e:
+            logging.exception(f"{job['tool']} failed")
+            result = {"ok": False, "error": f"{job['tool']} raised {type(e).__name__}: {e}"}
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved[0], 1)
+            os.dup2(saved[1], 2)
+            for fd in saved:
+                os.close(fd)
+    result["seconds"] = time.time() - start
+    # peak_rss_mb is the worker's high-water mark across all its jobs so far
+    result["usage"] = process_usage(usage)
+    if cache is not None:
+        result["cache_hits"] = cache.hits - hits
+        result["cache_misses"] = cache.misses - misses
+    return result
+
+
+def serve():
+    """Worker main loop: import the converters once, then run jobs from stdin"""
+    start = time.time()
+    # Results go out on a private copy of stdout; the converters' own output
+    # goes to each job's log, and stdin is reserved for jobs
+    results = os.fdopen(os.dup(1), "w", buffering=1)
+    jobs = os.fdopen(os.dup(0), "r")
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 0)
+    os.dup2(2, 1)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    try:
+        modules = {tool: importlib.import_module(name) for tool, name in TOOLS.items()}
+    except Exception as e:
+        results.write(json.dumps({"ready": False, "error": f"{type(e).__name__}: {e}"}) + "\n")
+        return 1
+    cache = None
+    if not os.environ.get("SIMPLE2_NO_HASH_CACHE"):
+        from .hashcache import HashCache
+        cache = HashCache()
+    if not install_hooks(modules["bidsmri2nidm"], cache):
+        cache = None
+    results.write(json.dumps({"ready": True, "seconds": time.time() - start}) + "\n")
+
+    for line in jobs:
+        results.write(json.dumps(run_job(json.loads(line), modules, cache)) + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(serve())
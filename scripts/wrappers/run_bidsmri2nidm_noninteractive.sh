@@ -2,7 +2,12 @@
 # Wrapper script to run bidsmri2nidm non-interactively
 # Provides default responses to any interactive prompts
 
+# Runs bidsmri2nidm through pipeline/launch.py so image sha512 sums come from
+# the persistent hash cache (set SIMPLE2_NO_HASH_CACHE=1 to disable)
+REPO_DIR="$(cd "$(dirname "$0")/../.." && pwd)"
+export PYTHONPATH="$REPO_DIR${PYTHONPATH:+:$PYTHONPATH}"
+
 # Pass all arguments to bidsmri2nidm
 # Provide sufficient newlines and default values for all potential prompts
 # Using echo with -e to provide multiple lines of input
-(echo -e "\n\n3\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n") | micromamba run -n simple2 bidsmri2nidm "$@"
\ No newline at end of file
+(echo -e "\n\n3\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n") | micromamba run -n simple2 python -m pipeline.launch bidsmri2nidm "$@"
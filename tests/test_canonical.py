@@ -0,0 +1,78 @@
+import random
+import uuid
+
+from pipeline import vocab
+from pipeline.canonical import canonicalize
+from pipeline.diff import compare_unit
+from pipeline.turtle import TurtleWriter, iter_triples, literal
+
+ROLE = f"<{vocab.SIO}Subject>"
+AGE = f"<{vocab.NIDM}age>"
+
+
+def write_graph(path, ages, seed):
+    """A small site graph whose Project, activities, entities and elements have fresh IRIs"""
+    def niiri():
+        return f"<{vocab.NIIRI}{uuid.uuid4()}>"
+
+    project, session, element = niiri(), niiri(), niiri()
+    blocks = [
+        (project, [(vocab.TYPE, vocab.PROJECT), (vocab.TITLE, literal("Site"))]),
+        (session, [(vocab.TYPE, vocab.SESSION), (vocab.IS_PART_OF, project)]),
+        (element, [(vocab.TYPE, vocab.PERSONAL_DATA_ELEMENT), (vocab.LABEL, literal("age")),
+                   (vocab.SOURCE_VARIABLE, literal("age"))]),
+    ]
+    for subject, age in sorted(ages.items()):
+        agent, scan, scan_object, assessment, assessment_object = niiri(), niiri(), niiri(), niiri(), niiri()
+        association = [(vocab.TYPE, vocab.PROV_ASSOCIATION), (vocab.PROV_AGENT_PROP, agent), (vocab.HAD_ROLE, ROLE)]
+        blocks += [
+            (agent, [(vocab.TYPE, vocab.PROV_PERSON), (vocab.SRC_SUBJECT_ID, literal(subject))]),
+            (scan, [(vocab.TYPE, vocab.ACQUISITION), (vocab.TYPE, vocab.PROV_ACTIVITY),
+                    (vocab.IS_PART_OF, session), (vocab.QUALIFIED_ASSOCIATION, association)]),
+            (scan_object, [(vocab.TYPE, vocab.ACQUISITION_OBJECT), (vocab.WAS_GENERATED_BY, scan),
+                           (vocab.FILENAME, literal(f"sub-{subject}_T1w.nii.gz")),
+                           (vocab.SHA512, literal(subject * 64))]),
+            (assessment, [(vocab.TYPE, vocab.ASSESSMENT), (vocab.TYPE, vocab.PROV_ACTIVITY),
+                          (vocab.IS_PART_OF, session), (vocab.QUALIFIED_ASSOCIATION, association)]),
+            (assessment_object, [(vocab.TYPE, vocab.ASSESSMENT_OBJECT), (vocab.WAS_GENERATED_BY, assessment),
+                                 (element, literal(age, vocab.XSD + "integer"))]),
+        ]
+    random.Random(seed).shuffle(blocks)
+    with open(path, "w", encoding="utf-8") as f:
+        writer = TurtleWriter(f, vocab.PREFIXES)
+        writer.write_prefixes()
+        for subject, props in blocks:
+            writer.write_subject(subject, props)
+
+
+AGES = {"01": "10", "02": "11", "03": "12"}
+
+
+def test_canonicalize_is_deterministic(tmp_path):
+    first, second = tmp_path / "first.ttl", tmp_path / "second.ttl"
+    write_graph(first, AGES, seed=1)
+    write_graph(second, AGES, seed=2)
+    assert first.read_bytes() != second.read_bytes()
+    triples = len(list(iter_triples(first)))
+
+    assert canonicalize(first, "ds", "site") > 0
+    canonicalize(second, "ds", "site")
+    assert first.read_bytes() == second.read_bytes()
+    assert len(list(iter_triples(first))) == triples
+    # Idempotent: a canonical graph keeps its names
+    canonical = first.read_bytes()
+    canonicalize(first, "ds", "site")
+    assert first.read_bytes() == canonical
+
+
+def test_compare_unit_reports_the_edited_subject(tmp_path):
+    old, new = tmp_path / "old.ttl", tmp_path / "new.ttl"
+    write_graph(old, AGES, seed=1)
+    write_graph(new, dict(AGES, **{"02": "13"}), seed=2)
+    result = compare_unit(("ds/site.ttl", [old], [new]))
+    assert result["status"] == "changed"
+    assert result["changed"] == ["2"]
+    assert not result["added"] and not result["removed"] and not result["site_changed"]
+
+    write_graph(new, AGES, seed=3)
+    assert compare_unit(("ds/site.ttl", [old], [new]))["status"] == "equivalent"
@@ -0,0 +1,56 @@
+import hashlib
+import io
+from collections import Counter
+
+from pipeline import vocab
+from pipeline.compact import CompactGraph, decode_terms, encode_term, pack
+from pipeline.turtle import TurtleReader, TurtleWriter, iter_triples, literal
+
+
+def write_graph(path, subjects, extra=""):
+    with open(path, "w", encoding="utf-8") as f:
+        writer = TurtleWriter(f, vocab.PREFIXES)
+        writer.write_prefixes()
+        for n in subjects:
+            digest = hashlib.sha512(f"{n}{extra}".encode()).hexdigest()
+            props = [(vocab.TYPE, vocab.ACQUISITION_OBJECT),
+                     (vocab.SHA512, literal(digest, vocab.XSD + "string")),
+                     (vocab.FILENAME, literal(f"sub-{n:02d}_T1w{extra}.nii.gz"))]
+            if not extra:
+                props += [(vocab.DESCRIPTION, literal(digest.upper())),
+                          (vocab.QUALIFIED_ASSOCIATION, [(vocab.PROV_AGENT_PROP, f"<{vocab.NIIRI}agent-{n}>")])]
+            writer.write_subject(f"<{vocab.NIIRI}scan-{n}>", props)
+
+
+def test_hex_literals_are_packed():
+    digest = hashlib.sha512(b"x").hexdigest()
+    for term in (f'"{digest}"^^<{vocab.XSD}string>', f'"{digest}"', f'"{digest.upper()}"', f"<{vocab.NIIRI}x>"):
+        data = encode_term(term)
+        assert decode_terms(data, 1) == ([term], len(data))
+    assert len(encode_term(f'"{digest}"')) < len(digest)
+
+
+def test_pack_round_trip(tmp_path):
+    files = [tmp_path / "nidm.ttl", tmp_path / "delta.ttl"]
+    write_graph(files[0], range(20))
+    write_graph(files[1], range(0, 20, 3), extra="_run-2")
+    original = [triple for i, path in enumerate(files) for triple in iter_triples(path, bnode_prefix=f"f{i}b")]
+    output = tmp_path / "site.nidmz"
+
+    stats = pack(files, output, codec="zlib", block_size=1024)
+    assert stats["blocks"] > 3 and stats["triples"] == len(original) and stats["subjects"] == 20
+    with CompactGraph(output) as graph:
+        assert len(graph) == len(original)
+        assert Counter(graph) == Counter(original)
+        for n in (0, 3, 19):
+            subject = f"<{vocab.NIIRI}scan-{n}>"
+            expected = {t for t in original if t[0] == subject}
+            expected |= {t for t in original if t[0] in {o for s, p, o in expected if o.startswith("_:")}}
+            assert set(graph.statements(subject)) == expected
+        # A subject with statements in both files has a range in more than one block
+        assert len({n for n, start, end in graph.index["subjects"][f"<{vocab.NIIRI}scan-0>"]}) == 2
+        assert graph.statements(f"<{vocab.NIIRI}missing>") == []
+        f = io.StringIO()
+        graph.write_turtle(f)
+    assert Counter(TurtleReader(io.StringIO(f.getvalue()))) == Counter(TurtleReader(io.StringIO(
+        "".join(path.read_text() for path in files))))
@@ -0,0 +1,52 @@
+import multiprocessing
+import os
+from collections import Counter
+
+from pipeline.jobqueue import JobQueue, work
+from pipeline.scheduler import DONE
+
+JOBS = [
+    {"id": "ds+site+a", "name": "ds/site/a", "deps": [], "priority": 3},
+    {"id": "ds+site+b", "name": "ds/site/b", "deps": [], "priority": 2},
+    {"id": "ds+site+c", "name": "ds/site/c", "deps": ["ds+site+a"], "priority": 2},
+    {"id": "ds+site+d", "name": "ds/site/d", "deps": ["ds+site+b", "ds+site+c"], "priority": 1},
+    {"id": "ds+site+e", "name": "ds/site/e", "deps": [], "priority": 1},
+]
+
+
+def _worker(root, log):
+    def run(job, pool, results, attempts):
+        assert all(results[dep]["status"] == DONE for dep in job["deps"])
+        with open(log, "a") as f:
+            f.write(f"{job['id']} {attempts}\n")
+        return {"status": DONE, "error": None, "metrics": {}, "elapsed": 0.0}
+
+    work(JobQueue(root), run=run, poll=0.05)
+
+
+def _run(queue, log, processes=3):
+    context = multiprocessing.get_context("fork")
+    workers = [context.Process(target=_worker, args=(queue.root, log)) for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(60)
+        assert worker.exitcode == 0
+    with open(log) as f:
+        return Counter(tuple(line.split()) for line in f)
+
+
+def test_resubmitted_queue_runs_every_job_again(tmp_path):
+    queue = JobQueue(tmp_path / "queue")
+    for run in ("run1", "run2"):
+        queue.create({"run": run}, JOBS)
+        assert not (queue.root / "finished.json").exists()
+        log = tmp_path / f"{run}.log"
+        ran = _run(queue, log)
+        assert ran == Counter((job["id"], "0") for job in JOBS)
+        assert queue.drained()
+        assert set(JobQueue(queue.root).finished()) == {job["id"] for job in JOBS}
+        assert not os.listdir(queue.claimed) and not os.listdir(queue.leases)
+        # What the end of a run leaves behind: its summary and a claim lost to a dead worker
+        (queue.root / "finished.json").write_text("{}")
+        (queue.lost / "ds+site+a@host-1.json").write_text("{}")
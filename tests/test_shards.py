@@ -0,0 +1,71 @@
+import uuid
+
+from pipeline import vocab
+from pipeline.shards import filter_participants, merge_shards, plan
+from pipeline.turtle import TurtleWriter, is_literal, iter_triples, literal, split_literal
+
+LOCATION = f"<{vocab.PROV}atLocation>"
+
+
+def niiri():
+    return f"<{vocab.NIIRI}{uuid.uuid4()}>"
+
+
+def write_shard(path, view, subjects):
+    """A bidsmri2nidm-like shard graph: its own Project and data element IRIs"""
+    project, age, sex = niiri(), niiri(), niiri()
+    with open(path, "w", encoding="utf-8") as f:
+        writer = TurtleWriter(f, vocab.PREFIXES)
+        writer.write_prefixes()
+        writer.write_subject(project, [(vocab.TYPE, vocab.PROJECT), (vocab.TITLE, literal("Site"))])
+        for element, variable in ((age, "age"), (sex, "sex")):
+            writer.write_subject(element, [(vocab.TYPE, vocab.PERSONAL_DATA_ELEMENT),
+                                           (vocab.LABEL, literal(variable)),
+                                           (vocab.SOURCE_VARIABLE, literal(variable))])
+        for subject in subjects:
+            session, scan, assessment = niiri(), niiri(), niiri()
+            writer.write_subject(session, [(vocab.TYPE, vocab.SESSION), (vocab.IS_PART_OF, project)])
+            writer.write_subject(scan, [(vocab.TYPE, vocab.ACQUISITION_OBJECT),
+                                        (LOCATION, literal(f"{view}/{subject}/anat/{subject}_T1w.nii.gz"))])
+            writer.write_subject(assessment, [(vocab.TYPE, vocab.ASSESSMENT_OBJECT),
+                                              (age, literal("12", vocab.XSD + "integer")),
+                                              (sex, literal("F"))])
+
+
+def test_plan():
+    subjects = [f"sub-{i:02d}" for i in range(7)]
+    assert plan(subjects, 10) == [subjects]
+    shards = plan(subjects, 3)
+    assert [len(shard) for shard in shards] == [2, 2, 3]
+    assert sum(shards, []) == subjects
+
+
+def test_filter_participants():
+    data = b"participant_id\tage\nsub-01\t10\nsub-02\t11\n03\t12\n"
+    assert filter_participants(data, ["sub-02", "sub-03"]) == b"participant_id\tage\nsub-02\t11\n03\t12\n"
+
+
+def test_merge_shards(tmp_path):
+    site_dir = tmp_path / "site"
+    views = [tmp_path / ".pipeline" / "shards" / "ds" / "site" / str(k) for k in range(2)]
+    files = [tmp_path / f"shard{k}.ttl" for k in range(2)]
+    write_shard(files[0], views[0], ["sub-01", "sub-02"])
+    write_shard(files[1], views[1], ["sub-03"])
+    output = tmp_path / "site_nidm.ttl"
+
+    written = merge_shards(files, views, site_dir, output)
+    triples = list(iter_triples(output))
+    assert written == len(triples) == len(set(triples))
+
+    projects = {s for s, p, o in triples if p == vocab.TYPE and o == vocab.PROJECT}
+    assert len(projects) == 1
+    assert {o for s, p, o in triples if p == vocab.IS_PART_OF} == projects
+    elements = {s: o for s, p, o in triples if p == vocab.SOURCE_VARIABLE}
+    assert sorted(split_literal(o)[0] for o in elements.values()) == ["age", "sex"]
+    # Every shard's assessments use the surviving element IRIs
+    assert {p for s, p, o in triples if p in elements or p.startswith(f"<{vocab.NIIRI}")} == set(elements)
+
+    locations = [split_literal(o)[0] for s, p, o in triples if is_literal(o) and p == LOCATION]
+    assert len(locations) == 3
+    assert all(location.startswith(f"{site_dir}/sub-") for location in locations)
+    assert not any(".pipeline/shards/" in o for s, p, o in triples if is_literal(o))
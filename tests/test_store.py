@@ -0,0 +1,70 @@
+import pytest
+
+from pipeline import store as store_module, vocab
+from pipeline.store import QueryError, Store
+from pipeline.turtle import TurtleWriter, literal
+
+TR = f"<{vocab.DICOM}RepetitionTime>"
+
+
+def write_site(path, trs):
+    with open(path, "w", encoding="utf-8") as f:
+        writer = TurtleWriter(f, vocab.PREFIXES)
+        writer.write_prefixes()
+        for n, tr in enumerate(trs):
+            writer.write_subject(f"<{vocab.NIIRI}{path.stem}-{n}>", [
+                (vocab.TYPE, vocab.ACQUISITION_OBJECT), (TR, literal(tr, vocab.XSD + "decimal"))])
+
+
+@pytest.fixture
+def sites(tmp_path, monkeypatch):
+    """{site: TR values} of a two-site dataset "ds"; ingest reads the sites listed in it"""
+    sites = {"A": ["1.5", "2.5"], "B": ["0.8"]}
+    for site, trs in sites.items():
+        write_site(tmp_path / f"{site}.ttl", trs)
+    monkeypatch.setattr(store_module, "read_sites", lambda dataset: sorted(sites))
+    monkeypatch.setattr(store_module, "site_paths", lambda dataset, site: {"nidm": tmp_path / f"{site}.ttl"})
+    monkeypatch.setattr(store_module, "site_graph_files", lambda dataset, site: [tmp_path / f"{site}.ttl"])
+    monkeypatch.setattr(store_module, "data_elements_path", lambda: tmp_path / "data_elements.ttl")
+    return sites
+
+
+def short_trs(store):
+    variables, rows = store.query(["?x dicom:RepetitionTime ?tr"], ["?tr < 2"], select=["?x"])
+    assert variables == ["?x"]
+    return sorted(row[0].rsplit("/", 1)[1][:-1] for row in rows)
+
+
+def test_query(tmp_path, sites):
+    store = Store(tmp_path / "store.sqlite")
+    assert store.ingest(["ds"])["loaded"] == [("ds", "A"), ("ds", "B")]
+    assert short_trs(store) == ["A-0", "B-0"]
+    variables, rows = store.query(["?x a nidm:AcquisitionObject", "?x dicom:RepetitionTime ?tr"],
+                                  ["?tr >= 2"], select=["?tr"])
+    assert rows == [[literal("2.5", vocab.XSD + "decimal")]]
+    # Terms the store has never seen match nothing
+    assert store.query(["?x dicom:RepetitionTime ?tr"], ['?tr = "unknown"']) == (["?x", "?tr"], [])
+    assert store.query(["?x dicom:EchoTime ?te"])[1] == []
+    with pytest.raises(QueryError):
+        store.query(["?x dicom:RepetitionTime ?tr"], ["?te < 2"])
+
+
+def test_ingest_invalidates_cache(tmp_path, sites):
+    store = Store(tmp_path / "store.sqlite")
+    store.ingest(["ds"])
+    assert short_trs(store) == ["A-0", "B-0"]
+    generation = store.generation()
+    assert store.ingest(["ds"]) == {"loaded": [], "unchanged": 2, "dropped": []}
+    assert store.generation() == generation
+
+    write_site(tmp_path / "A.ttl", ["1.5", "1.0"])
+    assert store.ingest(["ds"])["loaded"] == [("ds", "A")]
+    assert store.generation() > generation
+    assert short_trs(store) == ["A-0", "A-1", "B-0"]
+    # A second Store over the same file sees the change as well
+    assert short_trs(Store(tmp_path / "store.sqlite")) == ["A-0", "A-1", "B-0"]
+
+    del sites["B"]
+    assert store.ingest(["ds"])["dropped"] == [("ds", "B")]
+    assert set(store.graphs()) == {("ds", "A")}
+    assert short_trs(store) == ["A-0", "A-1"]
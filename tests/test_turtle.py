@@ -0,0 +1,62 @@
+import io
+
+from pipeline.turtle import RDF_TYPE, XSD, TurtleReader, TurtleWriter, literal, split_literal
+
+EX = "http://example.org/"
+
+DOCUMENT = '''@prefix ex: <http://example.org/> .
+@prefix xsd: <http://www.w3.org/2001/XMLSchema#> .
+
+ex:s a ex:Thing, ex:Other ;
+    ex:age "12.5"^^xsd:float ;
+    ex:label "caf\\u00e9 \\"quoted\\"\\n\\ttab"@en-US ;
+    ex:part [ a ex:Part ;
+            ex:n 3 ] .
+
+ex:t ex:p
+        <http://example.org/o> ;
+    ex:flag true .
+'''
+
+
+def ex(name):
+    return f"<{EX}{name}>"
+
+
+def read(text):
+    return set(TurtleReader(io.StringIO(text)))
+
+
+def test_reader_triples():
+    assert read(DOCUMENT) == {
+        (ex("s"), RDF_TYPE, ex("Thing")),
+        (ex("s"), RDF_TYPE, ex("Other")),
+        (ex("s"), ex("age"), literal("12.5", XSD + "float")),
+        (ex("s"), ex("label"), literal('café "quoted"\n\ttab', lang="en-US")),
+        ("_:b1", RDF_TYPE, ex("Part")),
+        ("_:b1", ex("n"), literal("3", XSD + "integer")),
+        (ex("s"), ex("part"), "_:b1"),
+        (ex("t"), ex("p"), ex("o")),
+        (ex("t"), ex("flag"), literal("true", XSD + "boolean")),
+    }
+
+
+def test_split_literal():
+    assert split_literal(literal('a "b"\n', XSD + "string")) == ('a "b"\n', XSD + "string", None)
+    assert split_literal(literal("x", lang="fr")) == ("x", None, "fr")
+
+
+def test_writer_round_trip():
+    f = io.StringIO()
+    writer = TurtleWriter(f, {"ex": EX, "xsd": XSD})
+    writer.write_prefixes()
+    writer.write_subject(ex("s"), [
+        (RDF_TYPE, ex("Thing")),
+        (RDF_TYPE, ex("Other")),
+        (ex("age"), literal("12.5", XSD + "float")),
+        (ex("label"), literal('café "quoted"\n\ttab', lang="en-US")),
+        (ex("part"), [(RDF_TYPE, ex("Part")), (ex("n"), literal("3", XSD + "integer"))]),
+    ])
+    writer.write_subject(ex("t"), [(ex("p"), f"<{EX}a/b?c=1>"), (ex("flag"), literal("true", XSD + "boolean"))])
+    assert read(f.getvalue()) == read(DOCUMENT) - {(ex("t"), ex("p"), ex("o"))} | {(ex("t"), ex("p"), f"<{EX}a/b?c=1>")}
+    assert "ex:Thing" in f.getvalue() and "xsd:float" in f.getvalue()